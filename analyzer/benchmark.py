@@ -0,0 +1,59 @@
+import argparse
+import time
+
+import keras
+import numpy
+
+from dataset import CLUMP_FEATURES
+from models import LR_SCALINGS, PROFILES, create_model
+
+
+def synthetic_segments(count, segment_size, seed=0):
+    """ Returns `count` random normalized segments and balanced labels; only the shapes matter here. """
+    rng = numpy.random.default_rng(seed)
+    x = rng.random((count, segment_size, CLUMP_FEATURES), dtype=numpy.float32)
+    y = (numpy.arange(count) % 2).astype(numpy.float32)
+    return x, y
+
+
+def benchmark_model(version, segment_size, profile_name, samples, epochs, batch_size=None, lr_scaling=None):
+    """ Returns the train and predict throughputs (samples/s) of a model under a profile, whose batch size
+        and learning rate scaling can be overridden. The first epoch and prediction are warm-ups, which is
+        where tracing and XLA compilation happen. """
+    keras.utils.set_random_seed(0)
+    profile = PROFILES[profile_name].override(batch_size, lr_scaling)
+    model = create_model(version, segment_size, profile)
+    x, y = synthetic_segments(samples, segment_size)
+    model.fit(x, y, epochs=1, batch_size=profile.batch_size, verbose=0)
+    start = time.perf_counter()
+    model.fit(x, y, epochs=epochs, batch_size=profile.batch_size, verbose=0)
+    train = samples * epochs / (time.perf_counter() - start)
+    model.predict(x, batch_size=profile.batch_size, verbose=0)
+    start = time.perf_counter()
+    model.predict(x, batch_size=profile.batch_size, verbose=0)
+    predict = samples / (time.perf_counter() - start)
+    return train, predict
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--models', type=int, nargs='+', default=[1, 2, 3, 4], help='model versions')
+    parser.add_argument('--segment-sizes', type=int, nargs='+', default=[4, 7, 10], help='segment sizes')
+    parser.add_argument('--profiles', nargs='+', choices=sorted(PROFILES), default=sorted(PROFILES),
+                        help='performance profiles to compare')
+    parser.add_argument('--batch-size', type=int, help="batch size, overriding the profiles'")
+    parser.add_argument('--lr-scaling', choices=LR_SCALINGS,
+                        help="learning rate scaling with the batch size, overriding the profiles'")
+    parser.add_argument('--samples', type=int, default=32768, help='synthetic segments per measurement')
+    parser.add_argument('--epochs', type=int, default=2, help='timed training epochs, after a warm-up epoch')
+    args = parser.parse_args()
+
+    print('{:>5} {:>8} {:>8} {:>14} {:>16}'.format('model', 'segment', 'profile', 'train (smp/s)',
+                                                  'predict (smp/s)'))
+    for version in args.models:
+        for segment_size in args.segment_sizes:
+            for profile_name in args.profiles:
+                train, predict = benchmark_model(version, segment_size, profile_name, args.samples, args.epochs,
+                                                 args.batch_size, args.lr_scaling)
+                print('{:>5} {:>8} {:>8} {:>14.0f} {:>16.0f}'.format(version, segment_size, profile_name, train,
+                                                                    predict))
@@ -1,71 +1,361 @@
+import contextlib
 import gzip
+import hashlib
+import json
 import logging
 import math
 import os
-import pickle
+import shutil
+import tempfile
 
 import ijson
 import numpy
+from numpy.lib.stride_tricks import sliding_window_view
 from sklearn.model_selection import train_test_split
 
 import utils as utils
 
+CLUMP_FEATURES = 5
+PADDING_CLUMP = (-1, -1, -1, -1, 0)
+LABELS = {'doh': 1, 'ndoh': 0}
+# Part of the cache key: changing any of these invalidates the cached normalized clumps
+NORMALIZATION = {
+    'time_floor': 1e-12, 'time_range': (-12, -2),
+    'size_cap': 1e4, 'size_range': (0.5, 4),
+    'packets_cap': 256, 'packets_range': (0, 8),
+}
+CACHE_VERSION = 1
+INDEX_CHUNK = 1 << 16  # clump rows converted at a time when building a flow index
 
-def create_segments(clumps_list, segment_size):
-    """ Normalizes clump features and creates overlapping segments. """
-    clumps_list2 = []
+
+def exact_log(function, values):
+    """ Applies math.log10 or math.log2 to an array, once per distinct value. NumPy's vectorized
+        logarithms can differ from the C library in the last bit, which would change the segments. """
+    distinct, inverse = numpy.unique(values, return_inverse=True)
+    return numpy.array([function(v) for v in distinct.tolist()], dtype=numpy.float64)[inverse].reshape(values.shape)
+
+
+def normalize_clumps(clumps):
+    """ Normalizes an array of clump rows, all at once. """
+    clumps = numpy.asarray(clumps, dtype=numpy.float64).reshape(-1, CLUMP_FEATURES)
+    normalized = numpy.empty_like(clumps)
     # Inter-arrival, Duration, Size, Packets, Direction
-    for c in clumps_list:
-        c2 = [
-            utils.normalize(math.log10(max(1e-12, c[0])), data_min=-12, data_max=-2),
-            utils.normalize(math.log10(max(1e-12, c[1])), data_min=-12, data_max=-2),
-            utils.normalize(math.log10(min(1e4, c[2])), data_min=0.5, data_max=4),
-            utils.normalize(math.log2(min(256, c[3])), data_min=0, data_max=8),
-            c[4]
-        ]
-        clumps_list2.append(c2)
-    while len(clumps_list2) < segment_size:
-        clumps_list2.append([-1, -1, -1, -1, 0])
-    return utils.nwise(clumps_list2, segment_size)
-
-
-def load_json(path, label, segment_size, shuffle=True, max_count=0):
-    """ Loads JSON data from a file, creates segments, and returns them with labels. """
-    logging.info('Loading {} .'.format(path))
+    normalized[:, 0:2] = utils.normalize(exact_log(math.log10, numpy.maximum(NORMALIZATION['time_floor'],
+                                                                             clumps[:, 0:2])),
+                                         *NORMALIZATION['time_range'])
+    normalized[:, 2] = utils.normalize(exact_log(math.log10, numpy.minimum(NORMALIZATION['size_cap'], clumps[:, 2])),
+                                       *NORMALIZATION['size_range'])
+    normalized[:, 3] = utils.normalize(exact_log(math.log2, numpy.minimum(NORMALIZATION['packets_cap'],
+                                                                          clumps[:, 3])),
+                                       *NORMALIZATION['packets_range'])
+    normalized[:, 4] = clumps[:, 4]
+    return normalized
+
+
+def window_view(data, segment_size):
+    """ Returns every window of segment_size consecutive rows of data, as a read-only strided view. """
+    return sliding_window_view(data, (segment_size, CLUMP_FEATURES))[:, 0]
+
+
+def pad_flow(normalized, segment_size):
+    """ Pads the normalized clumps of a flow shorter than a segment with padding clumps. """
+    missing = segment_size - len(normalized)
+    if missing > 0:
+        normalized = numpy.concatenate((normalized, numpy.tile(PADDING_CLUMP, (missing, 1))))
+    return normalized
+
+
+def create_segments(clumps_list, segment_size):
+    """ Normalizes clump features and creates overlapping segments, padding short flows. """
+    return window_view(pad_flow(normalize_clumps(clumps_list), segment_size), segment_size)
+
+
+def segment_counts(offsets, segment_size):
+    """ Number of segments of every flow. """
+    return numpy.maximum(numpy.diff(offsets) - segment_size + 1, 1)
+
+
+def segment_clumps(normalized, offsets, segment_size):
+    """ Lays out the normalized clumps of every flow (flow i being normalized[offsets[i]:offsets[i + 1]])
+        in a single array and returns it with the start of each of their segments, in flow order.
+        Flows shorter than a segment get a padded copy after the other rows. """
+    offsets = numpy.asarray(offsets, dtype=numpy.int64)
+    lengths = numpy.diff(offsets)
+    short = lengths < segment_size
+    counts = numpy.where(short, 1, lengths - segment_size + 1)
+
+    # Padded copies of the short flows, one segment each
+    short_lengths = lengths[short]
+    padded = numpy.tile(numpy.array(PADDING_CLUMP, dtype=numpy.float64), (len(short_lengths) * segment_size, 1))
+    within = numpy.arange(short_lengths.sum()) - numpy.repeat(numpy.cumsum(short_lengths) - short_lengths,
+                                                              short_lengths)
+    blocks = numpy.repeat(numpy.arange(len(short_lengths)) * segment_size, short_lengths)
+    padded[blocks + within] = normalized[numpy.repeat(offsets[:-1][short], short_lengths) + within]
+    data = numpy.concatenate((normalized, padded))
+
+    bases = offsets[:-1].copy()
+    bases[short] = len(normalized) + numpy.arange(len(short_lengths)) * segment_size
+    starts = numpy.repeat(bases, counts) + numpy.arange(counts.sum()) - numpy.repeat(numpy.cumsum(counts) - counts,
+                                                                                     counts)
+    return data, starts
+
+
+def load_clumps(path, segment_size, max_count=0):
+    """ Returns the raw clump rows and flow offsets of a file or directory, stopping after the flow
+        whose segments take the count over max_count (when positive). Clump arrays are memory mapped. """
+    if path.endswith('.clumps.npy'):
+        rows, offsets = load_clump_arrays(path)
+        offsets = cut_offsets(offsets, segment_size, max_count)
+        return rows[:offsets[-1]], offsets
+
+    rows = []
+    offsets = [0]
+    count = 0
+    for flow in read_sequences(path):
+        if 0 < max_count < count:
+            break
+        rows.extend(flow)
+        offsets.append(len(rows))
+        count += max(len(flow) - segment_size + 1, 1)
+    return numpy.array(rows, dtype=numpy.float64).reshape(-1, CLUMP_FEATURES), numpy.array(offsets)
+
+
+def cut_offsets(offsets, segment_size, max_count):
+    """ Keeps the flows up to the one whose segments take the count over max_count (when positive). """
+    if max_count <= 0:
+        return offsets
+    counts = segment_counts(offsets, segment_size)
+    flows = numpy.searchsorted(numpy.cumsum(counts), max_count, side='right') + 1
+    return offsets[:flows + 1]
+
+
+def sample_flows(offsets, segment_size, target, rng=numpy.random):
+    """ Picks random flows until their segments reach target and returns them in file order. """
+    counts = segment_counts(offsets, segment_size)
+    order = rng.permutation(len(counts))
+    taken = numpy.searchsorted(numpy.cumsum(counts[order]), target) + 1
+    return numpy.sort(order[:taken])
+
+
+def gather_flows(rows, offsets, flows):
+    """ Returns the rows and offsets of the given flows only, reading nothing else from memory mapped rows. """
+    offsets = numpy.asarray(offsets)
+    starts = offsets[flows]
+    lengths = offsets[flows + 1] - starts
+    gathered = numpy.concatenate(([0], numpy.cumsum(lengths))).astype(numpy.int64)
+    index = numpy.repeat(starts - gathered[:-1], lengths) + numpy.arange(gathered[-1])
+    return rows[index], gathered
+
+
+@contextlib.contextmanager
+def flow_index(path, use_cache=True):
+    """ Provides the raw clump rows and flow offsets of a source, memory mapped so that any flow can be read
+        without scanning the file. Clump arrays are used as they are; other sources are converted once,
+        in float64 to keep the normalization exact, into cache/index-<key> next to them, or without
+        use_cache into a temporary directory removed when the context exits. """
+    if path.endswith('.clumps.npy'):
+        yield load_clump_arrays(path)
+        return
+    if not use_cache:
+        index_dir = tempfile.mkdtemp(prefix='index-')
+        try:
+            build_index(path, index_dir)
+            yield open_index(index_dir)
+        finally:
+            shutil.rmtree(index_dir, ignore_errors=True)
+        return
+    key = hashlib.sha1(json.dumps({'version': CACHE_VERSION, 'name': os.path.basename(os.path.abspath(path)),
+                                   'source': fingerprint(path)}).encode()).hexdigest()
+    index_dir = os.path.join(os.path.dirname(os.path.abspath(path)), 'cache', 'index-' + key)
+    if not os.path.isdir(index_dir):
+        temporary = '{}.tmp{}'.format(index_dir, os.getpid())
+        shutil.rmtree(temporary, ignore_errors=True)
+        os.makedirs(temporary)
+        build_index(path, temporary)
+        publish_directory(temporary, index_dir)
+    yield open_index(index_dir)
 
-    if path.endswith('gz'):
-        json_file = gzip.open(path, 'r')
+
+def build_index(path, index_dir):
+    """ Writes the clump rows of a source as raw float64 to index_dir/clumps.f8, and its flow offsets. """
+    logging.info('Indexing {}'.format(path))
+    offsets = [0]
+    with open(os.path.join(index_dir, 'clumps.f8'), 'wb') as raw:
+        chunk = []
+        for flow in read_sequences(path):
+            chunk.extend(flow)
+            offsets.append(offsets[-1] + len(flow))
+            if len(chunk) >= INDEX_CHUNK:
+                numpy.array(chunk, dtype=numpy.float64).tofile(raw)
+                chunk = []
+        numpy.array(chunk, dtype=numpy.float64).tofile(raw)
+    numpy.save(os.path.join(index_dir, 'offsets.npy'), numpy.array(offsets, dtype=numpy.int64))
+
+
+def open_index(index_dir):
+    offsets = numpy.load(os.path.join(index_dir, 'offsets.npy'), mmap_mode='r')
+    if offsets[-1] == 0:
+        return numpy.empty((0, CLUMP_FEATURES)), offsets
+    rows = numpy.memmap(os.path.join(index_dir, 'clumps.f8'), dtype=numpy.float64, mode='r',
+                        shape=(int(offsets[-1]), CLUMP_FEATURES))
+    return rows, offsets
+
+
+def load_clump_arrays(path):
+    """ Memory maps a <name>.clumps.npy float32 (rows, 5) array and its <name>.offsets.npy:
+        sequence i is rows[offsets[i]:offsets[i + 1]]. """
+    rows = numpy.load(path, mmap_mode='r')
+    offsets = numpy.load(path[:-len('.clumps.npy')] + '.offsets.npy', mmap_mode='r')
+    return rows, offsets
+
+
+def read_sequences(path):
+    """ Yields the clump sequences of a JSON array file, of a JSON Lines file (one sequence per line),
+        of clump arrays or of a directory of JSON Lines shards or clump arrays as written by the
+        extractor, gzip compressed or not. """
+    if os.path.isdir(path):
+        for name in sorted(os.listdir(path)):
+            if not name.endswith('.offsets.npy'):
+                yield from read_sequences(os.path.join(path, name))
+        return
+    if path.endswith('.clumps.npy'):
+        rows, offsets = load_clump_arrays(path)
+        for start, end in zip(offsets[:-1], offsets[1:]):
+            yield rows[start:end].tolist()
+        return
+    with (gzip.open(path, 'rb') if path.endswith('gz') else open(path, 'rb')) as json_file:
+        if '.jsonl' in path:
+            for line in json_file:
+                if line.strip():
+                    yield json.loads(line)
+        else:
+            yield from ijson.items(json_file, 'item')
+
+
+def label_path(dir_path, label):
+    """ Returns where the sequences of a label are in dir_path: an aggregated <label>.json.gz,
+        merged <label>.clumps.npy arrays or <label>.jsonl.gz / <label>.jsonl, or the <label>
+        directory of a sequence mode run. """
+    for name in ('{}.json.gz', '{}.clumps.npy', '{}.jsonl.gz', '{}.jsonl', '{}'):
+        path = os.path.join(dir_path, name.format(label))
+        if os.path.exists(path):
+            return path
+    raise FileNotFoundError('No {} sequences in {}'.format(label, dir_path))
+
+
+def load_json(path, label, segment_size, shuffle=True, max_count=0, sample=False, rng=numpy.random,
+              use_cache=True):
+    """ Loads JSON data from a file, creates segments, and returns them with labels.
+        With sample, the max_count segments come from random flows read through the flow index
+        (kept in the cache with use_cache), rather than from the flows at the head of the file. """
+    logging.info('Loading {} .'.format(path))
+    if sample and max_count > 0:
+        with flow_index(path, use_cache) as (rows, offsets):
+            # gather_flows copies the flows out of the index
+            rows, offsets = gather_flows(rows, offsets, sample_flows(offsets, segment_size, max_count, rng))
     else:
-        json_file = open(path, 'r')
+        rows, offsets = load_clumps(path, segment_size, max_count)
     logging.info('Loading {} ..'.format(path))
-    items = ijson.items(json_file, 'item')
-    segments = []
+    return label_segments(normalize_clumps(rows), offsets, label, segment_size, shuffle, rng=rng)
 
-    for flow in items:
-        if 0 < max_count < len(segments):
-            break
-        segments.extend(create_segments(flow, segment_size))
-    logging.info('Loading {} ...'.format(path))
+
+def label_segments(normalized, offsets, label, segment_size, shuffle=True, max_count=0, rng=numpy.random,
+                   sample=False):
+    """ Creates the segments of normalized flows, shuffled with rng, and returns them with labels.
+        max_count keeps the flows at the head, or random flows with sample, up to that many segments. """
+    if sample and max_count > 0:
+        normalized, offsets = gather_flows(normalized, offsets, sample_flows(offsets, segment_size, max_count, rng))
+    else:
+        offsets = cut_offsets(offsets, segment_size, max_count)
+    data, starts = segment_clumps(normalized[:offsets[-1]], offsets, segment_size)
+    logging.info('Segmenting {} flows'.format(len(offsets) - 1))
 
     if shuffle:
-        numpy.random.shuffle(segments)
-    return numpy.array(segments), numpy.full(len(segments), label)
+        rng.shuffle(starts)
+    # The segments are only copied out of the single array here, once
+    segments = window_view(data, segment_size)[starts] if len(starts) else numpy.empty((0, segment_size,
+                                                                                        CLUMP_FEATURES))
+    return segments, numpy.full(len(starts), label)
 
 
-def load_dataset(dir_path, segment_size, use_cache=True):
-    """ loads and processes datasets from a directory, optionally using a cache. """
-    cache_path = os.path.join(dir_path, 'cache-{}'.format(segment_size))
-    if use_cache and os.path.exists(cache_path):
+def publish_directory(temporary, target):
+    """ Renames a directory written aside into place. If another process published the same one first,
+        its copy is kept and this one is dropped. """
+    try:
+        os.replace(temporary, target)
+    except OSError:
+        if not os.path.isdir(target):
+            raise
+        shutil.rmtree(temporary)
+
+
+def fingerprint(path):
+    """ Name, size and modification time of a file, or of every file of a directory. """
+    if os.path.isdir(path):
+        files = sorted(os.path.join(root, name) for root, _, names in os.walk(path) for name in names)
+        base = path
+    else:
+        files = [path]
+        base = os.path.dirname(path)
+    return [[os.path.relpath(f, base), os.stat(f).st_size, os.stat(f).st_mtime_ns] for f in files]
+
+
+def cache_key(sources):
+    """ Digest of the input files of every label and of the normalization parameters. """
+    description = {
+        'version': CACHE_VERSION,
+        'normalization': NORMALIZATION,
+        'sources': {label: fingerprint(path) for label, path in sources.items()},
+    }
+    return hashlib.sha1(json.dumps(description, sort_keys=True).encode()).hexdigest()
+
+
+def load_normalized(dir_path, use_cache=True):
+    """ Returns the normalized clumps and flow offsets of every label of a directory. They are parsed
+        and normalized only once: later calls memory map them from dir_path/cache/<key>, until the
+        input files or the normalization change. """
+    sources = {label: label_path(dir_path, label) for label in LABELS}
+    cache_dir = os.path.join(dir_path, 'cache', cache_key(sources))
+    if use_cache and os.path.isdir(cache_dir):
         print('Using cached version')
-        return pickle.load(open(cache_path, 'rb'))
+        return {label: (numpy.load(os.path.join(cache_dir, '{}.normalized.npy'.format(label)), mmap_mode='r'),
+                        numpy.load(os.path.join(cache_dir, '{}.offsets.npy'.format(label)), mmap_mode='r'))
+                for label in LABELS}
+
+    clumps = {}
+    for label, path in sources.items():
+        logging.info('Loading {}'.format(path))
+        rows, offsets = load_clumps(path, 1)
+        clumps[label] = normalize_clumps(rows), offsets
 
-    doh_dataset = load_json(os.path.join(dir_path, 'doh.json.gz'), 1, segment_size)
-    ndoh_dataset = load_json(os.path.join(dir_path, 'ndoh.json.gz'), 0, segment_size, max_count=len(doh_dataset[0]))
+    if use_cache:
+        # Written aside and renamed, so an interrupted run never leaves a partial cache behind
+        temporary = '{}.tmp{}'.format(cache_dir, os.getpid())
+        shutil.rmtree(temporary, ignore_errors=True)
+        os.makedirs(temporary)
+        for label, (normalized, offsets) in clumps.items():
+            numpy.save(os.path.join(temporary, '{}.normalized.npy'.format(label)), normalized)
+            numpy.save(os.path.join(temporary, '{}.offsets.npy'.format(label)), offsets)
+        publish_directory(temporary, cache_dir)
+    return clumps
+
+
+def load_dataset(dir_path, segment_size, use_cache=True, seed=None, sample=False):
+    """ Loads the segments of a directory and splits them into train and test sets. Any segment size
+        is derived from the same cached clumps. With a seed, the shuffles and the split are reproducible.
+        With sample, the ndoh segments matching the doh count come from random flows instead of the
+        first ones. """
+    rng = numpy.random if seed is None else numpy.random.RandomState(seed)
+    if use_cache:
+        clumps = load_normalized(dir_path)
+        doh_dataset = label_segments(*clumps['doh'], LABELS['doh'], segment_size, rng=rng)
+        ndoh_dataset = label_segments(*clumps['ndoh'], LABELS['ndoh'], segment_size,
+                                      max_count=len(doh_dataset[0]), rng=rng, sample=sample)
+    else:
+        doh_dataset = load_json(label_path(dir_path, 'doh'), LABELS['doh'], segment_size, rng=rng)
+        ndoh_dataset = load_json(label_path(dir_path, 'ndoh'), LABELS['ndoh'], segment_size,
+                                 max_count=len(doh_dataset[0]), sample=sample, rng=rng, use_cache=False)
     logging.info('Combining datasets')
     main_dataset = utils.combine(doh_dataset, ndoh_dataset)
     logging.info('Splitting test/train')
-    dataset_tuple = train_test_split(*main_dataset)
-
-    if use_cache:
-        pickle.dump(dataset_tuple, open(cache_path, 'wb'))
-    return dataset_tuple
+    return train_test_split(*main_dataset, random_state=seed)
@@ -0,0 +1,122 @@
+import argparse
+import json
+import subprocess
+import sys
+import time
+
+import keras
+import numpy
+
+from runtime import BUNDLE_VERSION, load_bundle
+
+TOLERANCE = 1e-5
+
+
+def layer_spec(layer) -> dict:
+    """ Describes a layer for the NumPy runtime, refusing the options it does not implement. """
+    config = layer.get_config()
+    kind = type(layer).__name__
+    spec = {'type': kind}
+    if kind in ('Dense', 'Activation'):
+        spec['activation'] = config['activation']
+    elif kind == 'LSTM':
+        if config['return_sequences'] or config['go_backwards'] or config['stateful'] or not config['use_bias']:
+            raise ValueError('unsupported LSTM configuration: {}'.format(layer.name))
+        spec['activation'] = config['activation']
+        spec['recurrent_activation'] = config['recurrent_activation']
+    elif kind == 'Conv1D':
+        if config['padding'] != 'valid' or config['strides'] != (1,) or config['dilation_rate'] != (1,):
+            raise ValueError('unsupported Conv1D configuration: {}'.format(layer.name))
+        spec['activation'] = config['activation']
+    elif kind == 'MaxPooling1D':
+        if config['padding'] != 'valid' or config['strides'] != config['pool_size']:
+            raise ValueError('unsupported MaxPooling1D configuration: {}'.format(layer.name))
+        spec['pool_size'] = config['pool_size'][0]
+    elif kind != 'Flatten':
+        raise ValueError('unsupported layer: {} ({})'.format(layer.name, kind))
+    if spec.get('activation', 'linear') not in ('relu', 'sigmoid', 'tanh', 'linear'):
+        raise ValueError('unsupported activation: {}'.format(spec['activation']))
+    return spec
+
+
+def export_model(model, path) -> None:
+    """ Writes a Sequential model as a .npz bundle: its float32 weights and a JSON description of its layers. """
+    layers = []
+    arrays = {}
+    for layer in model.layers:
+        if type(layer).__name__ == 'Dropout':
+            continue
+        spec = layer_spec(layer)
+        weights = layer.get_weights()
+        for i, weight in enumerate(weights):
+            arrays['{}.{}'.format(len(layers), i)] = weight.astype(numpy.float32)
+        spec['weight_count'] = len(weights)
+        layers.append(spec)
+    spec = {'version': BUNDLE_VERSION, 'input_shape': list(model.input_shape), 'layers': layers}
+    with open(path, 'wb') as f:  # numpy.savez would add .npz to other file names
+        numpy.savez(f, spec=numpy.array(json.dumps(spec)), **arrays)
+
+
+def verify(model, bundle, samples=4096, seed=0) -> float:
+    """ Returns the largest difference between the Keras and bundle predictions on random segments,
+        drawn from the [-1, 1] range of the normalized clumps. """
+    x = numpy.random.default_rng(seed).uniform(-1, 1, (samples,) + tuple(model.input_shape[1:])).astype(numpy.float32)
+    return float(numpy.abs(model.predict(x, batch_size=1024, verbose=0) - bundle.predict(x)).max())
+
+
+def cold_start(statement) -> float:
+    """ Seconds for a new interpreter to run `statement`, imports included. """
+    start = time.perf_counter()
+    subprocess.run([sys.executable, '-c', statement], check=True, stderr=subprocess.DEVNULL)
+    return time.perf_counter() - start
+
+
+def batch_latency(predict, x, repeat=50) -> float:
+    """ Median seconds of a predict call on x, after a warm-up call. """
+    predict(x)
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        predict(x)
+        times.append(time.perf_counter() - start)
+    return float(numpy.median(times))
+
+
+def benchmark(model_path, bundle_path, model, bundle, batch_sizes):
+    segment = 'numpy.zeros((1,) + tuple(model.input_shape[1:]), dtype=numpy.float32)'
+    keras_start = cold_start('import numpy, keras; model = keras.models.load_model({!r}); '
+                             'model.predict_on_batch({})'.format(model_path, segment))
+    bundle_start = cold_start('import sys, numpy; sys.path.insert(0, {!r}); import runtime; '
+                              'model = runtime.load_bundle({!r}); model.predict_on_batch({})'
+                              .format(sys.path[0], bundle_path, segment))
+    print('cold start (s): keras {:.3f}, numpy {:.3f}'.format(keras_start, bundle_start))
+    print('{:>6} {:>12} {:>12}'.format('batch', 'keras (ms)', 'numpy (ms)'))
+    rng = numpy.random.default_rng(0)
+    for batch_size in batch_sizes:
+        x = rng.uniform(-1, 1, (batch_size,) + tuple(model.input_shape[1:])).astype(numpy.float32)
+        print('{:>6} {:>12.3f} {:>12.3f}'.format(batch_size, batch_latency(model.predict_on_batch, x) * 1000,
+                                                 batch_latency(bundle.predict_on_batch, x) * 1000))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='exports a trained model to a NumPy-only bundle (see runtime.py)')
+    parser.add_argument('model', help='trained model, see main.py --save-models')
+    parser.add_argument('output', help='bundle file (.npz)')
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE,
+                        help='largest difference allowed from the Keras predictions (default: {:g}, '
+                             'bfloat16 models need about 1e-2)'.format(TOLERANCE))
+    parser.add_argument('--benchmark', action='store_true',
+                        help='compare the cold start and per-batch latency of Keras and the bundle')
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 32, 256, 1024],
+                        help='batch sizes of the latency benchmark')
+    args = parser.parse_args()
+
+    model = keras.models.load_model(args.model)
+    export_model(model, args.output)
+    bundle = load_bundle(args.output)
+    difference = verify(model, bundle)
+    print('largest difference from Keras: {:.3g}'.format(difference))
+    if difference > args.tolerance:
+        sys.exit('the bundle does not match the model')
+    if args.benchmark:
+        benchmark(args.model, args.output, model, bundle, args.batch_sizes)
@@ -0,0 +1,66 @@
+import hashlib
+import json
+import multiprocessing
+import os
+
+
+def grid_jobs(models, segment_sizes, repeats, seed=0, run_options=None):
+    """ Returns the jobs of an experiment grid, one per model version, segment size and repeat.
+        Each repeat has its own seed, and the job id names the job in the results log. The id ends
+        with a hash of `run_options`, the options the results depend on, so that a results log is
+        only resumed by a run with the same options. """
+    suffix = '' if run_options is None else '-' + options_hash(run_options)
+    return [{'job': 'v{}-s{}-r{}{}'.format(model, segment_size, seed + repeat, suffix),
+             'model': model, 'segment_size': segment_size, 'seed': seed + repeat}
+            for segment_size in segment_sizes for model in models for repeat in range(repeats)]
+
+
+def options_hash(run_options) -> str:
+    """ Returns a short hash of a dict of JSON-serializable options. """
+    return hashlib.sha1(json.dumps(run_options, sort_keys=True).encode()).hexdigest()[:8]
+
+
+def read_results(results_path) -> list:
+    """ Returns the results recorded in a results log. A line cut short by a crash is ignored. """
+    results = []
+    if os.path.exists(results_path):
+        with open(results_path) as f:
+            for line in f:
+                try:
+                    results.append(json.loads(line))
+                except ValueError:
+                    continue
+    return results
+
+
+def run_grid(jobs, run_job, results_path, workers=1, threads=0) -> list:
+    """ Runs the jobs that are not in the results log yet with a pool of `workers` processes, each
+        limited to `threads` TensorFlow threads (0 lets TensorFlow decide). run_job takes a job and
+        returns its result, which is appended to the log as soon as it finishes. Every job runs in a
+        fresh process, so models and TensorFlow state never pile up. Returns all the logged results. """
+    completed = {result['job'] for result in read_results(results_path)}
+    pending = [job for job in jobs if job['job'] not in completed]
+    print('Jobs: {}, already completed: {}'.format(len(jobs), len(jobs) - len(pending)))
+
+    if pending:
+        # TensorFlow does not survive a fork once initialized
+        context = multiprocessing.get_context('spawn')
+        with open(results_path, 'a') as log, \
+                context.Pool(workers, _init_worker, (threads,), maxtasksperchild=1) as pool:
+            for done, result in enumerate(pool.imap_unordered(run_job, pending), 1):
+                log.write(json.dumps(result) + '\n')
+                log.flush()
+                os.fsync(log.fileno())
+                print('[{}/{}] {}: {:.1f}s, {} epochs, {:.0f} samples/s'.format(
+                    done, len(pending), result['job'], result['train_time'], result['epochs'],
+                    result['samples_per_second']))
+    return read_results(results_path)
+
+
+def _init_worker(threads):
+    """ Applies the thread budget before TensorFlow creates its thread pools. """
+    if threads > 0:
+        os.environ['OMP_NUM_THREADS'] = str(threads)
+        import tensorflow as tf
+        tf.config.threading.set_intra_op_parallelism_threads(threads)
+        tf.config.threading.set_inter_op_parallelism_threads(threads)
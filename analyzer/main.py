@@ -1,28 +1,73 @@
-
 import argparse
+import functools
 import json
 import logging
+import os
+import time
 
+import keras
 from sklearn.metrics import classification_report, confusion_matrix
-from keras.callbacks import EarlyStopping
+from keras.callbacks import Callback, EarlyStopping
 
 import dataset as dataset
-from models import create_model
+import grid as grid
+import pipeline as pipeline
+from models import LR_SCALINGS, PROFILES, create_model
+
+
+class BatchCounter(Callback):
+    """ Counts the training batches, the only measure of the samples seen when streaming. """
+
+    def __init__(self):
+        super().__init__()
+        self.batches = 0
+
+    def on_train_batch_end(self, batch, logs=None):
+        self.batches += 1
 
 
-def run_model(version, segment_size):
-    model = create_model(version, segment_size)
+def run_model(job, options):
+    """ Trains and evaluates one model of the grid and returns its results, with the training time,
+        epochs and throughput. """
+    version, segment_size, seed = job['model'], job['segment_size'], job['seed']
+    keras.utils.set_random_seed(seed)
+    profile = PROFILES[options['profile']].override(options['batch_size'], options['lr_scaling'])
+    model = create_model(version, segment_size, profile)
     print(model.summary())
     es = EarlyStopping()
-    model.fit(x_train, y_train, epochs=100, validation_data=(x_test, y_test), callbacks=[es],
-              batch_size=32)
-    y_pred = model.predict(x_test, verbose=1)
+    counter = BatchCounter()
+    if options['streaming']:
+        train_data, test_data = pipeline.load_datasets(options['input'], segment_size, batch_size=profile.batch_size,
+                                                       shuffle_buffer=options['shuffle_buffer'], seed=seed,
+                                                       use_cache=options['use_cache'])
+        start = time.perf_counter()
+        history = model.fit(train_data, epochs=100, validation_data=test_data, callbacks=[es, counter])
+        train_time = time.perf_counter() - start
+        y_test, y_pred = pipeline.predict(model, test_data)
+    else:
+        x_train, x_test, y_train, y_test = dataset.load_dataset(options['input'], segment_size, options['use_cache'],
+                                                                seed, options['sample'])
+        start = time.perf_counter()
+        history = model.fit(x_train, y_train, epochs=100, validation_data=(x_test, y_test), callbacks=[es, counter],
+                            batch_size=profile.batch_size)
+        train_time = time.perf_counter() - start
+        y_pred = model.predict(x_test, batch_size=profile.batch_size, verbose=1)
+    if options['save_models']:
+        # Loaded by realtime.py to classify live traffic
+        model.save(os.path.join(options['save_models'], job['job'] + '.h5'))
     y_pred_bool = list(map(lambda y: 1 if y > 0.5 else 0, y_pred))
 
-    return (
-        classification_report(y_test, y_pred_bool, digits=5, output_dict=True),
-        confusion_matrix(y_test, y_pred_bool).tolist()
-    )
+    return dict(job, **{
+        'profile': options['profile'],
+        'batch_size': profile.batch_size,
+        'learning_rate': profile.learning_rate(),
+        'report': classification_report(y_test, y_pred_bool, digits=5, output_dict=True),
+        'confusion_matrix': confusion_matrix(y_test, y_pred_bool).tolist(),
+        'train_time': train_time,
+        'epochs': len(history.epoch),
+        # Includes the validation passes, which are part of the training time
+        'samples_per_second': counter.batches * profile.batch_size / train_time,
+    })
 
 
 if __name__ == '__main__':
@@ -36,24 +81,66 @@ if __name__ == '__main__':
                         default='./sample_data')
     parser.add_argument('--output', help='output file',
                         default='./sample_data/output.json')
+    parser.add_argument('--results', default='./sample_data/results.jsonl',
+                        help='append-only log of the finished jobs; jobs completed with the same options are skipped on '
+                             'restart')
+    parser.add_argument('--models', type=int, nargs='+', default=[1, 2, 3, 4], help='model versions')
+    parser.add_argument('--segment-sizes', type=int, nargs='+', default=list(range(4, 11)), help='segment sizes')
+    parser.add_argument('--repeats', type=int, default=3, help='trainings per model and segment size')
+    parser.add_argument('--workers', type=int, default=1, help='jobs trained in parallel')
+    parser.add_argument('--threads', type=int, default=0,
+                        help='TensorFlow threads per job (default: 0, all the cores)')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='seed of the first repeat, the next repeats use the following seeds')
+    parser.add_argument('--no-cache', action='store_false', dest='use_cache',
+                        help='parse and normalize the clumps again instead of using the cache')
+    parser.add_argument('--sample', action='store_true',
+                        help='balance the classes with random ndoh flows instead of the first ones')
+    parser.add_argument('--streaming', action='store_true',
+                        help='stream the segments with tf.data instead of loading them all in memory; '
+                             'the classes are balanced by sampling and the train/test split is per flow')
+    parser.add_argument('--shuffle-buffer', type=int, default=10000,
+                        help='segments held in the shuffle buffer when streaming (default: 10000)')
+    parser.add_argument('--profile', choices=sorted(PROFILES), default='default',
+                        help='how the models are compiled and trained: "fast" adds XLA and batches of 1024 '
+                             '(with a scaled learning rate), "bf16" also trains in bfloat16 mixed precision '
+                             'where the CPU supports it (default: default, the original settings)')
+    parser.add_argument('--batch-size', type=int,
+                        help="batch size, overriding the profile's; the learning rate is scaled to it")
+    parser.add_argument('--lr-scaling', choices=LR_SCALINGS,
+                        help="how the learning rate follows the batch size, overriding the profile's "
+                             "(all profiles: sqrt)")
+    parser.add_argument('--save-models', metavar='DIR',
+                        help='save every trained model to DIR/<job>.h5, for realtime.py')
     args = parser.parse_args()
 
-    results = []
-
-    for segment_size in range(4, 11):
-
-        x_train, x_test, y_train, y_test = dataset.load_dataset(args.input, segment_size, use_cache=False)
-
-        for model_idx in range(1, 5):
-            for _ in range(3):
-                results.append((run_model(model_idx, segment_size), model_idx, segment_size))
-
+    if args.save_models:
+        os.makedirs(args.save_models, exist_ok=True)
+    if args.use_cache:
+        # Built once here rather than by every job at the same time
+        dataset.load_normalized(args.input)
+
+    # Everything the results depend on: a log is resumed only by a run with the same options
+    profile = PROFILES[args.profile].override(args.batch_size, args.lr_scaling)
+    run_options = dict(vars(profile), input=os.path.abspath(args.input), sample=args.sample, streaming=args.streaming,
+                       shuffle_buffer=args.shuffle_buffer, profile=args.profile)
+    jobs = grid.grid_jobs(args.models, args.segment_sizes, args.repeats, args.seed, run_options)
+    options = {'input': args.input, 'use_cache': args.use_cache, 'sample': args.sample,
+               'streaming': args.streaming, 'shuffle_buffer': args.shuffle_buffer, 'profile': args.profile,
+               'batch_size': args.batch_size, 'lr_scaling': args.lr_scaling, 'save_models': args.save_models}
+    results = grid.run_grid(jobs, functools.partial(run_model, options=options), args.results, args.workers,
+                            args.threads)
+
+    # The grid's results, in grid order, also in the format of the output file
+    job_ids = {job['job']: index for index, job in enumerate(jobs)}
+    results = sorted((r for r in results if r['job'] in job_ids), key=lambda r: job_ids[r['job']])
     output = open(args.output, 'w')
 
-    for res, model_idx, segments in results:
-        print('=' * 20 + ' [SEG={}] Model {} '.format(segments, model_idx) + '=' * 20)
-        print(res[0])
-        print(res[1])
+    for res in results:
+        print('=' * 20 + ' [SEG={}] Model {} '.format(res['segment_size'], res['model']) + '=' * 20)
+        print(res['report'])
+        print(res['confusion_matrix'])
 
-    json.dump(results, output)
+    json.dump([((res['report'], res['confusion_matrix']), res['model'], res['segment_size']) for res in results],
+              output)
     output.close()
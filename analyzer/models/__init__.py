@@ -1,7 +1,75 @@
 import importlib
+import logging
+import math
 
+import keras
+from keras.optimizers import Adam
 
-def create_model(version, segment_size):
-    """ dynamically imports a version-specific model module and creates a model. """
+BASE_BATCH_SIZE = 32
+BASE_LEARNING_RATE = 0.001  # Adam's default, what the models were tuned with at BASE_BATCH_SIZE
+LR_SCALINGS = ('sqrt', 'linear')
+
+
+class PerformanceProfile:
+    """ How a model is compiled and trained: XLA compilation, batch size (the learning rate is scaled
+        from BASE_BATCH_SIZE, by the square root of the ratio or linearly) and bfloat16 mixed precision. """
+
+    def __init__(self, jit_compile=False, batch_size=BASE_BATCH_SIZE, mixed_precision=False, lr_scaling='sqrt'):
+        self.jit_compile = jit_compile
+        self.batch_size = batch_size
+        self.mixed_precision = mixed_precision
+        self.lr_scaling = lr_scaling
+
+    def override(self, batch_size=None, lr_scaling=None) -> 'PerformanceProfile':
+        """ Returns a copy of the profile with another batch size and/or learning rate scaling. """
+        return PerformanceProfile(self.jit_compile, batch_size or self.batch_size, self.mixed_precision,
+                                  lr_scaling or self.lr_scaling)
+
+    def learning_rate(self) -> float:
+        ratio = self.batch_size / BASE_BATCH_SIZE
+        return BASE_LEARNING_RATE * (ratio if self.lr_scaling == 'linear' else math.sqrt(ratio))
+
+
+PROFILES = {
+    'default': PerformanceProfile(),
+    'fast': PerformanceProfile(jit_compile=True, batch_size=1024),
+    'bf16': PerformanceProfile(jit_compile=True, batch_size=1024, mixed_precision=True),
+}
+
+
+def bf16_supported() -> bool:
+    """ Whether the CPU computes in bfloat16 natively (AVX512-BF16 or AMX), otherwise it is emulated
+        and slower than float32. """
+    try:
+        with open('/proc/cpuinfo') as f:
+            flags = f.read()
+    except OSError:
+        return False
+    return 'avx512_bf16' in flags or 'amx_bf16' in flags
+
+
+def create_model(version, segment_size, profile=None):
+    """ dynamically imports a version-specific model module and creates a model.
+        With a profile, the model is built and compiled for it; see PerformanceProfile. In mixed
+        precision, the output layer, its sigmoid included, and so the loss are kept in float32. """
     module = importlib.import_module('.v{}'.format(version), package='models')
-    return module.create_model(segment_size)
+    if profile is None:
+        return module.create_model(segment_size)
+
+    if isinstance(profile, str):
+        profile = PROFILES[profile]
+    mixed_precision = profile.mixed_precision and bf16_supported()
+    if profile.mixed_precision and not mixed_precision:
+        logging.warning('bfloat16 is not supported by this CPU, using float32')
+
+    previous_policy = keras.mixed_precision.global_policy()
+    if mixed_precision:
+        keras.mixed_precision.set_global_policy('mixed_bfloat16')
+    try:
+        model = module.create_model(segment_size, output_dtype='float32' if mixed_precision else None)
+    finally:
+        keras.mixed_precision.set_global_policy(previous_policy)
+
+    model.compile(loss='binary_crossentropy', optimizer=Adam(learning_rate=profile.learning_rate()),
+                  metrics=['accuracy'], jit_compile=profile.jit_compile)
+    return model
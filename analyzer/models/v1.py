@@ -4,12 +4,12 @@ from keras import Sequential
 from keras.layers import Dense, Flatten, Dropout, LSTM
 
 
-def create_model(segment_size):
+def create_model(segment_size, output_dtype=None):
     model = Sequential()
     model.add(LSTM(segment_size * 8, input_shape=(segment_size, 5), activation='relu'))
     model.add(Dense(segment_size * 6, activation='relu'))
     model.add(Dropout(0.2))
     model.add(Dense(segment_size * 2, activation='relu'))
-    model.add(Dense(1, activation='sigmoid'))
+    model.add(Dense(1, activation='sigmoid', dtype=output_dtype))
     model.compile(loss='binary_crossentropy', optimizer='adam', metrics=['accuracy'])
     return model
@@ -2,7 +2,7 @@ from keras import Sequential
 from keras.layers import Dense, Dropout, LSTM, Conv1D, MaxPool1D, Flatten
 
 
-def create_model(segment_size):
+def create_model(segment_size, output_dtype=None):
     model = Sequential()
     model.add(Conv1D(segment_size * 2, kernel_size=3, input_shape=(segment_size, 5), activation='relu'))
     model.add(MaxPool1D())
@@ -10,6 +10,6 @@ def create_model(segment_size):
     model.add(Dense(segment_size * 6, activation='relu'))
     model.add(Dropout(0.2))
     model.add(Dense(segment_size * 2, activation='relu'))
-    model.add(Dense(1, activation='sigmoid'))
+    model.add(Dense(1, activation='sigmoid', dtype=output_dtype))
     model.compile(loss='binary_crossentropy', optimizer='adam', metrics=['accuracy'])
     return model
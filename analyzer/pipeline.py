@@ -0,0 +1,68 @@
+import numpy
+import tensorflow as tf
+
+import dataset as dataset
+
+
+def flow_split(flow_count, test_size, seed):
+    """ Assigns every flow to the train or test set, so that the segments of a flow are never split. """
+    test = numpy.random.RandomState(seed).rand(flow_count) < test_size
+    return numpy.flatnonzero(~test), numpy.flatnonzero(test)
+
+
+def label_stream(normalized, offsets, flows, label, segment_size, keep_rate, seed=None, reshuffle=True):
+    """ Streams the segments of the given flows of a label, windowed on the fly. Flows are read from
+        the (memory mapped) normalized clumps in a random order, and each segment is kept with
+        probability keep_rate, which balances the classes by sampling over the whole file.
+        With reshuffle=False, every pass draws the same flows order and segments. """
+    rng = numpy.random.RandomState(seed)
+
+    def generate():
+        flow_rng = rng if reshuffle else numpy.random.RandomState(seed)
+        for i in flow_rng.permutation(flows):
+            flow = dataset.pad_flow(normalized[offsets[i]:offsets[i + 1]], segment_size)
+            yield flow.astype(numpy.float32), flow_rng.rand(len(flow) - segment_size + 1) < keep_rate
+
+    def windows(flow, keep):
+        segments = tf.signal.frame(flow, segment_size, 1, axis=0)
+        return tf.boolean_mask(segments, keep), tf.fill([tf.reduce_sum(tf.cast(keep, tf.int32))], label)
+
+    stream = tf.data.Dataset.from_generator(generate, output_signature=(
+        tf.TensorSpec(shape=(None, dataset.CLUMP_FEATURES), dtype=tf.float32),
+        tf.TensorSpec(shape=(None,), dtype=tf.bool)))
+    return stream.map(windows, num_parallel_calls=tf.data.AUTOTUNE).unbatch()
+
+
+def load_datasets(dir_path, segment_size, batch_size=32, shuffle_buffer=10000, test_size=0.25, seed=None,
+                  use_cache=True):
+    """ Returns train and test tf.data.Datasets of (segments, labels) batches that never hold more than
+        shuffle_buffer segments in memory. The clumps come from the normalized cache of
+        dataset.load_normalized; the classes are balanced by keeping each segment of the larger class
+        with the probability that brings it to the size of the smaller one, instead of truncating it.
+        The train set is reshuffled every epoch, the test set is the same on every pass. """
+    clumps = dataset.load_normalized(dir_path, use_cache)
+    splits = {label: flow_split(len(offsets) - 1, test_size, seed) for label, (_, offsets) in clumps.items()}
+
+    def balanced(part, reshuffle, part_seed):
+        counts = {label: dataset.segment_counts(offsets, segment_size)[splits[label][part]].sum()
+                  for label, (_, offsets) in clumps.items()}
+        smallest = min(counts.values())
+        streams = [label_stream(normalized, offsets, splits[label][part], dataset.LABELS[label], segment_size,
+                                smallest / max(counts[label], 1), None if part_seed is None else part_seed + i,
+                                reshuffle)
+                   for i, (label, (normalized, offsets)) in enumerate(clumps.items())]
+        return tf.data.Dataset.sample_from_datasets(streams, seed=part_seed)
+
+    train = balanced(0, True, seed).shuffle(shuffle_buffer, seed=seed)
+    test = balanced(1, False, 0 if seed is None else seed + 10)
+    return (train.batch(batch_size).prefetch(tf.data.AUTOTUNE),
+            test.batch(batch_size).prefetch(tf.data.AUTOTUNE))
+
+
+def predict(model, data):
+    """ Returns the labels and predictions of a dataset of batches, from a single pass over it. """
+    labels, predictions = [], []
+    for segments, batch_labels in data:
+        labels.append(batch_labels.numpy())
+        predictions.append(model.predict_on_batch(segments))
+    return numpy.concatenate(labels), numpy.concatenate(predictions)
@@ -0,0 +1,248 @@
+import argparse
+import json
+import logging
+import os
+import socket
+import sys
+import threading
+import time
+from collections import deque
+
+import numpy
+
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(project_root)
+sys.path.append(os.path.join(project_root, 'extractor'))
+
+from dataset import CLUMP_FEATURES, normalize_clumps, pad_flow
+from extractor.flow_session import FlowSession
+from extractor.pcap_stream import read_records
+from runtime import load_bundle
+
+BATCH_SIZE = 256
+INTERVAL = 0.05  # seconds a segment may wait for its micro-batch to fill
+THRESHOLD = 0.5
+
+
+class _FlowState:
+    """ The clumps of a flow being classified: the last segment_size normalized rows and its scores. """
+
+    __slots__ = ('flow_id', 'window', 'rows', 'segments', 'pending', 'score_sum', 'label')
+
+    def __init__(self, flow_id, segment_size):
+        self.flow_id = flow_id
+        self.window = deque(maxlen=segment_size)
+        self.rows = 0
+        self.segments = 0  # scored so far
+        self.pending = 0  # submitted, not scored yet
+        self.score_sum = 0.0
+        self.label = None  # set when the flow ended
+
+
+class StreamClassifier:
+    """ Classifies flows while their clumps are finished. Every window of segment_size consecutive
+        clumps of a flow is a segment, as in training, and a flow that ended with fewer clumps gets one
+        padded segment. Segments of all the flows are scored together by a single predict call once
+        batch_size of them are waiting or the oldest has waited `interval` seconds, on a thread of
+        their own, and a JSON line is written to `output` for every segment with the flow's running
+        verdict, then one for the flow when it ended (with the label of its resolver, "final": true).
+        latency_ms is the time from the last clump of the segment being finished to its verdict. """
+
+    def __init__(self, model, output, batch_size=BATCH_SIZE, interval=INTERVAL, threshold=THRESHOLD):
+        self.model = model
+        self.segment_size = model.input_shape[1]
+        self.output = output
+        self.batch_size = batch_size
+        self.interval = interval
+        self.threshold = threshold
+        self.states = {}
+        self.pending = []  # (state, segment, submission time)
+        self.latencies = []
+        self.batches = 0
+        self.flows = 0
+        self.agreements = 0
+        # Traces the model now rather than on the first batch
+        model.predict_on_batch(numpy.zeros((batch_size, self.segment_size, CLUMP_FEATURES), dtype=numpy.float32))
+        self.condition = threading.Condition()
+        self.closing = False
+        self.thread = threading.Thread(target=self._run, name='classifier', daemon=True)
+        self.thread.start()
+
+    def add_clump(self, flow, row) -> None:
+        """ Adds a finished clump of a flow, submitting the segment it completes. """
+        state = self.states.get(flow)
+        if state is None:
+            state = self.states[flow] = self._new_state(flow)
+        self._add_row(state, row)
+
+    def finish_flow(self, flow, rows, label) -> None:
+        """ Adds the clumps of an ended flow not added yet; its final verdict follows its last segment. """
+        if not rows:
+            return  # No application data to classify
+        state = self.states.pop(flow, None) or self._new_state(flow)
+        for row in rows[state.rows:]:
+            self._add_row(state, row)
+        if state.rows < self.segment_size:
+            self._submit(state, pad_flow(numpy.array(state.window), self.segment_size))
+        with self.condition:
+            state.label = label
+            if not state.pending:
+                self._emit_final(state)
+
+    def close(self) -> None:
+        """ Scores the waiting segments, stops the thread and logs the verdict latencies. """
+        with self.condition:
+            self.closing = True
+            self.condition.notify()
+        self.thread.join()
+        if self.output is not sys.stdout:
+            self.output.close()
+        if self.latencies:
+            latencies = numpy.array(self.latencies) * 1000
+            logging.info('{} segments in {} batches, latency (ms): mean {:.2f}, p50 {:.2f}, p99 {:.2f}, max {:.2f}'
+                         .format(len(latencies), self.batches, latencies.mean(), *numpy.percentile(latencies,
+                                                                                                   [50, 99, 100])))
+        if self.flows:
+            logging.info('{} flows classified, {:.2%} agree with their resolver label'.format(
+                self.flows, self.agreements / self.flows))
+
+    def _new_state(self, flow):
+        flow_id = '{}_{}-{}_{}'.format(flow.src_ip, flow.src_port, flow.dest_ip, flow.dest_port)
+        return _FlowState(flow_id, self.segment_size)
+
+    def _add_row(self, state, row):
+        state.window.append(normalize_clumps(row)[0])
+        state.rows += 1
+        if state.rows >= self.segment_size:
+            self._submit(state, numpy.array(state.window))
+
+    def _submit(self, state, segment):
+        with self.condition:
+            state.pending += 1
+            self.pending.append((state, segment, time.perf_counter()))
+            if len(self.pending) == 1 or len(self.pending) >= self.batch_size:
+                self.condition.notify()
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while not self.closing:
+                    if self.pending:
+                        wait = self.pending[0][2] + self.interval - time.perf_counter()
+                        if len(self.pending) >= self.batch_size or wait <= 0:
+                            break
+                    else:
+                        wait = None
+                    self.condition.wait(wait)
+                if not self.pending:
+                    return  # closing
+                batch = self.pending[:self.batch_size]
+                del self.pending[:self.batch_size]
+            scores = self.model.predict_on_batch(numpy.stack([segment for _, segment, _ in batch])
+                                                 .astype(numpy.float32))
+            with self.condition:
+                self.batches += 1
+                now = time.perf_counter()
+                lines = []
+                for (state, _, submitted), score in zip(batch, scores[:, 0].tolist()):
+                    state.pending -= 1
+                    state.segments += 1
+                    state.score_sum += score
+                    latency = now - submitted
+                    self.latencies.append(latency)
+                    lines.append(self._verdict(state, score=round(score, 5), latency_ms=round(latency * 1000, 3)))
+                    if state.label is not None and not state.pending:
+                        lines.append(self._final(state))
+                self.output.write(''.join(lines))
+                self.output.flush()
+
+    def _verdict(self, state, **fields):
+        flow_score = state.score_sum / state.segments
+        return json.dumps(dict({'flow': state.flow_id, 'time': time.time(), 'segments': state.segments,
+                                'flow_score': round(flow_score, 5), 'doh': flow_score > self.threshold},
+                               **fields)) + '\n'
+
+    def _final(self, state):
+        self.flows += 1
+        self.agreements += (state.score_sum / state.segments > self.threshold) == (state.label == 'doh')
+        return self._verdict(state, label=state.label, final=True)
+
+    def _emit_final(self, state):
+        self.output.write(self._final(state))
+        self.output.flush()
+
+
+def open_output(target):
+    """ Opens the verdict stream: '-' for stdout, unix:<path> for a listening local socket, else a file. """
+    if target == '-':
+        return sys.stdout
+    if target.startswith('unix:'):
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        connection.connect(target[len('unix:'):])
+        return connection.makefile('w')
+    return open(target, 'a')
+
+
+def replay(session, input_file, decoder, speed):
+    """ Feeds a capture to the session as if it were live traffic: at `speed` times the pace of its
+        timestamps, or as fast as possible when 0. """
+    start = first = None
+    for record in read_records(input_file, decoder):
+        if speed > 0:
+            if first is None:
+                start, first = time.perf_counter(), record.time
+            delay = start + (record.time - first) / speed - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        session.on_record_received(record)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(
+        format='%(asctime)s %(levelname)-8s %(message)s',
+        level=logging.INFO,
+        datefmt='%Y-%m-%d %H:%M:%S')
+
+    parser = argparse.ArgumentParser(description='classifies DoH flows live, from their clumps')
+    parser.add_argument('--model', required=True,
+                        help='trained model (see main.py --save-models) or its NumPy bundle (.npz, see export.py), '
+                             'which starts without TensorFlow')
+    input_group = parser.add_mutually_exclusive_group(required=True)
+    input_group.add_argument('-i', '--interface', help='capture traffic from a network interface')
+    input_group.add_argument('-f', '--file', help='replay a capture file in place of an interface')
+    parser.add_argument('--output', default='-',
+                        help="verdict stream: '-' for stdout (default), unix:<path> for a local socket or a file")
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE,
+                        help='segments scored at most per predict call (default: {})'.format(BATCH_SIZE))
+    parser.add_argument('--interval', type=float, default=INTERVAL * 1000,
+                        help='ms a segment may wait for its batch to fill (default: {:g})'.format(INTERVAL * 1000))
+    parser.add_argument('--threshold', type=float, default=THRESHOLD, help='DoH score threshold')
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help='replay speed relative to the capture timestamps, 0 for as fast as possible')
+    parser.add_argument('--decoder', choices=['raw', 'scapy'], default='raw', help='packet decoder for replays')
+    args = parser.parse_args()
+
+    if args.model.endswith('.npz'):
+        model = load_bundle(args.model)
+    else:
+        import keras
+        model = keras.models.load_model(args.model)
+    classifier = StreamClassifier(model, open_output(args.output), args.batch_size, args.interval / 1000,
+                                  args.threshold)
+    session = FlowSession.generate_session_class('inference', None, classifier=classifier)()
+
+    if args.file:
+        replay(session, args.file, args.decoder, args.speed)
+    else:
+        from scapy.all import AsyncSniffer
+        sniffer = AsyncSniffer(iface=args.interface, filter='tcp port 443', prn=session.on_packet_received,
+                               store=False)
+        sniffer.start()
+        try:
+            sniffer.join()
+        except KeyboardInterrupt:
+            sniffer.stop()
+        finally:
+            sniffer.join()
+    # Classifies the flows still open
+    session.close()
@@ -0,0 +1,99 @@
+import json
+
+import numpy
+
+BUNDLE_VERSION = 1
+
+
+def relu(x):
+    return numpy.maximum(x, 0)
+
+
+def sigmoid(x):
+    # The same function as 1 / (1 + exp(-x)), without overflowing and several times faster
+    return numpy.tanh(x * 0.5) * 0.5 + 0.5
+
+
+def linear(x):
+    return x
+
+
+ACTIVATIONS = {'relu': relu, 'sigmoid': sigmoid, 'tanh': numpy.tanh, 'linear': linear}
+
+
+def dense(x, layer):
+    kernel, bias = layer['weights']
+    return ACTIVATIONS[layer['activation']](x @ kernel + bias)
+
+
+def lstm(x, layer):
+    """ Returns the last output of a Keras LSTM, whose gates are ordered input, forget, cell, output. """
+    kernel, recurrent_kernel, bias = layer['weights']
+    activation, recurrent_activation = ACTIVATIONS[layer['activation']], ACTIVATIONS[layer['recurrent_activation']]
+    units = recurrent_kernel.shape[0]
+    inputs = x @ kernel + bias  # every timestep at once
+    h = numpy.zeros((len(x), units), dtype=x.dtype)
+    c = numpy.zeros((len(x), units), dtype=x.dtype)
+    for t in range(x.shape[1]):
+        z = inputs[:, t] + h @ recurrent_kernel
+        i = recurrent_activation(z[:, :units])
+        f = recurrent_activation(z[:, units:2 * units])
+        c = f * c + i * activation(z[:, 2 * units:3 * units])
+        h = recurrent_activation(z[:, 3 * units:]) * activation(c)
+    return h
+
+
+def conv1d(x, layer):
+    """ A valid, stride 1 convolution: the kernel is applied to every window of kernel_size timesteps. """
+    kernel, bias = layer['weights']
+    size = kernel.shape[0]
+    windows = numpy.lib.stride_tricks.sliding_window_view(x, size, axis=1)  # (batch, steps, channels, size)
+    return ACTIVATIONS[layer['activation']](numpy.einsum('bscw,wcf->bsf', windows, kernel) + bias)
+
+
+def max_pool1d(x, layer):
+    pool = layer['pool_size']
+    steps = x.shape[1] // pool
+    return x[:, :steps * pool].reshape(len(x), steps, pool, x.shape[2]).max(axis=2)
+
+
+def flatten(x, layer):
+    return x.reshape(len(x), -1)
+
+
+LAYERS = {'Dense': dense, 'LSTM': lstm, 'Conv1D': conv1d, 'MaxPooling1D': max_pool1d, 'Flatten': flatten,
+          'Activation': lambda x, layer: ACTIVATIONS[layer['activation']](x)}
+
+
+class NumpyModel:
+    """ The forward pass of an exported Sequential model, in NumPy and float32. Dropout layers are not
+        exported, they only apply to training. Has the parts of the Keras model interface used for
+        inference, so it can stand in for one. """
+
+    def __init__(self, layers, input_shape):
+        self.layers = layers
+        self.input_shape = tuple(input_shape)
+
+    def predict_on_batch(self, x):
+        x = numpy.asarray(x, dtype=numpy.float32)
+        for layer in self.layers:
+            x = LAYERS[layer['type']](x, layer)
+        return x
+
+    def predict(self, x, batch_size=1024):
+        x = numpy.asarray(x, dtype=numpy.float32)
+        return numpy.concatenate([self.predict_on_batch(x[i:i + batch_size])
+                                  for i in range(0, max(len(x), 1), batch_size)])
+
+
+def load_bundle(path) -> NumpyModel:
+    """ Loads a model exported by export.py, without TensorFlow. """
+    with numpy.load(path) as bundle:
+        spec = json.loads(str(bundle['spec']))
+        if spec['version'] != BUNDLE_VERSION:
+            raise ValueError('unsupported bundle version {}'.format(spec['version']))
+        layers = []
+        for index, layer in enumerate(spec['layers']):
+            layer['weights'] = [bundle['{}.{}'.format(index, i)] for i in range(layer.pop('weight_count'))]
+            layers.append(layer)
+    return NumpyModel(layers, spec['input_shape'])
@@ -15,4 +15,5 @@ def combine(*args):
 
 
 def normalize(data, data_min, data_max):
-    return min(1, max(-1, (data - data_min) / (data_max - data_min) * 2 - 1))
+    """ Scales data from [data_min, data_max] to [-1, 1], clipping outliers. Works on scalars and arrays. """
+    return numpy.clip((data - data_min) / (data_max - data_min) * 2 - 1, -1, 1)
@@ -0,0 +1,132 @@
+import argparse
+import ipaddress
+import os
+import random
+import sys
+import time
+
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(project_root)
+
+from features.online_statistics import DEFAULT_SKETCH_SIZE
+from resolvers import ResolverList
+from verify import synthetic_flow
+
+
+def timed(function, repeat):
+    """ Returns the result of `function` and its best wall-clock time over `repeat` runs. """
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return result, best
+
+
+def benchmark_flow_features(sizes, repeat):
+    """ Times FlowStatistics against the per-feature classes; verify.py checks the values. """
+    print('{:>8} {:>14} {:>14} {:>8}'.format('packets', 'features (s)', 'vectorized (s)', 'speedup'))
+    for size in sizes:
+        flow = synthetic_flow(size, seed=size)
+        _, legacy_time = timed(flow.get_data_by_feature, repeat)
+        _, engine_time = timed(flow.get_data, repeat)
+        print('{:>8} {:>14.6f} {:>14.6f} {:>7.1f}x'.format(size, legacy_time, engine_time, legacy_time / engine_time))
+
+def benchmark_online_statistics(sizes, repeat, sketch_size):
+    """ Reports the cost and the largest relative error of the online (constant-memory) statistics.
+        Only variances, means and medians are compared: skews of near-symmetric series and modes of
+        continuous times are too ill-conditioned for a relative error to mean anything. """
+    print('{:>8} {:>14} {:>14} {:>14}'.format('packets', 'exact (s)', 'online (s)', 'max rel. error'))
+    for size in sizes:
+        exact_flow = synthetic_flow(size, seed=size)
+        expected, exact_time = timed(exact_flow.get_data, repeat)
+        online_time = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            online_flow = synthetic_flow(size, seed=size, online_statistics=True, sketch_size=sketch_size)
+            actual = online_flow.get_data()
+            elapsed = time.perf_counter() - start
+            online_time = elapsed if online_time is None else min(online_time, elapsed)
+        worst_key, worst = None, 0.0
+        for key, value in expected.items():
+            if 'Skew' in key or not key.endswith(('Variance', 'Mean', 'Median')):
+                continue
+            error = abs(float(actual[key]) - float(value)) / max(abs(float(value)), 1e-12)
+            if error > worst:
+                worst_key, worst = key, error
+        print('{:>8} {:>14.6f} {:>14.6f} {:>14.4f} {}'.format(size, exact_time, online_time, worst, worst_key or ''))
+
+
+def random_resolvers(count, rng):
+    """ Returns `count` random resolver entries: 70% single addresses, the rest networks, a fifth of
+        everything IPv6. """
+    entries = []
+    for _ in range(count):
+        ipv6 = rng.random() < 0.2
+        bits = 128 if ipv6 else 32
+        value = rng.getrandbits(bits)
+        length = bits if rng.random() < 0.7 else rng.randint(8 if ipv6 else 4, bits - 1)
+        network = ipaddress.ip_network((value >> (bits - length) << (bits - length), length))
+        entries.append(str(network.network_address) if length == bits else str(network))
+    return entries
+
+
+def benchmark_resolvers(entries, queries, seed=0):
+    """ Times loading a resolver list and matching addresses against it, checking the matches against
+        ipaddress networks grouped by prefix length, and compares with scanning a list of addresses. """
+    rng = random.Random(seed)
+    resolver_entries = random_resolvers(entries, rng)
+    resolvers, load_time = timed(lambda: ResolverList(resolver_entries), 1)
+
+    # Half of the queries fall in the resolver list
+    addresses = []
+    for _ in range(queries):
+        if rng.random() < 0.5:
+            network = ipaddress.ip_network(rng.choice(resolver_entries))
+            addresses.append(str(network.network_address + rng.randrange(network.num_addresses)))
+        else:
+            addresses.append(str(ipaddress.ip_address(rng.getrandbits(32) if rng.random() < 0.8
+                                                      else rng.getrandbits(128) | (1 << 127))))
+    matches, match_time = timed(lambda: [resolvers.match(a) for a in addresses], 3)
+
+    by_length = {}
+    for entry in resolver_entries:
+        network = ipaddress.ip_network(entry)
+        by_length.setdefault((network.version, network.prefixlen), set()).add(int(network.network_address))
+    mismatches = 0
+    for address, match in zip(addresses, matches):
+        ip = ipaddress.ip_address(address)
+        bits = ip.max_prefixlen
+        expected = max((length for (version, length), networks in by_length.items() if version == ip.version and
+                        int(ip) >> (bits - length) << (bits - length) in networks), default=None)
+        actual = None if match is None else ipaddress.ip_network(match).prefixlen
+        mismatches += expected != actual
+
+    address_list = [e for e in resolver_entries if '/' not in e]
+    sample = addresses[:max(1, queries // 100)]
+    _, scan_time = timed(lambda: [a in address_list for a in sample], 1)
+    print('{} entries loaded in {:.3f} s, {} matches, {:.0f} lookups/s ({:.0f} lookups/s scanning the {} addresses)'
+          .format(len(resolvers), load_time, sum(m is not None for m in matches), queries / match_time,
+                  len(sample) / scan_time, len(address_list)))
+    if mismatches:
+        print('  {} lookups did not match the longest prefix'.format(mismatches))
+    return mismatches
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 1000, 10000, 100000],
+                        help='flow sizes (in packets) to benchmark')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per measurement, the best is reported')
+    parser.add_argument('--sketch-size', type=int, default=DEFAULT_SKETCH_SIZE,
+                        help='sketch size for the online statistics benchmark')
+    parser.add_argument('--resolver-entries', type=int, default=100000,
+                        help='size of the resolver list benchmark, 0 to skip it')
+    args = parser.parse_args()
+
+    benchmark_flow_features(args.sizes, args.repeat)
+    # The online timing includes building the flow, since that is where the work happens
+    benchmark_online_statistics(args.sizes, args.repeat, args.sketch_size)
+    if args.resolver_entries and benchmark_resolvers(args.resolver_entries, 100000):
+        sys.exit(1)
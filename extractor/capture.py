@@ -0,0 +1,429 @@
+import argparse
+import ctypes
+import ipaddress
+import mmap
+import os
+import select
+import socket
+import struct
+import sys
+import threading
+import time
+
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(project_root)
+
+from packet_record import ETHERTYPE_IPV4, ETHERTYPE_IPV6, LINKTYPE_ETHERNET, decode_frame
+from pcap_stream import read_frames
+
+# Ethernet + two VLAN tags + the longest IPv4 and TCP headers + a TLS record header
+SNAPLEN = 14 + 8 + 60 + 60 + 5
+DEFAULT_PORTS = (443,)
+BLOCK_SIZE = 1 << 20
+RING_SIZE = 64  # MiB
+FRAME_SIZE = 2048  # only the ring's nominal frame count depends on it, TPACKET_V3 frames are variable
+BLOCK_TIMEOUT = 10  # ms before the kernel hands over a block that is not full
+POLL_TIMEOUT = 100  # ms
+
+# linux/if_packet.h, linux/if_ether.h, asm-generic/socket.h, linux/if_arp.h
+SOL_PACKET = 263
+PACKET_RX_RING = 5
+PACKET_STATISTICS = 6
+PACKET_VERSION = 10
+PACKET_IGNORE_OUTGOING = 23
+TPACKET_V3 = 2
+TP_STATUS_KERNEL = 0
+TP_STATUS_USER = 1
+ETH_P_ALL = 0x0003
+SO_ATTACH_FILTER = 26
+ARPHRD_ETHER = 1
+ARPHRD_LOOPBACK = 772
+BPF_MAXINSNS = 4096
+
+# Classic BPF opcodes (linux/filter.h)
+BPF_LD_W_ABS = 0x20
+BPF_LD_H_ABS = 0x28
+BPF_LD_B_ABS = 0x30
+BPF_LD_H_IND = 0x48
+BPF_LDX_B_MSH = 0xb1
+BPF_ALU_AND_K = 0x54
+BPF_JMP_JA = 0x05
+BPF_JMP_JEQ_K = 0x15
+BPF_JMP_JSET_K = 0x45
+BPF_RET_K = 0x06
+ISLAND_DISTANCE = 200  # conditional jumps only reach 255 instructions ahead
+
+_block_header = struct.Struct('=IIII')  # block_status, num_pkts, offset_to_first_pkt, blk_len (at offset 8)
+_packet_header = struct.Struct('=IIIIIIHH')  # next_offset, sec, nsec, snaplen, len, status, mac, net
+_stats = struct.Struct('=III')  # tp_packets, tp_drops, tp_freeze_q_cnt
+
+
+class _Program:
+    """ Classic BPF instructions with forward jumps to labels, resolved by assemble. """
+
+    def __init__(self):
+        self.instructions = []
+        self.labels = {}
+        self.islands = 0
+        self.since_island = 0
+
+    def add(self, code, k=0, jt=0, jf=0):
+        self.instructions.append((code, jt, jf, k))
+        self.since_island += 1
+
+    def label(self, name):
+        self.labels[name] = len(self.instructions)
+
+    def accept(self):
+        """ The label of the next accepting instruction, which a conditional jump can reach. """
+        return 'accept{}'.format(self.islands)
+
+    def island(self, snaplen, jump_over=True):
+        """ Places the accepting instruction of accept(), where the jumps to it would get too long or,
+            without `jump_over`, right away after an instruction that returned. """
+        if not jump_over or self.since_island >= ISLAND_DISTANCE:
+            if jump_over:
+                self.add(BPF_JMP_JA, 1)
+            self.label(self.accept())
+            self.add(BPF_RET_K, snaplen)
+            self.islands += 1
+            self.since_island = 0
+
+    def assemble(self) -> bytes:
+        code = []
+        for index, (op, jt, jf, k) in enumerate(self.instructions):
+            if op == BPF_JMP_JA and isinstance(k, str):
+                k = self.labels[k] - index - 1
+            jt, jf = (self.labels[j] - index - 1 if isinstance(j, str) else j for j in (jt, jf))
+            if not (0 <= jt <= 255 and 0 <= jf <= 255):
+                raise ValueError('BPF jump out of range at instruction {}'.format(index))
+            code.append(struct.pack('=HBBI', op, jt, jf, k))
+        if len(code) > BPF_MAXINSNS:
+            raise ValueError('the filter needs {} BPF instructions, more than the kernel accepts ({}); '
+                             'use fewer networks'.format(len(code), BPF_MAXINSNS))
+        return b''.join(code)
+
+
+def compile_filter(ports=DEFAULT_PORTS, networks=(), snaplen=SNAPLEN) -> bytes:
+    """ Compiles a classic BPF program for Ethernet frames, equivalent to the tcpdump filter
+        'tcp and (port P1 or ...) and (net N1 or ...)' over IPv4 and IPv6 (without IPv6 extension
+        headers), that keeps the first snaplen bytes of the frames it accepts. Without ports or
+        networks, that part of the filter is left out. """
+    by_family = {4: {}, 6: {}}
+    for network in networks:
+        address, _, length = network.partition('/')
+        family = socket.AF_INET6 if ':' in address else socket.AF_INET
+        bits = 128 if family == socket.AF_INET6 else 32
+        length = int(length) if length else bits
+        value = int.from_bytes(socket.inet_pton(family, address), 'big') >> (bits - length) << (bits - length)
+        by_family[6 if family == socket.AF_INET6 else 4].setdefault(length, set()).add(value)
+
+    program = _Program()
+    program.add(BPF_LD_H_ABS, 12)
+    program.add(BPF_JMP_JEQ_K, ETHERTYPE_IPV4, jf=1)
+    program.add(BPF_JMP_JA, 'ipv4')
+    program.add(BPF_JMP_JEQ_K, ETHERTYPE_IPV6, jf=1)
+    program.add(BPF_JMP_JA, 'ipv6')
+    program.add(BPF_RET_K, 0)
+
+    # IPv4: TCP, not a non-first fragment, then the ports past the variable IP header
+    program.label('ipv4')
+    program.add(BPF_LD_B_ABS, 23)
+    program.add(BPF_JMP_JEQ_K, 6, jt=1)
+    program.add(BPF_RET_K, 0)
+    program.add(BPF_LD_H_ABS, 20)
+    program.add(BPF_JMP_JSET_K, 0x1fff, jf=1)
+    program.add(BPF_RET_K, 0)
+    program.add(BPF_LDX_B_MSH, 14)
+    _match_ports(program, BPF_LD_H_IND, (14, 16), ports, 'ipv4_networks')
+    program.label('ipv4_networks')
+    _match_networks(program, by_family[4], (26, 30), 32, snaplen, bool(networks))
+
+    program.label('ipv6')
+    program.add(BPF_LD_B_ABS, 20)
+    program.add(BPF_JMP_JEQ_K, 6, jt=1)
+    program.add(BPF_RET_K, 0)
+    _match_ports(program, BPF_LD_H_ABS, (54, 56), ports, 'ipv6_networks')
+    program.label('ipv6_networks')
+    _match_networks(program, by_family[6], (22, 38), 128, snaplen, bool(networks))
+    return program.assemble()
+
+
+def _match_ports(program, load, offsets, ports, matched):
+    """ Jumps to `matched` when the source or destination port is one of `ports`, else rejects. """
+    if not ports:
+        program.add(BPF_JMP_JA, matched)
+        return
+    for offset in offsets:
+        program.add(load, offset)
+        for port in ports:
+            program.add(BPF_JMP_JEQ_K, port, jt=matched)
+    program.add(BPF_RET_K, 0)
+
+
+def _match_networks(program, networks, offsets, bits, snaplen, filtered):
+    """ Accepts when the source or destination address is in one of `networks`, {prefix length: set of
+        network values}, else rejects. Addresses are compared 32 bits at a time.
+        With no networks, accepts everything unless the filter has networks in the other family. """
+    if not networks:
+        program.add(BPF_RET_K, 0 if filtered else snaplen)
+        return
+    for offset in offsets:
+        for length, values in sorted(networks.items()):
+            words = max(1, (length + 31) // 32)
+            if words == 1:
+                # One load and mask for every network of this length
+                program.add(BPF_LD_W_ABS, offset)
+                if length < 32:
+                    program.add(BPF_ALU_AND_K, (0xffffffff << (32 - length)) & 0xffffffff)
+                for value in sorted(values):
+                    program.island(snaplen)
+                    program.add(BPF_JMP_JEQ_K, value >> (bits - 32), jt=program.accept())
+                continue
+            for value in sorted(values):
+                program.island(snaplen)
+                following = 'network{}'.format(len(program.instructions))
+                for word in range(words):
+                    program.add(BPF_LD_W_ABS, offset + 4 * word)
+                    remaining = length - 32 * word
+                    if remaining < 32:
+                        program.add(BPF_ALU_AND_K, (0xffffffff << (32 - remaining)) & 0xffffffff)
+                    target = (value >> (bits - 32 * (word + 1))) & 0xffffffff
+                    last = word == words - 1
+                    program.add(BPF_JMP_JEQ_K, target, jt=program.accept() if last else 0, jf=following)
+                program.label(following)
+    program.add(BPF_RET_K, 0)
+    program.island(snaplen, jump_over=False)
+
+
+class RingCapture:
+    """ Captures the frames of an Ethernet (or loopback) interface through an AF_PACKET TPACKET_V3
+        ring buffer of ring_size MiB, shared with the kernel, after a BPF filter has dropped the other
+        traffic and cut the frames to snaplen in the kernel. Where TPACKET_V3 is not available,
+        falls back to reading the socket with a large receive buffer, which the kernel caps at
+        net.core.rmem_max (sysctl), however large ring_size is. The fallback loses the wire length of
+        the frames cut to snaplen, so when the caller needs it (`wire_length`, as the packet lengths
+        of flow mode do) a RuntimeError is raised instead.
+        Counts the frames the kernel dropped because the buffer was full, and those the caller
+        could not decode (undecoded). """
+
+    def __init__(self, interface, bpf, ring_size=RING_SIZE, wire_length=False):
+        with open('/sys/class/net/{}/type'.format(interface)) as f:
+            hardware_type = int(f.read())
+        if hardware_type not in (ARPHRD_ETHER, ARPHRD_LOOPBACK):
+            raise ValueError('{} is not an Ethernet interface'.format(interface))
+        self.linktype = LINKTYPE_ETHERNET
+        self.received = 0
+        self.dropped = 0
+        self.frozen = 0
+        self.undecoded = 0
+        self.running = True
+        # Protocol 0 receives nothing until bind, so no frame gets past without the filter
+        self.socket = socket.socket(socket.AF_PACKET, socket.SOCK_RAW, 0)
+        self._filter = ctypes.create_string_buffer(bpf)
+        program = struct.pack('HL', len(bpf) // 8, ctypes.addressof(self._filter))
+        self.socket.setsockopt(socket.SOL_SOCKET, SO_ATTACH_FILTER, program)
+        if hardware_type == ARPHRD_LOOPBACK:
+            # Loopback frames are seen leaving and again arriving, libpcap also keeps one copy
+            self.socket.setsockopt(SOL_PACKET, PACKET_IGNORE_OUTGOING, 1)
+        self.ring = None
+        try:
+            self.socket.setsockopt(SOL_PACKET, PACKET_VERSION, TPACKET_V3)
+            self.blocks = max(1, ring_size * (1 << 20) // BLOCK_SIZE)
+            request = struct.pack('=IIIIIII', BLOCK_SIZE, self.blocks, FRAME_SIZE,
+                                  BLOCK_SIZE // FRAME_SIZE * self.blocks, BLOCK_TIMEOUT, 0, 0)
+            self.socket.setsockopt(SOL_PACKET, PACKET_RX_RING, request)
+            self.ring = mmap.mmap(self.socket.fileno(), BLOCK_SIZE * self.blocks)
+        except OSError:
+            if wire_length:
+                self.socket.close()
+                raise RuntimeError('TPACKET_V3 is not available on {}, and without it the wire length of the '
+                                   'frames is lost: use --capture scapy in flow mode'.format(interface))
+            # Silently capped at net.core.rmem_max, raise it for a buffer of ring_size MiB
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, ring_size * (1 << 20))
+        self.socket.bind((interface, ETH_P_ALL))
+
+    def frames(self):
+        """ Yields (timestamp, linktype, frame bytes, wire length) until stop() is called, and None
+            whenever no frame arrived for POLL_TIMEOUT ms, so that an idle capture still hands back
+            control. """
+        if self.ring is None:
+            yield from self._socket_frames()
+            return
+        ring = self.ring
+        block = 0
+        poller = select.poll()
+        poller.register(self.socket, select.POLLIN | select.POLLERR)
+        while self.running:
+            base = block * BLOCK_SIZE
+            status, count, offset, _ = _block_header.unpack_from(ring, base + 8)
+            if not status & TP_STATUS_USER:
+                if not poller.poll(POLL_TIMEOUT):
+                    yield None
+                continue
+            position = base + offset
+            for _ in range(count):
+                next_offset, sec, nsec, snaplen, length, _, mac, _ = _packet_header.unpack_from(ring, position)
+                start = position + mac
+                yield sec + nsec * 1e-9, self.linktype, ring[start:start + snaplen], length
+                position += next_offset
+            # Hands the block back to the kernel
+            struct.pack_into('=I', ring, base + 8, TP_STATUS_KERNEL)
+            block = (block + 1) % self.blocks
+
+    def _socket_frames(self):
+        # The kernel cuts the frames to the snaplen before they are queued to the socket, so here the
+        # wire length is lost and the captured length stands in for it
+        self.socket.settimeout(POLL_TIMEOUT / 1000)
+        while self.running:
+            try:
+                data = self.socket.recv(65536)
+            except socket.timeout:
+                yield None
+                continue
+            yield time.time(), self.linktype, data, len(data)
+
+    def statistics(self) -> dict:
+        """ Returns the frames the filter accepted, those the kernel dropped and those that could not be
+            decoded, since the start. """
+        size = _stats.size if self.ring is not None else 8
+        values = struct.unpack('=' + 'I' * (size // 4), self.socket.getsockopt(SOL_PACKET, PACKET_STATISTICS, size))
+        # The kernel resets its counters when they are read; tp_packets includes the drops
+        self.received += values[0]
+        self.dropped += values[1]
+        if len(values) > 2:
+            self.frozen += values[2]
+        return {'received': self.received, 'dropped': self.dropped, 'frozen': self.frozen,
+                'undecoded': self.undecoded}
+
+    def stop(self) -> None:
+        self.running = False
+
+    def close(self) -> None:
+        if self.ring is not None:
+            self.ring.close()
+        self.socket.close()
+
+
+def capture_filter(ports=DEFAULT_PORTS, networks=()) -> str:
+    """ Returns the tcpdump syntax of the filter compile_filter builds, for libpcap based capture.
+        As in compile_filter, the host bits of the networks are ignored (libpcap rejects them). """
+    parts = ['tcp']
+    if ports:
+        parts.append('(' + ' or '.join('port {}'.format(port) for port in ports) + ')')
+    if networks:
+        parts.append('(' + ' or '.join('net {}'.format(ipaddress.ip_network(network, strict=False))
+                                  for network in networks) + ')')
+    return ' and '.join(parts)
+
+
+class RingSniffer:
+    """ Runs a RingCapture into a session on a thread of its own, with the start/join/stop interface
+        of scapy's AsyncSniffer. The session is closed when the capture stops; an error of the session
+        stops the capture and is raised again by join(). The decoding is counted in `metrics` when given.
+        See RingCapture for `wire_length`. """
+
+    def __init__(self, interface, session, bpf, ring_size=RING_SIZE, metrics=None, wire_length=False):
+        self.capture = RingCapture(interface, bpf, ring_size, wire_length)
+        self.session = session
+        self.metrics = metrics
+        self.thread = threading.Thread(target=self._run, name='capture')
+        self.finished = threading.Event()
+        self.error = None
+
+    def start(self) -> None:
+        self.thread.start()
+
+    def join(self) -> None:
+        # Waits on an event rather than Thread.join, which a KeyboardInterrupt can leave believing
+        # the thread has ended
+        while not self.finished.wait(0.5):
+            pass
+        raise_error(self)
+
+    def stop(self) -> None:
+        self.capture.stop()
+
+    def _run(self):
+        try:
+            try:
+                for record in capture_records(self.capture, metrics=self.metrics):
+                    self.session.on_record_received(record)
+            finally:
+                try:
+                    self.session.close()
+                finally:
+                    self.capture.close()
+        except BaseException as error:
+            self.error = error
+        finally:
+            self.finished.set()
+
+
+def raise_error(sniffer) -> None:
+    """ Raises, once, the error that ended the capture thread of a sniffer, if any. """
+    error, sniffer.error = sniffer.error, None
+    if error is not None:
+        raise error
+
+
+def capture_records(capture, statistics_interval=10.0, metrics=None):
+    """ Yields the PacketRecords of a capture's frames, decoded by the raw decoder, printing the kernel
+        and user space counters every statistics_interval seconds, idle or not, and when the capture ends.
+        The decoding is counted in `metrics` when given, where the counters are also published as
+        gauges (as of the last report). """
+    if metrics is not None:
+        for name in ('received', 'dropped', 'frozen', 'undecoded'):
+            metrics.gauge('capture_' + name, lambda name=name: getattr(capture, name))
+    next_report = time.monotonic() + statistics_interval
+    try:
+        for frame in capture.frames():
+            if frame is not None:
+                record = decode_frame(*frame) if metrics is None else metrics.decode(decode_frame, *frame)
+                if record is None:
+                    capture.undecoded += 1
+                else:
+                    yield record
+            if time.monotonic() >= next_report:
+                report_statistics(capture)
+                next_report = time.monotonic() + statistics_interval
+    finally:
+        report_statistics(capture)
+
+
+def report_statistics(capture) -> None:
+    print('Capture: kernel received {received}, dropped {dropped} (buffer full), {frozen} while frozen; '
+          'user space could not decode {undecoded}'.format(**capture.statistics()))
+
+
+def replay_capture(input_file, interface, speed=1.0) -> int:
+    """ Sends the frames of an Ethernet capture file out of an interface, such as one end of a veth
+        pair, at `speed` times the pace of their timestamps (0: as fast as possible).
+        Returns the number of frames sent. """
+    sender = socket.socket(socket.AF_PACKET, socket.SOCK_RAW)
+    sender.bind((interface, 0))
+    start = first = None
+    sent = 0
+    for timestamp, linktype, data, _ in read_frames(input_file):
+        if linktype != LINKTYPE_ETHERNET:
+            raise ValueError('only Ethernet captures can be replayed')
+        if speed > 0:
+            if first is None:
+                start, first = time.perf_counter(), timestamp
+            delay = start + (timestamp - first) / speed - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        sender.send(data)
+        sent += 1
+    sender.close()
+    return sent
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='replays a capture onto an interface, to test online mode')
+    parser.add_argument('input_file', help='pcap or pcapng file')
+    parser.add_argument('interface', help='interface to send the frames from, e.g. one end of a veth pair')
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help='replay speed relative to the capture timestamps, 0 for as fast as possible')
+    args = parser.parse_args()
+    print('Sent {} frames'.format(replay_capture(args.input_file, args.interface, args.speed)))
@@ -1,38 +1,117 @@
 import argparse
+import cProfile
 import os
+import pstats
 import sys
+import threading
 project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
 sys.path.append(project_root)
-from scapy.all import load_layer, AsyncSniffer , rdpcap
-from extractor.flow_session import FlowSession 
+from scapy.all import load_layer, bind_layers, AsyncSniffer, TCP
+from scapy.layers.tls.record import TLS
+from extractor.features.online_statistics import DEFAULT_SKETCH_SIZE
+from extractor.capture import (DEFAULT_PORTS, RING_SIZE, SNAPLEN, RingSniffer, capture_filter, compile_filter,
+                               raise_error)
+from extractor.export_stage import EXECUTORS
+from extractor.flow_session import FlowSession
+from extractor.metrics import REPORT_INTERVAL, Metrics, MetricsReporter
+from extractor.parallel import (BACKPRESSURE_POLICIES, ONLINE_QUEUE_SIZE, OnlinePipeline, extract_batch,
+                                extract_sharded, sort_csv)
+from extractor.pcap_stream import read_records
+from extractor.resolvers import DEFAULT_RESOLVERS, ResolverList
+from extractor.time_series.sequence_writer import DEFAULT_SHARDS
 
 
-def create_sniffer(input_file, input_interface, output_mode, output_file):
+class SessionSniffer(AsyncSniffer):
+    """ An AsyncSniffer that feeds its packets to a session and closes it when the capture stops.
+        As with RingSniffer, an error of the session stops the capture and is raised again by join(). """
+
+    def __init__(self, session, **kwargs):
+        super(SessionSniffer, self).__init__(prn=session.on_packet_received, store=False, **kwargs)
+        self.session = session
+        self.finished = threading.Event()
+        self.error = None
+
+    def _run(self, *args, **kwargs):
+        try:
+            try:
+                super(SessionSniffer, self)._run(*args, **kwargs)
+            finally:
+                self.session.close()
+        except BaseException as error:
+            self.error = error
+        finally:
+            self.finished.set()
+
+    def join(self, *args, **kwargs):
+        # As RingSniffer.join, waits on an event that a KeyboardInterrupt cannot leave set too early
+        while not self.finished.wait(0.5):
+            pass
+        raise_error(self)
+
+
+def create_sniffer(input_file, input_interface, output_mode, output_file, decoder='raw', clumping='incremental',
+                   sketch_size=0, workers=1, sort=False, json_shards=DEFAULT_SHARDS, compress=False,
+                   sequence_format='jsonl', resolvers=DEFAULT_RESOLVERS, capture='scapy', ports=DEFAULT_PORTS,
+                   filter_networks=(), snaplen=SNAPLEN, ring_size=RING_SIZE, queue_size=ONLINE_QUEUE_SIZE,
+                   backpressure='block', export_workers=0, export_executor='thread', export_ordered=True,
+                   metrics=None):
     assert (input_file is None) ^ (input_interface is None)
-    NewFlowSession = FlowSession.generate_session_class(output_mode, output_file)
+    session_options = dict(clumping=clumping, sketch_size=sketch_size, json_shards=json_shards, compress=compress,
+                           sequence_format=sequence_format, resolvers=resolvers, export_workers=export_workers,
+                           export_executor=export_executor, export_ordered=export_ordered)
+    NewFlowSession = FlowSession.generate_session_class(output_mode, output_file, metrics=metrics, **session_options)
 
     if input_file is not None:
         # Offline mode
-        packets = rdpcap(input_file)
-        
-        # Initialize the session
-        session = NewFlowSession()
-        
-        # Process packets
-        for packet in packets:
-            session.on_packet_received(packet)
-        
-        # Final garbage collection
-        session.garbage_collect(None)
+        if workers > 1:
+            extract_sharded(input_file, output_mode, output_file, workers, decoder, metrics, **session_options)
+        else:
+            session = NewFlowSession()
+
+            # Stream packets from the capture instead of loading it into memory
+            records = read_records(input_file, decoder)
+            for record in records if metrics is None else metrics.read(records):
+                session.on_record_received(record)
+
+            # Final garbage collection
+            session.close()
+            session.throughput.report()
+
+        if sort and output_mode == 'flow':
+            sort_csv(output_file)
         return None  # No AsyncSniffer needed for offline mode
 
     else:
-        # Online mode
-        def packet_handler(packet):
-            session.on_packet_received(packet)
+        # Online mode: the capture thread only queues the records, the flows are tracked and written
+        # out by the pipeline's worker processes
+        pipeline = OnlinePipeline(output_mode, output_file, workers, queue_size, backpressure, metrics,
+                                  **session_options)
+        try:
+            if capture == 'ring':
+                bpf = compile_filter(ports, filter_networks, snaplen)
+                # Flow features need the length of the packets, not only of what was captured
+                sniffer = RingSniffer(input_interface, pipeline, bpf, ring_size, metrics,
+                                      wire_length=output_mode == 'flow')
+                pipeline.on_failure = sniffer.stop
+            else:
+                sniffer = SessionSniffer(pipeline, iface=input_interface,
+                                         filter=capture_filter(ports, filter_networks))
+                pipeline.on_failure = lambda: sniffer.stop(join=False)
+        except BaseException:
+            pipeline.abort()
+            raise
+        return sniffer
+
+def bind_tls_ports(ports) -> None:
+    """ Has scapy dissect the TCP payloads of `ports` as TLS, which it only does for port 443. """
+    for port in ports:
+        bind_layers(TCP, TLS, sport=port)
+        bind_layers(TCP, TLS, dport=port)
+
+
+def parse_ports(value):
+    return [] if value == 'all' else [int(port) for port in value.split(',')]
 
-        session = NewFlowSession()
-        return AsyncSniffer(iface=input_interface, filter='tcp port 443', prn=packet_handler, store=False)
 
 def main():
     parser = argparse.ArgumentParser()
@@ -42,6 +121,9 @@ def main():
                              help='capture online data from INPUT_INTERFACE')
     input_group.add_argument('-f', '--offline', action='store', dest='input_file',
                              help='capture offline data from INPUT_FILE')
+    input_group.add_argument('-b', '--batch', action='store', dest='input_batch',
+                             help='extract every capture of a directory or glob pattern, resuming an '
+                                  'interrupted run; OUTPUT is then a directory')
 
     output_group = parser.add_mutually_exclusive_group(required=True)
     output_group.add_argument('-c', '--csv', action='store_const', const='flow', dest='output_mode',
@@ -49,21 +131,141 @@ def main():
     output_group.add_argument('-s', '--json', action='store_const', const='sequence', dest='output_mode',
                               help='output flow segments as json')
 
+    parser.add_argument('--decoder', choices=['raw', 'scapy'], default='raw',
+                        help='packet decoder for offline captures: the lightweight raw decoder (default) '
+                             'or full scapy dissection')
+    parser.add_argument('--clumping', choices=['incremental', 'batch'], default='incremental',
+                        help='in sequence mode, build clumps as packets arrive (default) '
+                             'or from the stored packets when the flow expires')
+    parser.add_argument('--online-stats', action='store_const', const=DEFAULT_SKETCH_SIZE, default=0,
+                        dest='sketch_size',
+                        help='in flow mode, accumulate the features in constant memory per flow instead of '
+                             'keeping every packet (median and mode become approximate)')
+    parser.add_argument('--sketch-size', type=int, dest='sketch_size',
+                        help='size of the median/mode sketches, implies --online-stats (default: {}); '
+                             'larger is more accurate'.format(DEFAULT_SKETCH_SIZE))
+    parser.add_argument('--sequence-format', choices=['jsonl', 'npy'], default='jsonl',
+                        help='in sequence mode, write JSON Lines (default) or float32 clump arrays with '
+                             'int64 offsets as .npy files, which the analyzer memory maps')
+    parser.add_argument('--json-shards', type=int, default=DEFAULT_SHARDS,
+                        help='in sequence mode, number of JSON Lines files per label (default: {})'.format(
+                            DEFAULT_SHARDS))
+    parser.add_argument('--gzip', action='store_true', help='in sequence mode, gzip the JSON Lines files')
+    parser.add_argument('-j', '--workers', type=int, default=1,
+                        help='offline or online, split the packets by connection across WORKERS processes, or '
+                             'in batch mode, extract WORKERS captures at a time (default: 1)')
+    parser.add_argument('--sort', action='store_true',
+                        help='in flow mode, sort the csv rows so the output does not depend on the number of workers')
+    parser.add_argument('--resolvers', metavar='FILE',
+                        help='label flows against the DoH resolver addresses and CIDR networks (IPv4 or IPv6) '
+                             'of FILE, one per line, instead of the built-in list')
+    parser.add_argument('--capture', choices=['scapy', 'ring'], default='scapy',
+                        help='online, capture with scapy (default) or through an AF_PACKET ring buffer with the '
+                             'filter and snaplen applied in the kernel and frames decoded by the raw decoder')
+    parser.add_argument('--ports', type=parse_ports, default=list(DEFAULT_PORTS),
+                        help="online, comma-separated TCP ports to capture, or 'all' (default: 443); with "
+                             "--capture scapy and 'all', only port 443 is dissected as TLS")
+    parser.add_argument('--filter-resolvers', action='store_true',
+                        help='online, only capture traffic to and from the resolvers (see --resolvers)')
+    parser.add_argument('--snaplen', type=int, default=SNAPLEN,
+                        help='with --capture ring, bytes kept of each frame (default: {}, the headers up to '
+                             'the first TLS record header)'.format(SNAPLEN))
+    parser.add_argument('--ring-size', type=int, default=RING_SIZE,
+                        help='with --capture ring, size of the ring buffer in MiB (default: {}); without '
+                             'TPACKET_V3, of the socket receive buffer, which net.core.rmem_max '
+                             'caps'.format(RING_SIZE))
+    parser.add_argument('--queue-size', type=int, default=ONLINE_QUEUE_SIZE,
+                        help='online, packets that may wait for each worker (default: {})'.format(ONLINE_QUEUE_SIZE))
+    parser.add_argument('--backpressure', choices=BACKPRESSURE_POLICIES, default='block',
+                        help='online, when a worker queue is full, block the capture until there is room (default; '
+                             'the kernel then drops packets) or drop the packets and count them')
+    parser.add_argument('--export-workers', type=int, default=0,
+                        help='compute and write the output of expired flows in batches on WORKERS threads or '
+                             'processes and a writer thread, off the packet path (default: 0, inline when offline, '
+                             '1 thread online)')
+    parser.add_argument('--export-executor', choices=EXECUTORS, default='thread',
+                        help='with --export-workers, compute the output on threads (default) or processes')
+    parser.add_argument('--unordered-export', action='store_false', dest='export_ordered',
+                        help='with --export-workers, write flows as soon as they are computed rather than in the '
+                             'order they expired')
+    parser.add_argument('--metrics', metavar='FILE',
+                        help="offline or online, append the counters, stage timings and histograms of the run to "
+                             "FILE as a JSON line every --metrics-interval seconds and at the end ('-' for stdout)")
+    parser.add_argument('--metrics-interval', type=float, default=REPORT_INTERVAL,
+                        help='seconds between two --metrics lines (default: {:g})'.format(REPORT_INTERVAL))
+    parser.add_argument('--metrics-port', type=int,
+                        help='offline or online, serve the metrics in the Prometheus text format at '
+                             'http://127.0.0.1:PORT/metrics')
+    parser.add_argument('--profile', metavar='FILE',
+                        help='offline, without -j or --export-workers (cProfile only sees the main thread), '
+                             'profile the extraction, writing the statistics to FILE (see pstats) and printing '
+                             'the functions with the most cumulative time')
     parser.add_argument('output', help='output file name (in flow mode) or directory (in sequence mode)')
     args = parser.parse_args()
 
-    load_layer('tls')
-    
-    sniffer = create_sniffer(args.input_file, args.input_interface, args.output_mode, args.output)
+    if args.decoder == 'scapy' or args.input_interface is not None:
+        load_layer('tls')
+        if args.input_interface is not None and args.capture == 'scapy':
+            bind_tls_ports(args.ports)
+
+    if args.input_batch is not None and args.export_executor == 'process' and args.export_workers > 0:
+        parser.error('batch mode workers cannot start export processes, use --export-executor thread')
 
-    if sniffer:
-        sniffer.start()
+    if args.profile is not None and (args.input_file is None or args.workers > 1 or args.export_workers > 0):
+        parser.error('--profile only profiles the main thread: it needs -f without -j or --export-workers')
+
+    metrics = None
+    if args.metrics is not None or args.metrics_port is not None:
+        if args.input_batch is not None:
+            parser.error('metrics are not available in batch mode')
+        metrics = Metrics(args.metrics_interval)
+
+    if args.profile is None:
+        run(args, metrics)
+    else:
+        profiler = cProfile.Profile()
         try:
-            sniffer.join()
-        except KeyboardInterrupt:
-            sniffer.stop()
+            profiler.runcall(run, args, metrics)
         finally:
-            sniffer.join()
+            profiler.dump_stats(args.profile)
+            pstats.Stats(profiler).sort_stats('cumulative').print_stats(25)
+
+
+def run(args, metrics=None):
+    resolvers = ResolverList.from_file(args.resolvers) if args.resolvers else DEFAULT_RESOLVERS
+
+    if args.input_batch is not None:
+        extract_batch(args.input_batch, args.output_mode, args.output, args.workers, args.decoder,
+                      clumping=args.clumping, sketch_size=args.sketch_size, json_shards=args.json_shards,
+                      compress=args.gzip, sequence_format=args.sequence_format, resolvers=resolvers,
+                      export_workers=args.export_workers, export_executor=args.export_executor,
+                      export_ordered=args.export_ordered)
+        if args.sort and args.output_mode == 'flow':
+            sort_csv(os.path.join(args.output, 'flows.csv'))
+        return
+
+    reporter = None
+    if metrics is not None:
+        reporter = MetricsReporter(metrics, args.metrics, args.metrics_port)
+
+    try:
+        sniffer = create_sniffer(args.input_file, args.input_interface, args.output_mode, args.output, args.decoder,
+                                 args.clumping, args.sketch_size, args.workers, args.sort, args.json_shards, args.gzip,
+                                 args.sequence_format, resolvers, args.capture, args.ports,
+                                 resolvers.entries if args.filter_resolvers else (), args.snaplen, args.ring_size,
+                                 args.queue_size, args.backpressure, args.export_workers, args.export_executor,
+                                 args.export_ordered, metrics)
+        if sniffer:
+            sniffer.start()
+            try:
+                sniffer.join()
+            except KeyboardInterrupt:
+                sniffer.stop()
+            finally:
+                sniffer.join()
+    finally:
+        if reporter is not None:
+            reporter.close()
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -0,0 +1,109 @@
+import multiprocessing
+import queue
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+EXPORT_BATCH_SIZE = 64  # flows per task
+MAX_PENDING_BATCHES = 64  # batches submitted and not yet written, beyond which submit blocks
+EXECUTORS = ('thread', 'process')
+FLUSH = object()  # writer marker: call flush
+DONE = object()  # writer marker: the stage is closed
+
+
+def _compute_batch(compute, items) -> list:
+    return [compute(item) for item in items]
+
+
+class ExportStage:
+    """ Turns finished flows into output off the packet path. Items are grouped in batches of
+        batch_size, `compute` is applied to each batch by a pool of `workers` threads or processes
+        (executor 'thread' or 'process', where compute and the items must be picklable), and a single
+        writer thread passes the results to `write` one by one, and calls `flush` when asked to.
+        The pool forks its processes lazily, once the writer (and metrics) threads run, so they are
+        started by a fork server rather than forked from this process.
+        With ordered, the results are written in the order the items were submitted, otherwise as
+        soon as their batch is computed. Submitting blocks while max_pending batches wait.
+        close() writes every item submitted before it returns, and raises the first error
+        of compute or write, if any. """
+
+    def __init__(self, compute, write, flush=None, workers=1, executor='thread', ordered=True,
+                 batch_size=EXPORT_BATCH_SIZE, max_pending=MAX_PENDING_BATCHES):
+        if executor not in EXECUTORS:
+            raise ValueError('unknown export executor: {}'.format(executor))
+        self.compute = compute
+        self.write = write
+        self.flush_output = flush
+        self.ordered = ordered
+        self.batch_size = batch_size
+        if executor == 'thread':
+            self.pool = ThreadPoolExecutor(workers)
+        else:
+            self.pool = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('forkserver'))
+        self.batch = []
+        self.pending = threading.BoundedSemaphore(max_pending)
+        # Futures in submission order when ordered, otherwise results as they are computed
+        self.results = queue.Queue()
+        self.error = None
+        self.closed = False
+        self.writer = threading.Thread(target=self._run_writer, name='export-writer')
+        self.writer.start()
+
+    def submit(self, item) -> None:
+        self.batch.append(item)
+        if len(self.batch) >= self.batch_size:
+            self._submit_batch()
+
+    def flush(self) -> None:
+        """ Submits the partial batch, then has the writer call flush once the results before it are written
+            (in unordered mode, once the results computed so far are written). """
+        self._submit_batch()
+        if self.flush_output is not None:
+            self.results.put(FLUSH)
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        self.closed = True
+        self._submit_batch()
+        # Every batch is computed, and in unordered mode queued by its callback, once the pool has shut down
+        self.pool.shutdown(wait=True)
+        self.results.put(DONE)
+        self.writer.join()
+        if self.error is not None:
+            raise self.error
+
+    def _submit_batch(self) -> None:
+        if not self.batch:
+            return
+        batch, self.batch = self.batch, []
+        self.pending.acquire()
+        future = self.pool.submit(_compute_batch, self.compute, batch)
+        if self.ordered:
+            self.results.put(future)
+        else:
+            future.add_done_callback(self.results.put)
+
+    def _run_writer(self) -> None:
+        while True:
+            future = self.results.get()
+            if future is DONE:
+                break
+            if future is FLUSH:
+                self._call(self.flush_output)
+                continue
+            try:
+                outputs = future.result()
+            except BaseException as e:
+                outputs = ()
+                self.error = self.error or e
+            for output in outputs:
+                self._call(self.write, output)
+            self.pending.release()
+
+    def _call(self, function, *args) -> None:
+        # After an error the writer keeps draining, so that the producer is never left blocked
+        if self.error is None:
+            try:
+                function(*args)
+            except BaseException as e:
+                self.error = e
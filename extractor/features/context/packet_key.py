@@ -11,33 +11,38 @@ def get_packet_flow_key(packet, direction) -> tuple:
     Creates a key signature for a packet so it can be assigned to a flow.
 
     Args:
-        packet: A network packet
+        packet: A PacketRecord
         direction: The direction of a packet
 
     Returns:
         tuple: (dest_ip , src_ip , src_port , dest_port)
-
-    Raises:
-        Exception: If the packet does not contain TCP or UDP protocol data.
     """
 
-    if 'TCP' in packet:
-        protocol = 'TCP'
-    elif 'UDP' in packet:
-        protocol = 'UDP'
-    else:
-        raise Exception('Only TCP protocols are supported.')
-
     if direction == PacketDirection.FORWARD:
-        dest_ip = packet['IP'].dst
-        src_ip = packet['IP'].src
-        src_port = packet[protocol].sport
-        dest_port = packet[protocol].dport
+        dest_ip = packet.dst_ip
+        src_ip = packet.src_ip
+        src_port = packet.src_port
+        dest_port = packet.dst_port
     else:
-        dest_ip = packet['IP'].src
-        src_ip = packet['IP'].dst
-        src_port = packet[protocol].dport
-        dest_port = packet[protocol].sport
-        
+        dest_ip = packet.src_ip
+        src_ip = packet.dst_ip
+        src_port = packet.dst_port
+        dest_port = packet.src_port
+
     return dest_ip, src_ip, src_port, dest_port
 
+
+def get_canonical_flow_key(packet) -> tuple:
+    """
+    Creates a key shared by both directions of a connection, so a flow is found with a single lookup.
+
+    Args:
+        packet: A PacketRecord
+
+    Returns:
+        tuple: the (ip, port) endpoints of the packet, lowest first
+    """
+
+    src = (packet.src_ip, packet.src_port)
+    dst = (packet.dst_ip, packet.dst_port)
+    return src + dst if src <= dst else dst + src
@@ -0,0 +1,105 @@
+import os
+import sys
+from datetime import datetime
+
+import numpy as np
+
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(project_root)
+
+from features.context.packet_direction import PacketDirection
+
+
+class FlowStatistics:
+    """ Computes every statistical CSV column of a flow in a single vectorized pass over its columns.
+        Produces the same values as FlowBytes, PacketLength, PacketTime and ResponseTime, but each
+        derived series (relative times, response times, sorted values) is computed only once. """
+
+    def __init__(self, times, lengths, directions):
+        self.times = np.asarray(times, dtype=np.float64)
+        self.lengths = np.asarray(lengths, dtype=np.int64)
+        self.directions = np.asarray(directions, dtype=np.int8)
+
+    def packet_times(self) -> np.ndarray:
+        """ Packet times relative to the first packet. """
+        return self.times - self.times[0]
+
+    def response_times(self) -> np.ndarray:
+        """ Time differences between a forward packet and the reverse packet right after it. """
+        forward = self.directions[:-1] == PacketDirection.FORWARD.value
+        reverse = self.directions[1:] == PacketDirection.REVERSE.value
+        return np.diff(self.times)[forward & reverse]
+
+    def get_data(self) -> dict:
+        """ Returns the columns from TimeStamp to ResponseTimeCoefficientofVariation, in CSV order. """
+        data = {}
+        packet_times = self.packet_times()
+        duration = packet_times.max() - packet_times.min()
+        forward = self.directions == PacketDirection.FORWARD.value
+        reverse = self.directions == PacketDirection.REVERSE.value
+        bytes_sent = int(self.lengths[forward].sum())
+        bytes_received = int(self.lengths[reverse].sum())
+
+        data['TimeStamp'] = datetime.fromtimestamp(self.times[0]).strftime('%Y-%m-%d %H:%M:%S')
+        data['Duration'] = duration
+        data['FlowBytesSent'] = bytes_sent
+        data['FlowSentRate'] = bytes_sent / duration if duration != 0 else -1
+        data['FlowBytesReceived'] = bytes_received
+        data['FlowReceivedRate'] = bytes_received / duration if duration != 0 else -1
+
+        var, std, mean, median, mode = _moments(self.lengths)
+        mode = int(mode)
+        data['PacketLengthVariance'] = var
+        data['PacketLengthStandardDeviation'] = std
+        data['PacketLengthMean'] = mean
+        data['PacketLengthMedian'] = median
+        data['PacketLengthMode'] = mode
+        data['PacketLengthSkewFromMedian'] = 3 * (mean - median) / std if std != 0 else 0.0
+        data['PacketLengthSkewFromMode'] = (mean - mode) / std if std != 0 else 0.0
+        data['PacketLengthCoefficientofVariation'] = std / mean if mean != 0 else 0.0
+
+        var, std, mean, median, mode = _moments(packet_times)
+        data['PacketTimeVariance'] = var
+        data['PacketTimeStandardDeviation'] = std
+        data['PacketTimeMean'] = mean
+        data['PacketTimeMedian'] = median
+        data['PacketTimeMode'] = float(mode)
+        data['PacketTimeSkewFromMedian'] = 3 * (mean - median) / std if std != 0 else -10
+        data['PacketTimeSkewFromMode'] = (float(mean) - float(mode)) / float(std) if std != 0 else -10
+        data['PacketTimeCoefficientofVariation'] = std / mean if mean != 0 else -1
+
+        response_times = self.response_times()
+        if len(response_times):
+            var, std, mean, median, mode = _moments(response_times)
+            mode = float(mode)
+        else:
+            var, mean, median, mode = 0.0, 0.0, 0.0, 0.0
+            std = np.sqrt(var)
+        data['ResponseTimeVariance'] = var
+        data['ResponseTimeStandardDeviation'] = std
+        data['ResponseTimeMean'] = mean
+        data['ResponseTimeMedian'] = median
+        data['ResponseTimeMode'] = mode
+        data['ResponseTimeSkewFromMedian'] = 3 * (mean - median) / std if std != 0 else 0.0
+        data['ResponseTimeSkewFromMode'] = (mean - mode) / std if std != 0 else 0.0
+        data['ResponseTimeCoefficientofVariation'] = std / mean if mean != 0 else 0.0
+        return data
+
+
+def _moments(values):
+    """ Returns variance, standard deviation, mean, median and mode of a non-empty series,
+        sorting it once for both the median and the mode. """
+    var = np.var(values)
+    std = np.sqrt(var)
+    mean = np.mean(values)
+    ordered = np.sort(values)
+    n = len(ordered)
+    if n % 2:
+        median = np.float64(ordered[n // 2])
+    else:
+        median = (np.float64(ordered[n // 2 - 1]) + np.float64(ordered[n // 2])) / 2
+    # Smallest of the most common values, as scipy.stats.mode
+    starts = np.flatnonzero(np.concatenate(([True], ordered[1:] != ordered[:-1])))
+    counts = np.diff(np.append(starts, n))
+    mode = ordered[starts[np.argmax(counts)]]
+    return var, std, mean, median, mode
@@ -0,0 +1,269 @@
+import math
+import os
+import sys
+from datetime import datetime
+
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(project_root)
+
+from features.context.packet_direction import PacketDirection
+
+DEFAULT_SKETCH_SIZE = 200
+
+
+class RunningMoments:
+    """ Mean and variance of a stream in constant memory (Welford), mergeable with Chan's formula. """
+
+    __slots__ = ('count', 'mean', 'm2')
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+
+    def add(self, value):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+
+    def merge(self, other):
+        """ Combines the moments of another stream into this one. """
+        count = self.count + other.count
+        if count == 0:
+            return
+        delta = other.mean - self.mean
+        self.mean += delta * other.count / count
+        self.m2 += other.m2 + delta * delta * self.count * other.count / count
+        self.count = count
+
+    def variance(self) -> float:
+        """ Population variance, as numpy.var. """
+        return self.m2 / self.count if self.count else 0.0
+
+
+class QuantileSketch:
+    """ KLL quantile sketch. Memory is bounded by about 3 * k values whatever the stream length,
+        and the rank error of a quantile is O(1/k). Exact while fewer than k values were added. """
+
+    __slots__ = ('k', 'compactors', 'size', 'max_size', 'offset')
+
+    def __init__(self, k=DEFAULT_SKETCH_SIZE):
+        self.k = k
+        self.compactors = []
+        self.size = 0
+        self.max_size = 0
+        self.offset = 0  # alternates which half of a compacted level survives, keeps results reproducible
+        self._grow()
+
+    def _grow(self):
+        self.compactors.append([])
+        self.max_size = sum(self._capacity(height) for height in range(len(self.compactors)))
+
+    def _capacity(self, height):
+        depth = len(self.compactors) - height - 1
+        return int(math.ceil(self.k * (2 / 3) ** depth)) + 1
+
+    def add(self, value):
+        self.compactors[0].append(value)
+        self.size += 1
+        if self.size >= self.max_size:
+            self._compress()
+
+    def merge(self, other):
+        """ Adds the values summarized by another sketch into this one. """
+        while len(self.compactors) < len(other.compactors):
+            self._grow()
+        for height, compactor in enumerate(other.compactors):
+            self.compactors[height].extend(compactor)
+        self.size = sum(len(c) for c in self.compactors)
+        while self.size >= self.max_size:
+            self._compress()
+
+    def _compress(self):
+        for height, compactor in enumerate(self.compactors):
+            if len(compactor) >= self._capacity(height):
+                if height + 1 >= len(self.compactors):
+                    self._grow()
+                compactor.sort()
+                # An odd item out stays at this level
+                kept = [compactor.pop()] if len(compactor) % 2 else []
+                self.compactors[height + 1].extend(compactor[self.offset::2])
+                self.offset ^= 1
+                self.compactors[height] = kept
+                self.size = sum(len(c) for c in self.compactors)
+                return
+
+    def median(self) -> float:
+        """ Median of the stream: exact (as numpy.median) until the first compaction, approximate after. """
+        if len(self.compactors) == 1 or all(not c for c in self.compactors[1:]):
+            ordered = sorted(self.compactors[0])
+            n = len(ordered)
+            if n % 2:
+                return float(ordered[n // 2])
+            return (float(ordered[n // 2 - 1]) + float(ordered[n // 2])) / 2
+        weighted = sorted((value, 2 ** height) for height, c in enumerate(self.compactors) for value in c)
+        total = sum(weight for _, weight in weighted)
+        cumulative = 0
+        for value, weight in weighted:
+            cumulative += weight
+            if cumulative * 2 >= total:
+                return float(value)
+        return float(weighted[-1][0])
+
+
+class FrequencySketch:
+    """ Misra-Gries heavy hitters with `capacity` counters. The count of a value is underestimated
+        by at most n / (capacity + 1), and it is exact while there are at most `capacity` distinct values. """
+
+    __slots__ = ('capacity', 'counters', 'minimum')
+
+    def __init__(self, capacity=DEFAULT_SKETCH_SIZE):
+        self.capacity = capacity
+        self.counters = {}
+        self.minimum = None
+
+    def add(self, value):
+        if self.minimum is None or value < self.minimum:
+            self.minimum = value
+        counters = self.counters
+        if value in counters:
+            counters[value] += 1
+        elif len(counters) < self.capacity:
+            counters[value] = 1
+        else:
+            for key in list(counters):
+                counters[key] -= 1
+                if counters[key] == 0:
+                    del counters[key]
+
+    def merge(self, other):
+        """ Adds the counters of another sketch, keeping the `capacity` largest. """
+        if other.minimum is not None and (self.minimum is None or other.minimum < self.minimum):
+            self.minimum = other.minimum
+        for value, count in other.counters.items():
+            self.counters[value] = self.counters.get(value, 0) + count
+        if len(self.counters) > self.capacity:
+            threshold = sorted(self.counters.values(), reverse=True)[self.capacity]
+            self.counters = {value: count - threshold for value, count in self.counters.items()
+                             if count > threshold}
+
+    def mode(self):
+        """ Smallest of the most frequent values (as scipy.stats.mode). When no value was seen twice,
+            that is the smallest value of the stream. """
+        best_count = max(self.counters.values(), default=0)
+        if best_count <= 1:
+            return self.minimum
+        return min(value for value, count in self.counters.items() if count == best_count)
+
+
+class OnlineSeries:
+    """ Constant-memory summary of a series: moments, median and mode. """
+
+    __slots__ = ('moments', 'quantiles', 'frequencies')
+
+    def __init__(self, sketch_size=DEFAULT_SKETCH_SIZE):
+        self.moments = RunningMoments()
+        self.quantiles = QuantileSketch(sketch_size)
+        self.frequencies = FrequencySketch(sketch_size)
+
+    def add(self, value):
+        self.moments.add(value)
+        self.quantiles.add(value)
+        self.frequencies.add(value)
+
+    def __len__(self):
+        return self.moments.count
+
+    def summary(self) -> tuple:
+        """ Returns variance, standard deviation, mean, median and mode. """
+        var = self.moments.variance()
+        return var, math.sqrt(var), self.moments.mean, self.quantiles.median(), self.frequencies.mode()
+
+
+class OnlineFlowStatistics:
+    """ Accumulates the statistical CSV columns of a flow packet by packet, in memory that does not
+        depend on the packet count. Moments are exact up to rounding, median and mode come from
+        bounded sketches whose accuracy is set by `sketch_size`. """
+
+    __slots__ = ('first_time', 'min_time', 'max_time', 'previous_time', 'previous_direction',
+                 'bytes_sent', 'bytes_received', 'lengths', 'packet_times', 'response_times')
+
+    def __init__(self, sketch_size=DEFAULT_SKETCH_SIZE):
+        self.first_time = None
+        self.min_time = None
+        self.max_time = None
+        self.previous_time = None
+        self.previous_direction = None
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.lengths = OnlineSeries(sketch_size)
+        self.packet_times = OnlineSeries(sketch_size)
+        self.response_times = OnlineSeries(sketch_size)
+
+    def add_packet(self, timestamp, length, direction):
+        """ Accounts for one packet, `direction` being a PacketDirection value. """
+        if self.first_time is None:
+            self.first_time = timestamp
+        relative_time = timestamp - self.first_time
+        if self.min_time is None or relative_time < self.min_time:
+            self.min_time = relative_time
+        if self.max_time is None or relative_time > self.max_time:
+            self.max_time = relative_time
+        if direction == PacketDirection.FORWARD.value:
+            self.bytes_sent += length
+        else:
+            self.bytes_received += length
+        self.lengths.add(length)
+        self.packet_times.add(relative_time)
+        if self.previous_direction == PacketDirection.FORWARD.value and direction == PacketDirection.REVERSE.value:
+            self.response_times.add(timestamp - self.previous_time)
+        self.previous_time = timestamp
+        self.previous_direction = direction
+
+    def get_data(self) -> dict:
+        """ Returns the columns from TimeStamp to ResponseTimeCoefficientofVariation, in CSV order,
+            with the same conventions as FlowStatistics. """
+        data = {}
+        duration = self.max_time - self.min_time
+
+        data['TimeStamp'] = datetime.fromtimestamp(self.first_time).strftime('%Y-%m-%d %H:%M:%S')
+        data['Duration'] = duration
+        data['FlowBytesSent'] = self.bytes_sent
+        data['FlowSentRate'] = self.bytes_sent / duration if duration != 0 else -1
+        data['FlowBytesReceived'] = self.bytes_received
+        data['FlowReceivedRate'] = self.bytes_received / duration if duration != 0 else -1
+
+        var, std, mean, median, mode = self.lengths.summary()
+        data['PacketLengthVariance'] = var
+        data['PacketLengthStandardDeviation'] = std
+        data['PacketLengthMean'] = mean
+        data['PacketLengthMedian'] = median
+        data['PacketLengthMode'] = int(mode)
+        data['PacketLengthSkewFromMedian'] = 3 * (mean - median) / std if std != 0 else 0.0
+        data['PacketLengthSkewFromMode'] = (mean - mode) / std if std != 0 else 0.0
+        data['PacketLengthCoefficientofVariation'] = std / mean if mean != 0 else 0.0
+
+        var, std, mean, median, mode = self.packet_times.summary()
+        data['PacketTimeVariance'] = var
+        data['PacketTimeStandardDeviation'] = std
+        data['PacketTimeMean'] = mean
+        data['PacketTimeMedian'] = median
+        data['PacketTimeMode'] = float(mode)
+        data['PacketTimeSkewFromMedian'] = 3 * (mean - median) / std if std != 0 else -10
+        data['PacketTimeSkewFromMode'] = (mean - mode) / std if std != 0 else -10
+        data['PacketTimeCoefficientofVariation'] = std / mean if mean != 0 else -1
+
+        if len(self.response_times):
+            var, std, mean, median, mode = self.response_times.summary()
+        else:
+            var, std, mean, median, mode = 0.0, 0.0, 0.0, 0.0, 0.0
+        data['ResponseTimeVariance'] = var
+        data['ResponseTimeStandardDeviation'] = std
+        data['ResponseTimeMean'] = mean
+        data['ResponseTimeMedian'] = median
+        data['ResponseTimeMode'] = float(mode)
+        data['ResponseTimeSkewFromMedian'] = 3 * (mean - median) / std if std != 0 else 0.0
+        data['ResponseTimeSkewFromMode'] = (mean - mode) / std if std != 0 else 0.0
+        data['ResponseTimeCoefficientofVariation'] = std / mean if mean != 0 else 0.0
+        return data
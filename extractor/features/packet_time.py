@@ -1,19 +1,13 @@
 import numpy
 from datetime import datetime
 from scipy import stats as stat
-from scapy.all import  PacketList
-from scapy.plist import PacketList
 
 
 class PacketTime:
     """This class extracts features related to the Packet Times."""
 
-    def __init__(self, packets: PacketList):
-        if isinstance(packets, PacketList):
-            self.packets = packets
-        else:
-            raise ValueError("Expected a PacketList object from Scapy.")
-
+    def __init__(self, times):
+        self.times = times
         self.packet_times = None
     
     def get_packet_times(self) -> list:
@@ -23,8 +17,8 @@ class PacketTime:
         """
         if self.packet_times is not None:
             return self.packet_times
-        first_packet_time = self.packets[0].time
-        packet_times = [packet.time - first_packet_time for packet in self.packets]
+        first_packet_time = self.times[0]
+        packet_times = [time - first_packet_time for time in self.times]
         self.packet_times = packet_times
         return packet_times
     
@@ -41,7 +35,7 @@ class PacketTime:
     
     def get_time_stamp(self) -> str:
         """ Returns the date and time in a human-readable format. """
-        time = self.packets[0].time
+        time = self.times[0]
         date_time = datetime.fromtimestamp(time).strftime('%Y-%m-%d %H:%M:%S')
         return date_time
     
@@ -12,9 +12,9 @@ class ResponseTime:
     """ A summary of features based on the time difference
         between an outgoing packet and the following response. """
 
-    def __init__(self, packets):
-        self.packets = packets
-        self.timestamps = [packet.time for packet in packets]
+    def __init__(self, times, directions):
+        self.times = times
+        self.directions = directions
 
 
     def get_dif(self) -> list:
@@ -22,11 +22,14 @@ class ResponseTime:
            and the following response packet.
            Returns a list of time differences. """
         time_diff = []
-        temp_packet = None
-        for packet in self.packets:
-            if temp_packet and temp_packet.direction == PacketDirection.FORWARD and packet.direction == PacketDirection.REVERSE:
-                time_diff.append(float(packet.time - temp_packet.time))
-            temp_packet = packet
+        temp_time = None
+        temp_direction = None
+        for time, direction in zip(self.times, self.directions):
+            if temp_time is not None and temp_direction == PacketDirection.FORWARD.value \
+                    and direction == PacketDirection.REVERSE.value:
+                time_diff.append(float(time - temp_time))
+            temp_time = time
+            temp_direction = direction
         return time_diff
 
     def get_var(self) -> float:
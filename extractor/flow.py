@@ -1,55 +1,99 @@
 import os
 import sys
-from scapy.plist import PacketList
-from scapy.layers.tls.record import TLSApplicationData
+from array import array
 
 project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
 sys.path.append(project_root)
 
-from constants import DOH_IPS
 from features.context import packet_key
 from features.flow_bytes import FlowBytes
+from features.flow_statistics import FlowStatistics
+from features.online_statistics import DEFAULT_SKETCH_SIZE, OnlineFlowStatistics
 from features.packet_length import PacketLength
 from features.packet_time import PacketTime
 from features.response_time import ResponseTime
 
 from enum import Enum
-from typing import Any, List
+from typing import Optional
 
-# Define Flow class
-from scapy.plist import PacketList
-from scapy.all import Packet
+from packet_record import PacketRecord
+from resolvers import DEFAULT_RESOLVERS, ResolverList
+from time_series.flow_clumps import ClumpBuilder
 
 class Flow:
     """This class summarizes the values of the features of the network flows"""
 
-    def __init__(self, packet: Packet, direction: Enum):
+    __slots__ = ('dest_ip', 'src_ip', 'src_port', 'dest_port', 'protocol',
+                 'times', 'lengths', 'app_data_lengths', 'directions',
+                 'clump_builder', 'statistics', 'latest_timestamp', 'start_timestamp', 'doh', 'initial_ttl')
+
+    def __init__(self, packet: PacketRecord, direction: Enum, incremental_clumps: bool = False,
+                 online_statistics: bool = False, sketch_size: int = DEFAULT_SKETCH_SIZE,
+                 resolvers: ResolverList = DEFAULT_RESOLVERS):
         """Initializes an object from the Flow class.
             Args:
-                packet (Packet): A packet from the network.
+                packet (PacketRecord): A packet from the network.
                 direction (Enum): The direction the packet is going over the wire.
+                incremental_clumps (bool): Build the clumps as packets arrive instead of storing the packets.
+                online_statistics (bool): Accumulate the CSV features as packets arrive instead of storing the packets.
+                sketch_size (int): Size of the median and mode sketches in online statistics mode.
+                resolvers (ResolverList): The DoH resolvers the flow is labelled against.
         """
         self.dest_ip, self.src_ip, self.src_port, self.dest_port = packet_key.get_packet_flow_key(packet, direction)
-        self.packets: PacketList = PacketList()  
-        self.directions: List[Enum] = []  # Add a list to store directions
+        self.protocol = packet.protocol
+        self.initial_ttl = packet.ttl  # of the first packet, the only one FlowBytes.get_initial_ttl reads
+        # Only the per-packet fields the features use are kept, one column each
+        self.times = array('d')
+        self.lengths = array('I')
+        self.app_data_lengths = array('H')
+        self.directions = array('b')  # PacketDirection values
+        self.clump_builder = ClumpBuilder() if incremental_clumps else None
+        self.statistics = OnlineFlowStatistics(sketch_size) if online_statistics else None
         self.latest_timestamp = 0
         self.start_timestamp = 0
+        # Labelled once, the endpoints of a flow do not change
+        self.doh = resolvers.match(self.src_ip) is not None or resolvers.match(self.dest_ip) is not None
 
-    def add_packet(self, packet: Packet, direction: Enum) -> None:
-        """Adds a packet to the current list of packets."""
-        self.packets.append(packet)
-        self.directions.append(direction)  # Store direction
+    def add_packet(self, packet: PacketRecord, direction: Enum) -> Optional[tuple]:
+        """Appends the fields of a packet to the flow columns, or to the open clump or the online
+            statistics in the incremental modes.
+            Returns the row of the clump the packet finished when clumping incrementally, otherwise None."""
+        finished = None
+        if self.clump_builder is not None:
+            finished = self.clump_builder.add_packet(packet.time, packet.app_data_length, direction)
+        elif self.statistics is not None:
+            self.statistics.add_packet(packet.time, packet.length, direction.value)
+        else:
+            self.times.append(packet.time)
+            self.lengths.append(packet.length)
+            self.app_data_lengths.append(packet.app_data_length)
+            self.directions.append(direction.value)
         self.latest_timestamp = max([packet.time, self.latest_timestamp])
         if self.start_timestamp == 0:
             self.start_timestamp = packet.time
+        return finished
 
     def get_data(self) -> dict:
         """Obtains the values of the features extracted from each flow."""
-        print(f"Number of packets: {len(self.packets)}, Number of directions: {len(self.directions)}")
-        flow_bytes = FlowBytes(self.packets, self.directions)  # Pass both PacketList and directions
-        packet_length = PacketLength(self.packets)  # Pass PacketList
-        packet_time = PacketTime(self.packets)  # Pass PacketList
-        response = ResponseTime(self.packets)  # Pass PacketList
+        data = {
+            'SourceIP': self.src_ip,
+            'DestinationIP': self.dest_ip,
+            'SourcePort': self.src_port,
+            'DestinationPort': self.dest_port,
+        }
+        if self.statistics is not None:
+            data.update(self.statistics.get_data())
+        else:
+            data.update(FlowStatistics(self.times, self.lengths, self.directions).get_data())
+        data['DoH'] = self.is_doh()
+        return data
+
+    def get_data_by_feature(self) -> dict:
+        """Obtains the same values as get_data through the individual feature classes."""
+        flow_bytes = FlowBytes(self.lengths, self.directions, self.times, self.protocol, self.initial_ttl)
+        packet_length = PacketLength(self.lengths)
+        packet_time = PacketTime(self.times)
+        response = ResponseTime(self.times, self.directions)
         data = {
             'SourceIP': self.src_ip,
             'DestinationIP': self.dest_ip,
@@ -90,8 +134,8 @@ class Flow:
         return data
 
     def is_doh(self) -> bool:
-        """Checks if the source or destination IP of the flow is in the list of DoH IPs."""
-        return self.src_ip in DOH_IPS or self.dest_ip in DOH_IPS
+        """Checks if the source or destination IP of the flow belongs to a DoH resolver."""
+        return self.doh
 
     @property
     def duration(self) -> float:
@@ -1,32 +1,74 @@
 import csv
+import functools
+import heapq
+import itertools
 import os
 import sys
+import time
 from collections import defaultdict
 
 project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
 sys.path.append(project_root)
 
-from scapy.layers.tls.record import TLS, TLSApplicationData
 from scapy.sessions import DefaultSession
 
 from features.context.packet_direction import PacketDirection
-from features.context.packet_key import get_packet_flow_key
+from features.context.packet_key import get_canonical_flow_key
+from export_stage import ExportStage
 from flow import Flow
+from packet_record import PacketRecord
+from resolvers import DEFAULT_RESOLVERS
+from time_series.clump_arrays import ClumpArrayWriter
 from time_series.processor import Processor
+from time_series.sequence_writer import DEFAULT_SHARDS, SequenceWriter
+from utils import Throughput
 
 EXPIRED_UPDATE = 40
+ACTIVE_TIMEOUT = 90
+MIN_APP_DATA_LENGTH = 40
 
 class FlowSession(DefaultSession):
     """Creates a list of network flows."""
 
     def __init__(self, prn=None, store=False, *args, **kwargs):
         self.flows = {}
+        # Lazy-deletion heap of (deadline, sequence, key), an entry is current only while
+        # expiry_schedule[key] still holds its (deadline, sequence)
+        self.expiry_heap = []
+        self.expiry_schedule = {}
+        self.expiry_sequence = itertools.count()
         self.csv_line = 0
         if self.output_mode == 'flow':
-            output = open(self.output_file, 'w')
-            self.csv_writer = csv.writer(output)
+            self.output = open(self.output_file, 'w', newline='')
+            self.csv_writer = csv.writer(self.output)
+        elif self.output_mode == 'inference':
+            pass  # Clumps go to self.classifier as they are finished
+        elif self.sequence_format == 'npy':
+            self.sequence_writer = ClumpArrayWriter(self.output_file, self.file_prefix)
+        else:
+            self.sequence_writer = SequenceWriter(self.output_file, self.json_shards, self.compress,
+                                                  self.file_prefix)
         self.packets_count = 0
+        self.throughput = Throughput()
         self.clumped_flows_per_label = defaultdict(list)
+        self.bytes_written = 0  # flow mode, the sequence writers count their own
+        if self.metrics is not None:
+            self.metrics.gauge('live_flows', lambda: len(self.flows))
+            if self.output_mode != 'inference':
+                self.metrics.gauge('bytes_written', lambda: self.bytes_written if self.output_mode == 'flow'
+                                   else self.sequence_writer.bytes_written)
+        self.export_stage = None
+        if self.export_workers > 0:
+            # Only the stage's writer thread touches the output from now on
+            if self.output_mode == 'inference' and self.export_executor != 'thread':
+                raise ValueError('inference mode exports flows with threads only')
+            if self.metrics is None:
+                compute, write = functools.partial(flow_output, self.output_mode), self.write_output
+            else:
+                compute, write = functools.partial(timed_flow_output, self.output_mode), self.write_timed_output
+            self.export_stage = ExportStage(compute, write,
+                                            self.sequence_writer.flush if self.output_mode == 'sequence' else None,
+                                            self.export_workers, self.export_executor, self.export_ordered)
         super(FlowSession, self).__init__(prn, store, *args, **kwargs)
 
 
@@ -37,68 +79,126 @@ class FlowSession(DefaultSession):
 
 
     def on_packet_received(self, packet):
-        """ Handles packets as they are received. """
+        """ Handles scapy packets as they are received. """
+        if self.metrics is None:
+            record = PacketRecord.from_scapy(packet)
+        else:
+            record = self.metrics.decode(PacketRecord.from_scapy, packet)
+        if record is not None:
+            self.on_record_received(record)
+
+
+    def on_record_received(self, packet):
+        """ Handles decoded packet records as they are received. """
 
-        count = 0
-        direction = PacketDirection.FORWARD
+        self.throughput.update(packet.length)
 
         if self.output_mode != 'flow':
-            if TLS not in packet:
-                return
-            if TLSApplicationData not in packet:
-                return
-            if len(packet[TLSApplicationData]) < 40:
-                # PING frame (len = 34) or other useless frames
+            if packet.app_data_length < MIN_APP_DATA_LENGTH:
+                # Not TLS application data, PING frame (len = 34) or other useless frames
                 return
 
         self.packets_count += 1
-        # Creates a key variable to check
-        packet_flow_key = get_packet_flow_key(packet, direction)
-        flow = self.flows.get((packet_flow_key, count))
+        metrics = self.metrics
+        if metrics is not None:
+            start = time.perf_counter()
+        # Both directions of a connection share one key, and the table holds its current generation
+        key = get_canonical_flow_key(packet)
+        flow = self.flows.get(key)
+
+        if flow is not None and (packet.time - flow.latest_timestamp) > EXPIRED_UPDATE:
+            # If the packet is sent after too much of a delay then it is a part of a new flow,
+            # oriented by this packet just as if the garbage collection had removed the old one first
+            self.expire_flow(key)
+            flow = None
+            if metrics is not None:
+                start = time.perf_counter()  # the export has stages of its own
 
-        # If there is no forward flow with a count of 0
         if flow is None:
-            # There might be one of it in reverse
+            direction = PacketDirection.FORWARD
+            flow = self.create_flow(packet, direction)
+            self.flows[key] = flow
+        elif packet.src_port == flow.src_port and packet.src_ip == flow.src_ip:
+            direction = PacketDirection.FORWARD
+        else:
             direction = PacketDirection.REVERSE
-            packet_flow_key = get_packet_flow_key(packet, direction)
-            flow = self.flows.get((packet_flow_key, count))
-            if flow is None:
-                # If no flow exists create a new flow
-                direction = PacketDirection.FORWARD
-                flow = Flow(packet, direction)
-                packet_flow_key = get_packet_flow_key(packet, direction)
-                self.flows[(packet_flow_key, count)] = flow
-
-            elif (packet.time - flow.latest_timestamp) > EXPIRED_UPDATE:
-                # If the packet exists in the flow but the packet is sent
-                # after too much of a delay than it is a part of a new flow.
-                expired = EXPIRED_UPDATE
-                while (packet.time - flow.latest_timestamp) > expired:
-                    count += 1
-                    expired += EXPIRED_UPDATE
-                    flow = self.flows.get((packet_flow_key, count))
-                    if flow is None:
-                        flow = Flow(packet, direction)
-                        self.flows[(packet_flow_key, count)] = flow
-                        break
-
-        elif (packet.time - flow.latest_timestamp) > EXPIRED_UPDATE:
-            expired = EXPIRED_UPDATE
-            while (packet.time - flow.latest_timestamp) > expired:
-                count += 1
-                expired += EXPIRED_UPDATE
-                flow = self.flows.get((packet_flow_key, count))
-                if flow is None:
-                    flow = Flow(packet, direction)
-                    self.flows[(packet_flow_key, count)] = flow
-                    break
-
-        flow.add_packet(packet, direction)
-        if self.packets_count % 10000 == 0 or (flow.duration > 120 and self.output_mode == 'flow'):
-            print('Packet count: {}'.format(self.packets_count))
+
+        if metrics is not None:
+            looked_up = time.perf_counter()
+            metrics.stage_seconds['flow_lookup'] += looked_up - start
+        finished = flow.add_packet(packet, direction)
+        if metrics is not None:
+            metrics.stage_seconds['clumping'] += time.perf_counter() - looked_up
+        if finished is not None and self.output_mode == 'inference':
+            self.classifier.add_clump(flow, finished)
+        if self.output_mode == 'flow' and flow.duration > ACTIVE_TIMEOUT:
+            # Cut long flows on the packet that passes the active timeout, so that where a flow
+            # ends does not depend on when the garbage collection happens to run
+            self.expire_flow(key)
+        else:
+            self.schedule_expiry(key, flow)
+        if self.packets_count % 10000 == 0:
             self.garbage_collect(packet.time)
 
 
+    def create_flow(self, packet, direction) -> Flow:
+        """ Creates a flow for the packet, clumping it incrementally in inference mode and in sequence
+            mode when enabled, and accumulating online statistics in flow mode when enabled.
+            The flow is labelled against the session's resolvers. """
+        return Flow(packet, direction,
+                    incremental_clumps=self.output_mode == 'inference' or (self.output_mode == 'sequence' and
+                                                                           self.clumping == 'incremental'),
+                    online_statistics=self.output_mode == 'flow' and self.sketch_size > 0,
+                    sketch_size=self.sketch_size,
+                    resolvers=self.resolvers)
+
+
+    def expiry_deadline(self, flow) -> float:
+        """ Returns the time after which the flow expires, when it idled for EXPIRED_UPDATE. """
+        return flow.latest_timestamp + EXPIRED_UPDATE
+
+
+    def schedule_expiry(self, key, flow) -> None:
+        """ Indexes a new flow by its deadline. A deadline that moved later because of new packets
+            is only caught up with when its entry is popped, so a busy flow costs one heap
+            operation per EXPIRED_UPDATE. """
+        if key not in self.expiry_schedule:
+            deadline = self.expiry_deadline(flow)
+            entry = (deadline, next(self.expiry_sequence))
+            self.expiry_schedule[key] = entry
+            heapq.heappush(self.expiry_heap, (*entry, key))
+
+
+    def pop_expired(self, latest_time) -> list:
+        """ Returns the keys of the flows expired at latest_time, touching only the heap entries
+            whose deadline passed. """
+        expired = []
+        while self.expiry_heap and self.expiry_heap[0][0] < latest_time:
+            deadline, sequence, key = heapq.heappop(self.expiry_heap)
+            if self.expiry_schedule.get(key) != (deadline, sequence):
+                continue  # stale entry
+            del self.expiry_schedule[key]
+            flow = self.flows[key]
+            if self.expiry_deadline(flow) < latest_time:
+                expired.append(key)
+            else:
+                self.schedule_expiry(key, flow)
+        return expired
+
+
+    def close(self) -> None:
+        """ Writes out the remaining flows and closes the output. """
+        self.garbage_collect(None)
+        if self.export_stage is not None:
+            self.export_stage.close()
+        if self.output_mode == 'flow':
+            self.output.close()
+        elif self.output_mode == 'inference':
+            self.classifier.close()
+        else:
+            self.sequence_writer.close()
+
+
     def get_flows(self) -> list:
         """ Returns the list of current flows. """
         return self.flows.values()
@@ -107,36 +207,121 @@ class FlowSession(DefaultSession):
     def garbage_collect(self, latest_time) -> None:
         """ Cleans up old or expired flows.
             Writes flow data and deletes flows that have been processed. """
-        
-        print('Garbage Collection Began. Flows = {}'.format(len(self.flows)))
-        keys = list(self.flows.keys())
+        start = time.perf_counter()
+        if latest_time is None:
+            keys = list(self.flows.keys())
+            self.expiry_heap = []
+            self.expiry_schedule = {}
+        else:
+            keys = self.pop_expired(latest_time)
         for k in keys:
-            flow = self.flows.get(k)
-            if self.output_mode == 'flow':
-                if latest_time is None or latest_time - flow.latest_timestamp > EXPIRED_UPDATE or flow.duration > 90:
-                    data = flow.get_data()
-                    if self.csv_line == 0:
-                        self.csv_writer.writerow(data.keys())
-                    self.csv_writer.writerow(data.values())
-                    self.csv_line += 1
-                    del self.flows[k]
-            else:
-                if latest_time is None or latest_time - flow.latest_timestamp > EXPIRED_UPDATE:
-                    output_dir = os.path.join(self.output_file, 'doh' if flow.is_doh() else 'ndoh')
-                    os.makedirs(output_dir, exist_ok=True)
-                    proc = Processor(flow)
-                    flow_clumps = proc.create_flow_clumps_container()
-                    flow_clumps.to_json_file(output_dir)
-                    del self.flows[k]
-        print('Garbage Collection Finished. Flows = {}'.format(len(self.flows)))
-
-
-    def generate_session_class(output_mode, output_file):
-        """ Generates a new session class with specified output_mode and output_file. """
+            self.finish_flow(self.flows.pop(k))
+        if self.export_stage is not None:
+            self.export_stage.flush()
+        elif self.output_mode == 'sequence':
+            self.sequence_writer.flush()
+        if self.metrics is not None:
+            self.metrics.histogram('gc_seconds').observe(time.perf_counter() - start)
+
+
+    def expire_flow(self, key) -> None:
+        """ Removes a flow from the table and writes it out. """
+        self.expiry_schedule.pop(key, None)
+        self.finish_flow(self.flows.pop(key))
+
+
+    def finish_flow(self, flow) -> None:
+        """ Exports a flow removed from the table, or hands it to the export stage when there is one. """
+        if self.export_stage is not None:
+            self.export_stage.submit(flow)
+        else:
+            self.export_flow(flow)
+
+
+    def export_flow(self, flow) -> None:
+        """ Writes the features (flow mode) or clumps (sequence mode) of a finished flow, or hands its
+            last clumps to the classifier (inference mode). """
+        if self.metrics is None:
+            self.write_output(flow_output(self.output_mode, flow))
+        else:
+            self.write_timed_output(timed_flow_output(self.output_mode, flow))
+
+
+    def write_output(self, output) -> None:
+        """ Writes the flow_output of a flow. """
+        if self.output_mode == 'flow':
+            if self.csv_line == 0:
+                self.bytes_written += self.csv_writer.writerow(output.keys())
+            self.bytes_written += self.csv_writer.writerow(output.values())
+            self.csv_line += 1
+        elif self.output_mode == 'inference':
+            self.classifier.finish_flow(*output)
+        else:
+            self.sequence_writer.write(*output)
+
+
+    def write_timed_output(self, timed_output) -> None:
+        """ Writes the output of timed_flow_output, recording the time spent computing and writing it. """
+        output, seconds = timed_output
+        start = time.perf_counter()
+        self.write_output(output)
+        elapsed = time.perf_counter() - start
+        self.metrics.add('flows_exported')
+        self.metrics.stage_seconds['features'] += seconds
+        self.metrics.stage_seconds['output'] += elapsed
+        self.metrics.histogram('features_seconds').observe(seconds)
+        self.metrics.histogram('output_seconds').observe(elapsed)
+
+
+    def generate_session_class(output_mode, output_file, clumping='incremental', sketch_size=0,
+                               json_shards=DEFAULT_SHARDS, compress=False, file_prefix='part', sequence_format='jsonl',
+                               classifier=None, resolvers=DEFAULT_RESOLVERS, export_workers=0, export_executor='thread',
+                               export_ordered=True, metrics=None):
+        """ Generates a new session class with specified output_mode, output_file, clumping mode
+            and online statistics sketch size (0 keeps the packets and computes exact statistics).
+            In sequence mode, the sequences are appended to json_shards JSON Lines files per label,
+            gzip compressed if `compress`, or with sequence_format 'npy' to a pair of clump and
+            offset arrays per label, in both cases named after file_prefix.
+            In inference mode, the clumps of every flow are passed to `classifier` as they are finished
+            (add_clump), then with the flow's last clumps when it ends (finish_flow); see analyzer/realtime.py.
+            Flows are labelled DoH when an endpoint matches `resolvers`, a ResolverList.
+            With export_workers > 0, expired flows are only unlinked from the table on the packet path and
+            handed to an ExportStage: a pool of export_workers threads or processes (export_executor) computes
+            their output in batches and a writer thread writes it, in expiry order if export_ordered.
+            The session updates `metrics`, a metrics.Metrics, when given. """
         return type('NewFlowSession', (FlowSession,), {
             'output_mode': output_mode,
             'output_file': output_file,
+            'clumping': clumping,
+            'sketch_size': sketch_size,
+            'json_shards': json_shards,
+            'compress': compress,
+            'file_prefix': file_prefix,
+            'sequence_format': sequence_format,
+            'classifier': classifier,
+            'resolvers': resolvers,
+            'export_workers': export_workers,
+            'export_executor': export_executor,
+            'export_ordered': export_ordered,
+            'metrics': metrics,
         })
-    
 
-    
\ No newline at end of file
+
+def flow_output(output_mode, flow):
+    """ Computes what is written of a finished flow: its features (flow mode), the label, clumps and
+        connection of its sequence (sequence mode), or the flow, its last clumps and its label (inference mode). """
+    label = 'doh' if flow.is_doh() else 'ndoh'
+    if output_mode == 'flow':
+        return flow.get_data()
+    if output_mode == 'inference':
+        return flow, flow.clump_builder.finish(), label
+    sequence, _ = Processor(flow).create_flow_clumps_container().output()
+    connection = '{}_{}-{}_{}'.format(flow.src_ip, flow.src_port, flow.dest_ip, flow.dest_port)
+    return label, sequence, connection
+
+
+def timed_flow_output(output_mode, flow) -> tuple:
+    """ Returns the flow_output of a flow and the seconds it took. """
+    start = time.perf_counter()
+    output = flow_output(output_mode, flow)
+    return output, time.perf_counter() - start
@@ -0,0 +1,245 @@
+import json
+import multiprocessing
+import sys
+import threading
+import time
+from bisect import bisect_left
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from queue import Empty
+
+STAGES = ('dissection', 'flow_lookup', 'clumping', 'features', 'output')
+HISTOGRAM_BUCKETS = (1e-5, 1e-4, 1e-3, 1e-2, 0.1, 1.0, 10.0)  # seconds
+REPORT_INTERVAL = 10.0
+PROMETHEUS_PREFIX = 'dohlyzer_'
+
+
+class Histogram:
+    """ Counts observations per bucket: counts[i] holds the values up to buckets[i] and above
+        buckets[i - 1], counts[-1] those above the last bucket. """
+
+    def __init__(self, buckets=HISTOGRAM_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.lock = threading.Lock()  # export stage threads observe concurrently
+
+    def observe(self, value) -> None:
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return {'buckets': list(self.buckets), 'counts': list(self.counts), 'sum': self.sum}
+
+
+class Metrics:
+    """ Counters, histograms and gauges of an extraction, updated by the pipeline when enabled.
+        The seconds spent in each of STAGES are counted per packet (dissection, flow_lookup, clumping,
+        where clumping stands for adding the packet to its flow, online statistics included) or per
+        flow (features, output, also observed as histograms, as is the duration of each garbage
+        collection). Gauges are functions read when a snapshot is taken.
+        Worker processes keep their own Metrics and send snapshots through worker_queue() every
+        `interval` seconds, which snapshot() adds to the totals of this process. """
+
+    def __init__(self, interval=REPORT_INTERVAL):
+        self.interval = interval
+        self.counters = defaultdict(int)
+        self.stage_seconds = dict.fromkeys(STAGES, 0.0)
+        self.histograms = {}
+        self.gauges = {}
+        self.children = {}  # latest snapshot of each worker process
+        self.queue = None
+        self.lock = threading.Lock()
+
+    def add(self, name, value=1) -> None:
+        self.counters[name] += value
+
+    def histogram(self, name) -> Histogram:
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = Histogram()
+        return histogram
+
+    def gauge(self, name, function) -> None:
+        self.gauges[name] = function
+
+    def read(self, records):
+        """ Yields the PacketRecords of an iterable such as read_records, counting them, their bytes and
+            the time spent reading and decoding them as dissection. """
+        iterator = iter(records)
+        counters, stage_seconds = self.counters, self.stage_seconds
+        while True:
+            start = time.perf_counter()
+            try:
+                record = next(iterator)
+            except StopIteration:
+                return
+            stage_seconds['dissection'] += time.perf_counter() - start
+            counters['packets'] += 1
+            counters['bytes'] += record.length
+            yield record
+
+    def decode(self, decoder, *args):
+        """ Returns decoder(*args), a PacketRecord or None, counting the record, its bytes and the time
+            spent as dissection. """
+        start = time.perf_counter()
+        record = decoder(*args)
+        self.stage_seconds['dissection'] += time.perf_counter() - start
+        if record is not None:
+            self.counters['packets'] += 1
+            self.counters['bytes'] += record.length
+        return record
+
+    def worker_queue(self):
+        """ Returns the queue worker processes send their snapshots to, created on first use. """
+        if self.queue is None:
+            self.queue = multiprocessing.Queue()
+        return self.queue
+
+    def local_snapshot(self) -> dict:
+        # Copies of the dicts are taken at once, while the pipeline keeps updating them
+        return {'counters': dict(self.counters),
+                'stages': dict(self.stage_seconds),
+                'histograms': {name: histogram.snapshot() for name, histogram in list(self.histograms.items())},
+                'gauges': {name: function() for name, function in list(self.gauges.items())}}
+
+    def snapshot(self) -> dict:
+        """ Returns the totals of this process and of its workers: counters, stage seconds, histograms
+            and gauges are summed. """
+        with self.lock:
+            while self.queue is not None:
+                try:
+                    worker, snapshot = self.queue.get_nowait()
+                except Empty:
+                    break
+                self.children[worker] = snapshot
+            children = list(self.children.values())
+        total = self.local_snapshot()
+        for child in children:
+            for section in ('counters', 'stages', 'gauges'):
+                for name, value in child[section].items():
+                    total[section][name] = total[section].get(name, 0) + value
+            for name, histogram in child['histograms'].items():
+                merged = total['histograms'].setdefault(name, dict(histogram, counts=[0] * len(histogram['counts']),
+                                                                   sum=0.0))
+                merged['counts'] = [a + b for a, b in zip(merged['counts'], histogram['counts'])]
+                merged['sum'] += histogram['sum']
+        return total
+
+
+class WorkerMetrics(Metrics):
+    """ The Metrics of a worker process, sent to the parent's worker_queue() by a thread every
+        `interval` seconds, and a last time by close(). """
+
+    def __init__(self, queue, worker, interval=REPORT_INTERVAL):
+        super(WorkerMetrics, self).__init__(interval)
+        self.parent_queue = queue
+        self.worker = worker
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, name='metrics', daemon=True)
+        self.thread.start()
+
+    def _run(self) -> None:
+        while not self.stopped.wait(self.interval):
+            self.parent_queue.put((self.worker, self.local_snapshot()))
+
+    def close(self) -> None:
+        self.stopped.set()
+        self.thread.join()
+        self.parent_queue.put((self.worker, self.local_snapshot()))
+
+
+def prometheus_text(snapshot) -> str:
+    """ Renders a snapshot in the Prometheus text exposition format. """
+    lines = []
+    for name, value in sorted(snapshot['counters'].items()):
+        lines += ['# TYPE {}{}_total counter'.format(PROMETHEUS_PREFIX, name),
+                  '{}{}_total {}'.format(PROMETHEUS_PREFIX, name, value)]
+    lines.append('# TYPE {}stage_seconds_total counter'.format(PROMETHEUS_PREFIX))
+    for stage, value in snapshot['stages'].items():
+        lines.append('{}stage_seconds_total{{stage="{}"}} {}'.format(PROMETHEUS_PREFIX, stage, value))
+    for name, value in sorted(snapshot['gauges'].items()):
+        lines += ['# TYPE {}{} gauge'.format(PROMETHEUS_PREFIX, name), '{}{} {}'.format(PROMETHEUS_PREFIX, name, value)]
+    for name, histogram in sorted(snapshot['histograms'].items()):
+        metric = PROMETHEUS_PREFIX + name
+        lines.append('# TYPE {} histogram'.format(metric))
+        cumulative = 0
+        for bound, count in zip(list(histogram['buckets']) + ['+Inf'], histogram['counts']):
+            cumulative += count
+            lines.append('{}_bucket{{le="{}"}} {}'.format(metric, bound, cumulative))
+        lines += ['{}_sum {}'.format(metric, histogram['sum']), '{}_count {}'.format(metric, cumulative)]
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsReporter:
+    """ Publishes the snapshots of a Metrics: as a JSON line every metrics.interval seconds and when closed,
+        to `output` ('-' for stdout), with the packets/s and bytes/s since the previous line, and/or
+        in the Prometheus text format at http://127.0.0.1:<port>/metrics. """
+
+    def __init__(self, metrics, output=None, port=None):
+        self.metrics = metrics
+        self.interval = metrics.interval
+        self.output = None
+        if output is not None:
+            self.output = sys.stdout if output == '-' else open(output, 'a')
+        self.server = None
+        if port is not None:
+            self.server = ThreadingHTTPServer(('127.0.0.1', port), _handler(metrics))
+            self.server.daemon_threads = True
+            threading.Thread(target=self.server.serve_forever, name='metrics-http', daemon=True).start()
+        self.stopped = threading.Event()
+        self.previous = (time.monotonic(), 0, 0)
+        self.thread = None
+        if self.output is not None:
+            self.thread = threading.Thread(target=self._run, name='metrics', daemon=True)
+            self.thread.start()
+
+    def _run(self) -> None:
+        while not self.stopped.wait(self.interval):
+            self.write()
+
+    def write(self) -> None:
+        snapshot = self.metrics.snapshot()
+        now = time.monotonic()
+        packets, size = snapshot['counters'].get('packets', 0), snapshot['counters'].get('bytes', 0)
+        then, previous_packets, previous_size = self.previous
+        elapsed = max(now - then, 1e-9)
+        self.previous = (now, packets, size)
+        line = dict(snapshot, time=time.time(), packets_per_second=(packets - previous_packets) / elapsed,
+                    bytes_per_second=(size - previous_size) / elapsed)
+        self.output.write(json.dumps(line) + '\n')
+        self.output.flush()
+
+    def close(self) -> None:
+        """ Writes the final totals and stops publishing. """
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.write()
+            if self.output is not sys.stdout:
+                self.output.close()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+
+
+def _handler(metrics):
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = prometheus_text(metrics.snapshot()).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass  # no line per scrape
+
+    return MetricsHandler
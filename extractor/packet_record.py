@@ -0,0 +1,168 @@
+import socket
+import struct
+
+from scapy.layers.inet import IP, TCP, UDP
+from scapy.layers.inet6 import IPv6
+from scapy.layers.tls.record import TLSApplicationData
+
+LINKTYPE_NULL = 0
+LINKTYPE_ETHERNET = 1
+LINKTYPE_RAW = 101
+LINKTYPE_LOOP = 108
+LINKTYPE_LINUX_SLL = 113
+LINKTYPE_IPV4 = 228
+LINKTYPE_IPV6 = 229
+LINKTYPE_LINUX_SLL2 = 276
+
+ETHERTYPE_IPV4 = 0x0800
+ETHERTYPE_IPV6 = 0x86dd
+ETHERTYPE_VLAN = (0x8100, 0x88a8, 0x9100)
+
+IPV6_EXTENSION_HEADERS = (0, 43, 60)
+IPV6_FRAGMENT = 44
+IPV6_AUTHENTICATION = 51
+
+PROTOCOLS = {6: 'TCP', 17: 'UDP'}
+
+TLS_CONTENT_TYPES = (20, 21, 22, 23, 24)
+TLS_APPLICATION_DATA = 23
+
+_u16 = struct.Struct('!H')
+_u32 = struct.Struct('<I')
+_ports = struct.Struct('!HH')
+
+
+class PacketRecord:
+    """ The fields of a packet the extractor actually uses, independent of how it was decoded. """
+
+    __slots__ = ('time', 'src_ip', 'dst_ip', 'src_port', 'dst_port', 'protocol', 'length', 'app_data_length', 'ttl')
+
+    def __init__(self, time, src_ip, dst_ip, src_port, dst_port, protocol, length, app_data_length, ttl=-1):
+        self.time = time
+        self.src_ip = src_ip
+        self.dst_ip = dst_ip
+        self.src_port = src_port
+        self.dst_port = dst_port
+        self.protocol = protocol
+        self.length = length
+        self.app_data_length = app_data_length  # length of the first TLS application data record, 0 if none
+        self.ttl = ttl  # IPv4 TTL or IPv6 hop limit, -1 if unknown
+
+    def __len__(self):
+        return self.length
+
+    def __reduce__(self):
+        # Pickled as a plain tuple of fields, which keeps batches sent between processes small
+        return PacketRecord, (self.time, self.src_ip, self.dst_ip, self.src_port, self.dst_port, self.protocol,
+                              self.length, self.app_data_length, self.ttl)
+
+    @classmethod
+    def from_scapy(cls, packet):
+        """ Builds a record from a dissected scapy packet.
+            Returns None for packets that are not TCP/UDP over IP. """
+        if IP in packet:
+            ip = packet[IP]
+            ttl = ip.ttl
+        elif IPv6 in packet:
+            ip = packet[IPv6]
+            ttl = ip.hlim
+        else:
+            return None
+        if TCP in packet:
+            protocol = 'TCP'
+            transport = packet[TCP]
+        elif UDP in packet:
+            protocol = 'UDP'
+            transport = packet[UDP]
+        else:
+            return None
+        app_data_length = len(packet[TLSApplicationData]) if TLSApplicationData in packet else 0
+        return cls(float(packet.time), ip.src, ip.dst, transport.sport, transport.dport, protocol,
+                   packet.wirelen or len(packet), app_data_length, ttl)
+
+
+def decode_frame(timestamp, linktype, data, wirelen):
+    """ Decodes a raw link-layer frame into a PacketRecord using only struct unpacking.
+        Returns None for frames that are not TCP/UDP over IPv4/IPv6 or are truncated before the ports. """
+    try:
+        offset, network = _link_layer(linktype, data)
+        if network == ETHERTYPE_IPV4:
+            header_length = (data[offset] & 0x0f) * 4
+            if _u16.unpack_from(data, offset + 6)[0] & 0x1fff:
+                # Non-first fragment, no transport header
+                return None
+            total_length = _u16.unpack_from(data, offset + 2)[0]
+            # A zero total length is left by TCP segmentation offload, fall back to the captured length
+            end = offset + total_length if total_length else len(data)
+            ttl = data[offset + 8]
+            number = data[offset + 9]
+            src_ip = socket.inet_ntoa(data[offset + 12:offset + 16])
+            dst_ip = socket.inet_ntoa(data[offset + 16:offset + 20])
+            offset += header_length
+        elif network == ETHERTYPE_IPV6:
+            end = offset + 40 + _u16.unpack_from(data, offset + 4)[0]
+            number = data[offset + 6]
+            ttl = data[offset + 7]
+            src_ip = socket.inet_ntop(socket.AF_INET6, data[offset + 8:offset + 24])
+            dst_ip = socket.inet_ntop(socket.AF_INET6, data[offset + 24:offset + 40])
+            offset += 40
+            while number in IPV6_EXTENSION_HEADERS or number == IPV6_AUTHENTICATION:
+                if number == IPV6_AUTHENTICATION:
+                    length = (data[offset + 1] + 2) * 4
+                else:
+                    length = (data[offset + 1] + 1) * 8
+                number = data[offset]
+                offset += length
+            if number == IPV6_FRAGMENT:
+                return None
+        else:
+            return None
+
+        protocol = PROTOCOLS.get(number)
+        if protocol is None:
+            return None
+        src_port, dst_port = _ports.unpack_from(data, offset)
+        app_data_length = 0
+        if protocol == 'TCP':
+            payload = offset + (data[offset + 12] >> 4) * 4
+            app_data_length = _tls_application_data_length(data, payload, min(end, len(data)))
+    except (IndexError, struct.error):
+        return None
+    return PacketRecord(timestamp, src_ip, dst_ip, src_port, dst_port, protocol, wirelen, app_data_length, ttl)
+
+
+def _link_layer(linktype, data):
+    """ Returns the offset of the network header and its ethertype. """
+    if linktype == LINKTYPE_ETHERNET:
+        offset = 12
+        ethertype = _u16.unpack_from(data, offset)[0]
+        while ethertype in ETHERTYPE_VLAN:
+            offset += 4
+            ethertype = _u16.unpack_from(data, offset)[0]
+        return offset + 2, ethertype
+    if linktype in (LINKTYPE_NULL, LINKTYPE_LOOP):
+        family = _u32.unpack_from(data)[0]
+        if family > 0xffff:
+            family = struct.unpack_from('>I', data)[0]
+        return 4, ETHERTYPE_IPV4 if family == socket.AF_INET else ETHERTYPE_IPV6
+    if linktype == LINKTYPE_LINUX_SLL:
+        return 16, _u16.unpack_from(data, 14)[0]
+    if linktype == LINKTYPE_LINUX_SLL2:
+        return 20, _u16.unpack_from(data, 0)[0]
+    if linktype in (LINKTYPE_RAW, LINKTYPE_IPV4, LINKTYPE_IPV6):
+        return 0, ETHERTYPE_IPV4 if data[0] >> 4 == 4 else ETHERTYPE_IPV6
+    return 0, None
+
+
+def _tls_application_data_length(data, offset, end):
+    """ Walks the TLS record headers at the start of a TCP payload and returns the length of the
+        first application data record (0 if the payload does not start with a TLS record). """
+    while offset + 5 <= end:
+        content_type = data[offset]
+        if content_type not in TLS_CONTENT_TYPES or data[offset + 1] != 3:
+            return 0
+        length = _u16.unpack_from(data, offset + 3)[0]
+        if content_type == TLS_APPLICATION_DATA:
+            return length
+        offset += 5 + length
+    return 0
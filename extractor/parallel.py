@@ -0,0 +1,487 @@
+import csv
+import glob
+import gzip
+import hashlib
+import json
+import multiprocessing
+import os
+import shutil
+import signal
+import sys
+import threading
+import time
+from queue import Full
+
+import numpy as np
+
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(project_root)
+
+from features.context.packet_key import get_canonical_flow_key
+from flow_session import FlowSession, MIN_APP_DATA_LENGTH
+from metrics import WorkerMetrics
+from packet_record import PacketRecord
+from pcap_stream import read_records
+from time_series.clump_arrays import OFFSETS_DTYPE, ROW_FIELDS, ROWS_DTYPE
+from utils import Throughput
+
+BATCH_SIZE = 2048
+QUEUE_BATCHES = 16  # per worker, bounds the memory held by the reader when a worker falls behind
+PUT_TIMEOUT = 1.0  # seconds between two checks that the worker of a full queue is still alive
+CAPTURE_EXTENSIONS = ('.pcap', '.pcapng', '.cap')
+MANIFEST_FILE = 'manifest.jsonl'
+ONLINE_BATCH_SIZE = 256
+ONLINE_QUEUE_SIZE = 65536  # records per worker
+FLUSH_INTERVAL = 0.1  # seconds a partial batch may wait for more records
+STATISTICS_INTERVAL = 10.0
+BACKPRESSURE_POLICIES = ('block', 'drop')
+
+
+def extract_sharded(input_file, output_mode, output_file, workers, decoder='raw', metrics=None, **session_options):
+    """ Extracts the flows of a capture with `workers` processes. This process reads and decodes
+        the packets and sends each one to the worker picked by the hash of its connection, so both
+        directions of a connection always meet in the same FlowSession. In flow mode the workers
+        write part files that are merged into `output_file`; in sequence mode the workers write
+        their own shards in the output directory. session_options are passed to
+        FlowSession.generate_session_class. The workers send their `metrics` to this process.
+        Raises RuntimeError if a worker fails; the other workers are then terminated. """
+    parts = [worker_output(output_mode, output_file, index) for index in range(workers)]
+    queues = [multiprocessing.Queue(QUEUE_BATCHES) for _ in range(workers)]
+    metrics_queue = metrics.worker_queue() if metrics is not None else None
+    processes = [multiprocessing.Process(target=_run_worker, name='part{}'.format(index),
+                                         args=(queue, output_mode, part, 'part{}'.format(index), session_options,
+                                               metrics_queue, metrics and metrics.interval))
+                 for index, (queue, part) in enumerate(zip(queues, parts))]
+    for process in processes:
+        process.start()
+
+    throughput = Throughput()
+    batches = [[] for _ in range(workers)]
+    try:
+        records = read_records(input_file, decoder)
+        for record in records if metrics is None else metrics.read(records):
+            throughput.update(record.length)
+            if output_mode != 'flow' and record.app_data_length < MIN_APP_DATA_LENGTH:
+                # Dropped by the session anyway, no need to send it
+                continue
+            # The hash is only computed in this process, so string hash randomization does not matter
+            shard = hash(get_canonical_flow_key(record)) % workers
+            batch = batches[shard]
+            batch.append(record)
+            if len(batch) == BATCH_SIZE:
+                put_to_worker(queues[shard], batch, processes[shard])
+                batches[shard] = []
+
+        for queue, batch, process in zip(queues, batches, processes):
+            if batch:
+                put_to_worker(queue, batch, process)
+            put_to_worker(queue, None, process)
+    except BaseException:
+        stop_workers(processes, queues)
+        raise
+    join_workers(processes, metrics)
+    throughput.report()
+
+    failed = [index for index, process in enumerate(processes) if process.exitcode != 0]
+    if failed:
+        stop_workers(processes, queues)  # the batches a failed worker left in its queue are dropped
+        raise RuntimeError('Extraction workers {} failed.'.format(failed))
+    if output_mode == 'flow':
+        merge_csv(parts, output_file)
+        for part in parts:
+            os.remove(part)
+
+
+def worker_output(output_mode, output_file, index) -> str:
+    """ Returns where a worker writes: its own part file in flow mode, the shared directory otherwise. """
+    if output_mode == 'flow':
+        return '{}.part{}'.format(output_file, index)
+    return output_file
+
+
+def put_to_worker(queue, item, process) -> None:
+    """ Puts an item on the queue of a worker, waiting while the queue is full, unless the worker
+        has died: a RuntimeError is raised then rather than waiting forever. """
+    while True:
+        try:
+            queue.put(item, timeout=PUT_TIMEOUT)
+            return
+        except Full:
+            check_worker(process)
+
+
+def check_worker(process) -> None:
+    """ Raises a RuntimeError if a worker process has died. """
+    if not process.is_alive():
+        raise RuntimeError('Extraction worker {} failed (exit code {}).'.format(process.name, process.exitcode))
+
+
+def stop_workers(processes, queues) -> None:
+    """ Terminates the workers after an error, without waiting to flush what is left in their queues. """
+    for queue in queues:
+        queue.cancel_join_thread()
+    for process in processes:
+        process.terminate()
+    for process in processes:
+        process.join()
+
+
+def join_workers(processes, metrics=None) -> None:
+    """ Waits for worker processes, taking in their metrics meanwhile: a process does not exit
+        before the data it queued is read. """
+    for process in processes:
+        while process.is_alive():
+            if metrics is not None:
+                metrics.snapshot()
+            process.join(0.5)
+
+
+def _run_worker(queue, output_mode, output_file, file_prefix, session_options, metrics_queue=None,
+                metrics_interval=None):
+    """ Feeds the batches of records of one shard to a FlowSession until the None sentinel,
+        sending its metrics to metrics_queue every metrics_interval seconds when given. """
+    metrics = WorkerMetrics(metrics_queue, file_prefix, metrics_interval) if metrics_queue is not None else None
+    session = FlowSession.generate_session_class(output_mode, output_file, file_prefix=file_prefix,
+                                                 metrics=metrics, **session_options)()
+    session.throughput.interval = 0  # the reader reports the throughput of the whole capture
+    for batch in iter(queue.get, None):
+        for record in batch:
+            session.on_record_received(record)
+    session.close()
+    if metrics is not None:
+        metrics.close()
+
+
+class OnlinePipeline:
+    """ Extracts the flows of a live capture with `workers` processes, so that the capture thread only
+        decodes packets into records and queues them. Records are sent in batches to the worker picked
+        by the hash of their connection, as in extract_sharded, through a bounded queue of queue_size
+        records per worker; each worker runs a FlowSession whose flows are exported by an ExportStage
+        (of at least one thread).
+        When a queue is full, the 'block' backpressure policy waits for the worker (and the kernel drops
+        packets if the capture falls behind), the 'drop' policy drops the batch and counts its records.
+        A timer thread sends the partial batches every FLUSH_INTERVAL seconds, checks the workers and
+        reports the queue depth and high-water mark every STATISTICS_INTERVAL seconds, also while no packet
+        arrives. If a worker dies, the timer calls on_failure (the sniffer sets it to stop the capture) and
+        the pipeline raises a RuntimeError rather than waiting for it.
+        With `metrics`, the queues are reported as gauges and the workers send their metrics to this process.
+        Has the on_packet_received/on_record_received/close interface of a FlowSession. """
+
+    def __init__(self, output_mode, output_file, workers=1, queue_size=ONLINE_QUEUE_SIZE, backpressure='block',
+                 metrics=None, **session_options):
+        if backpressure not in BACKPRESSURE_POLICIES:
+            raise ValueError('unknown backpressure policy: {}'.format(backpressure))
+        self.output_mode = output_mode
+        self.output_file = output_file
+        self.block = backpressure == 'block'
+        self.parts = [worker_output(output_mode, output_file, index) for index in range(workers)]
+        self.capacity = max(1, queue_size // ONLINE_BATCH_SIZE)  # in batches
+        self.queues = [multiprocessing.Queue(self.capacity) for _ in range(workers)]
+        options = dict(session_options, export_workers=session_options.get('export_workers') or 1)
+        self.metrics = metrics
+        metrics_queue = metrics.worker_queue() if metrics is not None else None
+        self.processes = [multiprocessing.Process(target=_run_online_worker, name='part{}'.format(index),
+                                                  args=(queue, output_mode, part, 'part{}'.format(index), options,
+                                                        metrics_queue, metrics and metrics.interval))
+                          for index, (queue, part) in enumerate(zip(self.queues, self.parts))]
+        for process in self.processes:
+            process.start()
+        self.batches = [[] for _ in range(workers)]
+        self.high_water = [0] * workers  # in batches
+        self.enqueued = 0
+        self.dropped = 0
+        self.throughput = Throughput()
+        self.next_report = time.monotonic() + STATISTICS_INTERVAL
+        self.on_failure = None
+        self.lock = threading.Lock()  # the batches are sent by the capture thread and the timer
+        self.closing = threading.Event()
+        self.timer = threading.Thread(target=self._run_timer, name='pipeline-timer', daemon=True)
+        self.timer.start()
+        if metrics is not None:
+            metrics.gauge('queue_depth', lambda: sum(queue.qsize() for queue in self.queues))
+            metrics.gauge('queue_high_water', lambda: max(self.high_water))
+            metrics.gauge('records_dropped', lambda: self.dropped)
+
+    def on_packet_received(self, packet):
+        if self.metrics is None:
+            record = PacketRecord.from_scapy(packet)
+        else:
+            record = self.metrics.decode(PacketRecord.from_scapy, packet)
+        if record is not None:
+            self.on_record_received(record)
+
+    def on_record_received(self, record):
+        self.throughput.update(record.length)
+        if self.output_mode == 'flow' or record.app_data_length >= MIN_APP_DATA_LENGTH:
+            shard = hash(get_canonical_flow_key(record)) % len(self.queues)
+            with self.lock:
+                batch = self.batches[shard]
+                batch.append(record)
+                if len(batch) == ONLINE_BATCH_SIZE:
+                    self.send(shard)
+
+    def _run_timer(self) -> None:
+        while not self.closing.wait(FLUSH_INTERVAL):
+            try:
+                with self.lock:
+                    for shard, batch in enumerate(self.batches):
+                        if batch:
+                            self.send(shard)
+                    for process in self.processes:
+                        check_worker(process)
+            except RuntimeError:
+                # close() raises the error once the capture has stopped
+                if self.on_failure is not None:
+                    self.on_failure()
+                return
+            if time.monotonic() >= self.next_report:
+                self.report()
+                self.next_report = time.monotonic() + STATISTICS_INTERVAL
+
+    def send(self, shard, block=None) -> None:
+        """ Queues the pending batch of a shard, applying the backpressure policy unless `block` is given.
+            Raises a RuntimeError if the worker of the shard has died. """
+        batch = self.batches[shard]
+        self.batches[shard] = []
+        queue, process = self.queues[shard], self.processes[shard]
+        if self.block if block is None else block:
+            put_to_worker(queue, batch, process)
+        else:
+            try:
+                queue.put(batch, False)
+            except Full:
+                check_worker(process)
+                self.dropped += len(batch)
+                return
+        self.enqueued += len(batch)
+        self.high_water[shard] = max(self.high_water[shard], self.queues[shard].qsize())
+
+    def queue_metrics(self) -> dict:
+        """ Returns the depth and high-water mark of each worker queue, in batches of up to
+            ONLINE_BATCH_SIZE records, and the records enqueued and dropped since the start. """
+        return {'depth': [queue.qsize() for queue in self.queues], 'high_water': list(self.high_water),
+                'capacity': self.capacity, 'enqueued': self.enqueued, 'dropped': self.dropped}
+
+    def report(self) -> None:
+        print('Queues: depth {depth}, high water {high_water} of {capacity} batches; '
+              'records enqueued {enqueued}, dropped {dropped}'.format(**self.queue_metrics()))
+
+    def abort(self) -> None:
+        """ Stops the workers without waiting for their flows, when the capture could not start. """
+        self.closing.set()
+        self.timer.join()
+        stop_workers(self.processes, self.queues)
+
+    def close(self) -> None:
+        """ Sends the pending batches, waits for the workers to write out every flow and, in flow mode,
+            merges their part files into output_file. If a worker has died, the others are stopped
+            and a RuntimeError is raised. """
+        self.closing.set()
+        self.timer.join()
+        try:
+            for process in self.processes:
+                check_worker(process)
+            for shard, batch in enumerate(self.batches):
+                if batch:
+                    self.send(shard, block=True)
+            for queue, process in zip(self.queues, self.processes):
+                put_to_worker(queue, None, process)
+        except BaseException:
+            stop_workers(self.processes, self.queues)
+            raise
+        join_workers(self.processes, self.metrics)
+        self.throughput.report()
+        self.report()
+        failed = [index for index, process in enumerate(self.processes) if process.exitcode != 0]
+        if failed:
+            raise RuntimeError('Extraction workers {} failed.'.format(failed))
+        if self.output_mode == 'flow':
+            merge_csv(self.parts, self.output_file)
+            for part in self.parts:
+                os.remove(part)
+
+
+def _run_online_worker(queue, output_mode, output_file, file_prefix, session_options, metrics_queue=None,
+                       metrics_interval=None):
+    # Ctrl-C stops the capture in the parent, which then drains the queues, so the workers ignore it
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    _run_worker(queue, output_mode, output_file, file_prefix, session_options, metrics_queue, metrics_interval)
+
+
+def merge_csv(parts, output_file) -> None:
+    """ Concatenates CSV files under a single header. Files without any row are skipped. """
+    header = None
+    with open(output_file, 'w', newline='') as output:
+        writer = csv.writer(output)
+        for part in parts:
+            with open(part, newline='') as f:
+                reader = csv.reader(f)
+                part_header = next(reader, None)
+                if part_header is None:
+                    continue
+                if header is None:
+                    header = part_header
+                    writer.writerow(header)
+                writer.writerows(reader)
+
+
+def sort_csv(output_file) -> None:
+    """ Sorts the rows of a CSV file, keeping the header first, so that the output of a capture
+        is the same whatever the number of workers. """
+    with open(output_file, newline='') as f:
+        rows = list(csv.reader(f))
+    if not rows:
+        return
+    with open(output_file, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(rows[0])
+        writer.writerows(sorted(rows[1:]))
+
+
+def extract_batch(input_path, output_mode, output_dir, workers, decoder='raw', **session_options):
+    """ Extracts every capture of a directory or glob pattern with a pool of `workers` processes,
+        one capture per task. Each capture gets its own output under output_dir/parts, and every
+        finished capture is recorded in output_dir/manifest.jsonl, so a run that was interrupted
+        skips them when restarted. The outputs of all the captures are then merged into flows.csv
+        (flow mode), or doh.jsonl.gz and ndoh.jsonl.gz, or <label>.clumps.npy and <label>.offsets.npy
+        with sequence_format 'npy' (sequence mode). """
+    captures = list_captures(input_path)
+    parts_dir = os.path.join(output_dir, 'parts')
+    os.makedirs(parts_dir, exist_ok=True)
+    manifest_path = os.path.join(output_dir, MANIFEST_FILE)
+    completed = read_manifest(manifest_path)
+    outputs = {capture: part_output(parts_dir, capture, output_mode) for capture in captures}
+    jobs = [(capture, outputs[capture], output_mode, decoder, session_options) for capture in captures
+            if completed.get(capture) != capture_signature(capture)]
+    print('Captures: {}, already extracted: {}'.format(len(captures), len(captures) - len(jobs)))
+
+    if jobs:
+        with open(manifest_path, 'a') as manifest, multiprocessing.Pool(workers) as pool:
+            for done, (capture, signature) in enumerate(pool.imap_unordered(_extract_capture, jobs), 1):
+                manifest.write(json.dumps({'file': capture, 'signature': signature}) + '\n')
+                manifest.flush()
+                os.fsync(manifest.fileno())
+                print('[{}/{}] Extracted {}'.format(done, len(jobs), capture))
+
+    parts = [outputs[capture] for capture in captures]
+    if output_mode == 'flow':
+        merge_csv(parts, os.path.join(output_dir, 'flows.csv'))
+    elif session_options.get('sequence_format') == 'npy':
+        merge_clump_arrays(parts, output_dir)
+    else:
+        merge_sequences(parts, output_dir)
+
+
+def list_captures(input_path) -> list:
+    """ Returns the absolute paths of the captures of a directory, or of the files matching a glob. """
+    if os.path.isdir(input_path):
+        files = [os.path.join(input_path, f) for f in os.listdir(input_path) if f.endswith(CAPTURE_EXTENSIONS)]
+    else:
+        files = glob.glob(input_path)
+    return sorted(os.path.abspath(f) for f in files)
+
+
+def capture_signature(capture) -> list:
+    """ Size and modification time of a capture: a capture that changed is extracted again. """
+    stat = os.stat(capture)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def read_manifest(manifest_path) -> dict:
+    """ Returns the signature of every capture recorded in a manifest, the latest record winning.
+        A line cut short by a crash is ignored. """
+    completed = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                completed[entry['file']] = entry['signature']
+    return completed
+
+
+def part_output(parts_dir, capture, output_mode) -> str:
+    """ Returns the output of one capture, named after it and the hash of its path so that captures
+        with the same name in different directories do not collide. """
+    name = os.path.splitext(os.path.basename(capture))[0]
+    digest = hashlib.sha1(capture.encode()).hexdigest()[:8]
+    path = os.path.join(parts_dir, '{}-{}'.format(name, digest))
+    return path + '.csv' if output_mode == 'flow' else path
+
+
+def _extract_capture(job):
+    """ Extracts one capture into a temporary output that replaces the final one only when complete. """
+    capture, output, output_mode, decoder, session_options = job
+    signature = capture_signature(capture)
+    temporary = output + '.tmp'
+    _remove(temporary)
+    session = FlowSession.generate_session_class(output_mode, temporary, **session_options)()
+    session.throughput.interval = 0
+    for record in read_records(capture, decoder):
+        session.on_record_received(record)
+    session.close()
+    if output_mode != 'flow':
+        os.makedirs(temporary, exist_ok=True)  # a capture without any flow
+    _remove(output)
+    os.replace(temporary, output)
+    return capture, signature
+
+
+def _remove(path):
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
+
+
+def merge_sequences(parts, output_dir) -> None:
+    """ Concatenates the sequence shards of every part into doh.jsonl.gz and ndoh.jsonl.gz. """
+    for label in ('doh', 'ndoh'):
+        count = 0
+        with gzip.open(os.path.join(output_dir, '{}.jsonl.gz'.format(label)), 'wt') as output:
+            for part in parts:
+                label_dir = os.path.join(part, label)
+                if not os.path.isdir(label_dir):
+                    continue
+                for name in sorted(os.listdir(label_dir)):
+                    path = os.path.join(label_dir, name)
+                    with (gzip.open(path, 'rt') if name.endswith('.gz') else open(path)) as f:
+                        for line in f:
+                            output.write(line)
+                            count += 1
+        print('{}: {} sequences'.format(label, count))
+
+
+def merge_clump_arrays(parts, output_dir) -> None:
+    """ Concatenates the clump and offset arrays of every part into <label>.clumps.npy and
+        <label>.offsets.npy, shifting the offsets of each part by the rows before it. """
+    for label in ('doh', 'ndoh'):
+        arrays = []
+        for part in parts:
+            label_dir = os.path.join(part, label)
+            if not os.path.isdir(label_dir):
+                continue
+            for name in sorted(os.listdir(label_dir)):
+                if name.endswith('.clumps.npy'):
+                    offsets = np.load(os.path.join(label_dir, name[:-len('.clumps.npy')] + '.offsets.npy'),
+                                      mmap_mode='r')
+                    arrays.append((np.load(os.path.join(label_dir, name), mmap_mode='r'), offsets))
+        row_count = sum(int(offsets[-1]) for _, offsets in arrays)
+        flow_count = sum(len(offsets) - 1 for _, offsets in arrays)
+        merged_rows = np.lib.format.open_memmap(os.path.join(output_dir, '{}.clumps.npy'.format(label)), 'w+',
+                                                ROWS_DTYPE, (row_count, ROW_FIELDS))
+        merged_offsets = np.lib.format.open_memmap(os.path.join(output_dir, '{}.offsets.npy'.format(label)), 'w+',
+                                                   OFFSETS_DTYPE, (flow_count + 1,))
+        merged_offsets[0] = 0
+        row, flow = 0, 0
+        for rows, offsets in arrays:
+            end = int(offsets[-1])
+            merged_rows[row:row + end] = rows[:end]
+            merged_offsets[flow + 1:flow + len(offsets)] = offsets[1:] + row
+            row += end
+            flow += len(offsets) - 1
+        merged_rows.flush()
+        merged_offsets.flush()
+        print('{}: {} sequences'.format(label, flow_count))
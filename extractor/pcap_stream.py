@@ -0,0 +1,134 @@
+import struct
+
+from scapy.utils import PcapReader
+
+from packet_record import PacketRecord, decode_frame
+
+PCAP_MAGIC_USEC = 0xa1b2c3d4
+PCAP_MAGIC_NSEC = 0xa1b23c4d
+PCAPNG_SECTION_HEADER = 0x0a0d0d0a
+PCAPNG_BYTE_ORDER_MAGIC = 0x1a2b3c4d
+PCAPNG_INTERFACE_DESCRIPTION = 0x00000001
+PCAPNG_PACKET = 0x00000002
+PCAPNG_SIMPLE_PACKET = 0x00000003
+PCAPNG_ENHANCED_PACKET = 0x00000006
+
+
+def read_packets(input_file):
+    """ Yields the packets of a pcap/pcapng file one at a time.
+        Unlike rdpcap, only the current packet is held in memory. """
+    with PcapReader(input_file) as reader:
+        for packet in reader:
+            yield packet
+
+
+def read_frames(input_file):
+    """ Yields (timestamp, linktype, frame bytes, wire length) for every packet of a pcap/pcapng
+        file, without handing anything to scapy. """
+    with open(input_file, 'rb') as f:
+        magic = f.read(4)
+        if len(magic) < 4:
+            return
+        if struct.unpack('<I', magic)[0] == PCAPNG_SECTION_HEADER:
+            yield from _read_pcapng_frames(f, magic)
+        else:
+            yield from _read_pcap_frames(f, magic)
+
+
+def read_records(input_file, decoder='raw'):
+    """ Yields the PacketRecords of a pcap/pcapng file, decoded by the raw decoder or by scapy.
+        Packets that are not TCP/UDP over IP are skipped. """
+    if decoder == 'raw':
+        records = (decode_frame(*frame) for frame in read_frames(input_file))
+    else:
+        records = (PacketRecord.from_scapy(packet) for packet in read_packets(input_file))
+    for record in records:
+        if record is not None:
+            yield record
+
+
+def _read_pcap_frames(f, magic):
+    """ Reads the records of a classic pcap file (either byte order, micro or nanosecond timestamps). """
+    for endian in '<>':
+        value = struct.unpack(endian + 'I', magic)[0]
+        if value in (PCAP_MAGIC_USEC, PCAP_MAGIC_NSEC):
+            break
+    else:
+        raise ValueError('Not a pcap or pcapng file.')
+    resolution = 1e-9 if value == PCAP_MAGIC_NSEC else 1e-6
+    _, _, _, _, _, linktype = struct.unpack(endian + 'HHiIII', f.read(20))
+    record_header = struct.Struct(endian + 'IIII')
+
+    while True:
+        header = f.read(record_header.size)
+        if len(header) < record_header.size:
+            return
+        ts_sec, ts_frac, caplen, wirelen = record_header.unpack(header)
+        data = f.read(caplen)
+        if len(data) < caplen:
+            return
+        yield ts_sec + ts_frac * resolution, linktype, data, wirelen
+
+
+def _read_pcapng_frames(f, magic):
+    """ Reads the packet blocks of a pcapng file, tracking the link type and timestamp
+        resolution of every interface. Simple packet blocks are skipped with a warning. """
+    endian = '<'
+    interfaces = []
+    simple_packets = 0
+    block_type = struct.unpack(endian + 'I', magic)[0]
+
+    while True:
+        length_bytes = f.read(4)
+        if len(length_bytes) < 4:
+            return
+        if block_type == PCAPNG_SECTION_HEADER:
+            order = f.read(4)
+            endian = '<' if struct.unpack('<I', order)[0] == PCAPNG_BYTE_ORDER_MAGIC else '>'
+            block_length = struct.unpack(endian + 'I', length_bytes)[0]
+            body = order + f.read(block_length - 12)
+            interfaces = []
+        else:
+            block_length = struct.unpack(endian + 'I', length_bytes)[0]
+            body = f.read(block_length - 8)
+        if len(body) < block_length - 8:
+            return
+        body = body[:-4]  # trailing block length
+
+        if block_type == PCAPNG_INTERFACE_DESCRIPTION:
+            linktype = struct.unpack_from(endian + 'H', body)[0]
+            interfaces.append((linktype, _pcapng_tsresol(body[8:], endian)))
+        elif block_type == PCAPNG_ENHANCED_PACKET:
+            interface, ts_high, ts_low, caplen, wirelen = struct.unpack_from(endian + 'IIIII', body)
+            linktype, resolution = interfaces[interface]
+            yield ((ts_high << 32) | ts_low) * resolution, linktype, body[20:20 + caplen], wirelen
+        elif block_type == PCAPNG_PACKET:
+            interface, _, ts_high, ts_low, caplen, wirelen = struct.unpack_from(endian + 'HHIIII', body)
+            linktype, resolution = interfaces[interface]
+            yield ((ts_high << 32) | ts_low) * resolution, linktype, body[20:20 + caplen], wirelen
+        elif block_type == PCAPNG_SIMPLE_PACKET:
+            # Simple packet blocks carry no timestamp, which the flows cannot do without
+            if simple_packets == 0:
+                print('Warning: skipping the simple packet blocks of the capture, they have no timestamp')
+            simple_packets += 1
+
+        type_bytes = f.read(4)
+        if len(type_bytes) < 4:
+            return
+        block_type = struct.unpack(endian + 'I', type_bytes)[0]
+
+
+def _pcapng_tsresol(options, endian):
+    """ Extracts the if_tsresol option of an interface description block (default: microseconds). """
+    offset = 0
+    while offset + 4 <= len(options):
+        code, length = struct.unpack_from(endian + 'HH', options, offset)
+        if code == 0:
+            break
+        if code == 9 and length >= 1:
+            value = options[offset + 4]
+            if value & 0x80:
+                return 2.0 ** -(value & 0x7f)
+            return 10.0 ** -value
+        offset += 4 + (length + 3) // 4 * 4
+    return 1e-6
@@ -0,0 +1,124 @@
+import socket
+
+from constants import DOH_IPS
+
+ADDRESS_BITS = {socket.AF_INET: 32, socket.AF_INET6: 128}
+
+
+def parse_address(address) -> tuple:
+    """ Returns the family and integer value of an IPv4 or IPv6 address string. """
+    family = socket.AF_INET6 if ':' in address else socket.AF_INET
+    return family, int.from_bytes(socket.inet_pton(family, address), 'big')
+
+
+class PrefixTrie:
+    """ Longest-prefix match over the networks of one address family, as a radix trie of stride 8:
+        each level is a dict from the next byte of the address to an entry [child, value, length].
+        A prefix whose length is not a multiple of 8 is expanded over the byte values it covers in
+        its last level, so a lookup is at most one dict access per byte of the address. """
+
+    def __init__(self, bits):
+        self.bytes = bits // 8
+        self.root = {}
+        self.default = None  # value of a /0 network
+        self.count = 0
+
+    def insert(self, network, length, value) -> None:
+        self.count += 1
+        if length == 0:
+            self.default = value
+            return
+        last = (length - 1) // 8  # level of the last byte the prefix covers
+        node = self.root
+        for level in range(last):
+            byte = (network >> (8 * (self.bytes - 1 - level))) & 0xff
+            entry = node.get(byte)
+            if entry is None:
+                entry = node[byte] = [None, None, -1]
+            if entry[0] is None:
+                entry[0] = {}
+            node = entry[0]
+        free_bits = 8 * (last + 1) - length
+        first = (network >> (8 * (self.bytes - 1 - last))) & 0xff & ~((1 << free_bits) - 1)
+        for byte in range(first, first + (1 << free_bits)):
+            entry = node.get(byte)
+            if entry is None:
+                node[byte] = [None, value, length]
+            elif entry[2] <= length:
+                # The longer prefix wins the bytes both cover
+                entry[1], entry[2] = value, length
+
+    def lookup(self, address):
+        """ Returns the value of the longest prefix containing the address, or None. """
+        best = self.default
+        node = self.root
+        for shift in range(8 * (self.bytes - 1), -8, -8):
+            entry = node.get((address >> shift) & 0xff)
+            if entry is None:
+                break
+            if entry[1] is not None:
+                best = entry[1]
+            node = entry[0]
+            if node is None:
+                break
+        return best
+
+
+class ResolverList:
+    """ The addresses and networks of known DoH resolvers. Single addresses are kept in a dict per
+        family, from their integer value to their entry, networks in a PrefixTrie per family; lookups
+        return the matching entry. """
+
+    def __init__(self, entries=()):
+        self.addresses = {family: {} for family in ADDRESS_BITS}
+        self.networks = {family: PrefixTrie(bits) for family, bits in ADDRESS_BITS.items()}
+        self.entries = []
+        for entry in entries:
+            self.add(entry)
+
+    @classmethod
+    def from_file(cls, path) -> 'ResolverList':
+        """ Loads a file of one address or CIDR network per line, with # comments. """
+        resolvers = cls()
+        with open(path) as f:
+            for number, line in enumerate(f, 1):
+                entry = line.split('#', 1)[0].strip()
+                if not entry:
+                    continue
+                try:
+                    resolvers.add(entry)
+                except ValueError:
+                    raise ValueError('invalid resolver entry {!r} at line {}'.format(entry, number)) from None
+        return resolvers
+
+    def add(self, entry) -> None:
+        """ Adds an address or CIDR network, raising ValueError if it is not one. """
+        address, _, length = entry.partition('/')
+        try:
+            family, value = parse_address(address)
+            bits = ADDRESS_BITS[family]
+            length = int(length) if length else bits
+        except (OSError, ValueError):  # inet_pton raises OSError
+            raise ValueError('invalid resolver entry {!r}'.format(entry)) from None
+        if not 0 <= length <= bits:
+            raise ValueError('invalid resolver entry {!r}: prefix length out of range'.format(entry))
+        if length == bits:
+            self.addresses[family][value] = entry
+        else:
+            # Host bits are ignored, as with ipaddress.ip_network(entry, strict=False)
+            self.networks[family].insert(value >> (bits - length) << (bits - length), length, entry)
+        self.entries.append(entry)
+
+    def match(self, address):
+        """ Returns the entry matching an address (the address itself or its longest network), or None. """
+        family, value = parse_address(address)
+        entry = self.addresses[family].get(value)
+        if entry is None and self.networks[family].count:
+            entry = self.networks[family].lookup(value)
+        return entry
+
+    def __len__(self):
+        return sum(len(a) for a in self.addresses.values()) + sum(t.count for t in self.networks.values())
+
+
+DEFAULT_RESOLVERS = ResolverList(DOH_IPS)
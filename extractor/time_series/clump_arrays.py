@@ -0,0 +1,123 @@
+import os
+import struct
+
+import numpy as np
+
+ROW_FIELDS = 5  # inter-arrival, duration, size, packets, direction
+ROWS_DTYPE = '<f4'
+OFFSETS_DTYPE = '<i8'
+NPY_HEADER_SIZE = 128  # reserved so the shape can be rewritten in place when the file grows
+FLUSH_SIZE = 512
+
+
+class ClumpArrayWriter:
+    """ Writes the clump sequences of each label as two .npy files that numpy.load can memory map:
+        <directory>/<label>/<prefix>.clumps.npy, a float32 (rows, 5) array of every clump row, and
+        <prefix>.offsets.npy, an int64 array where sequence i is rows[offsets[i]:offsets[i + 1]].
+        Rows are appended as raw data and the .npy headers are only given their final shape on
+        flush, so an existing pair of files is extended rather than rewritten. """
+
+    def __init__(self, directory, prefix='part', flush_size=FLUSH_SIZE):
+        self.directory = directory
+        self.prefix = prefix
+        self.flush_size = flush_size
+        self.labels = {}
+        self.buffered = 0
+        self.sequences = 0
+
+    @property
+    def bytes_written(self) -> int:
+        """ Bytes of rows and offsets written so far, the headers aside. """
+        return sum(state.bytes_written for state in list(self.labels.values()))
+
+    def write(self, label, sequence, shard_key=None) -> None:
+        """ Buffers a sequence of clump rows. `shard_key` is accepted for compatibility with
+            SequenceWriter, a label has a single pair of files. """
+        state = self.labels.get(label)
+        if state is None:
+            state = self.labels[label] = _LabelArrays(self.paths(label))
+        state.add(sequence)
+        self.buffered += 1
+        self.sequences += 1
+        if self.buffered >= self.flush_size:
+            self.flush()
+
+    def flush(self) -> None:
+        """ Writes the buffered sequences out and updates the headers. """
+        for state in self.labels.values():
+            state.flush()
+        self.buffered = 0
+
+    def close(self) -> None:
+        """ Flushes and closes every file. """
+        self.flush()
+        for state in self.labels.values():
+            state.close()
+        self.labels = {}
+
+    def paths(self, label) -> tuple:
+        """ Returns the rows and offsets files of a label. """
+        base = os.path.join(self.directory, label, self.prefix)
+        return base + '.clumps.npy', base + '.offsets.npy'
+
+
+class _LabelArrays:
+    """ The open rows and offsets files of one label, with their buffered additions. """
+
+    def __init__(self, paths):
+        rows_path, offsets_path = paths
+        os.makedirs(os.path.dirname(rows_path), exist_ok=True)
+        # The offsets are authoritative: rows past the last offset were not fully recorded
+        offsets = np.load(offsets_path, mmap_mode='r') if os.path.exists(offsets_path) else ()
+        self.offset_count = len(offsets)
+        self.row_count = int(offsets[-1]) if self.offset_count else 0
+        self.rows = _open_npy(rows_path, self.row_count, ROW_FIELDS * 4)
+        self.offsets = _open_npy(offsets_path, self.offset_count, 8)
+        self.pending_rows = []
+        self.pending_offsets = [] if self.offset_count else [0]
+        self.end = self.row_count
+        self.bytes_written = 0
+        self.flush()
+
+    def add(self, sequence):
+        self.pending_rows.extend(sequence)
+        self.end += len(sequence)
+        self.pending_offsets.append(self.end)
+
+    def flush(self):
+        if self.pending_offsets:
+            rows = np.array(self.pending_rows, dtype=ROWS_DTYPE).reshape(-1, ROW_FIELDS)
+            offsets = np.array(self.pending_offsets, dtype=OFFSETS_DTYPE)
+            rows.tofile(self.rows)
+            offsets.tofile(self.offsets)
+            self.bytes_written += rows.nbytes + offsets.nbytes
+            self.row_count = self.end
+            self.offset_count += len(self.pending_offsets)
+            self.pending_rows = []
+            self.pending_offsets = []
+        _write_npy_header(self.rows, (self.row_count, ROW_FIELDS), ROWS_DTYPE)
+        _write_npy_header(self.offsets, (self.offset_count,), OFFSETS_DTYPE)
+
+    def close(self):
+        self.rows.close()
+        self.offsets.close()
+
+
+def _open_npy(path, length, item_size):
+    """ Opens a .npy file for appending after its first `length` items. Data written after the
+        last header update (by a run that crashed) is dropped, keeping the file consistent. """
+    f = open(path, 'r+b' if os.path.exists(path) else 'w+b')
+    end = NPY_HEADER_SIZE + length * item_size
+    f.truncate(end)
+    f.seek(end)
+    return f
+
+
+def _write_npy_header(f, shape, descr):
+    """ Writes a version 1.0 .npy header padded to NPY_HEADER_SIZE, then returns to the end of the file. """
+    header = "{{'descr': '{}', 'fortran_order': False, 'shape': {}, }}".format(descr, repr(shape))
+    header = header.ljust(NPY_HEADER_SIZE - 10 - 1) + '\n'
+    f.seek(0)
+    f.write(b'\x93NUMPY\x01\x00' + struct.pack('<H', len(header)) + header.encode('latin1'))
+    f.seek(0, os.SEEK_END)
+    f.flush()
@@ -1,8 +1,5 @@
 import os
-import json
 import sys
-from scapy.layers.tls.record import TLSApplicationData
-from scapy.layers.inet import IP, TCP
 
 # Add project root to sys.path
 project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
@@ -23,20 +20,19 @@ class Clump:
         self.first_timestamp = 0
         self.latest_timestamp = 0   
      
-    def add_packet(self, packet):
-        """ Adds a packet to the clump. """
+    def add_packet(self, timestamp, size):
+        """ Adds a packet with `size` bytes of TLS application data to the clump. """
         if self.first_timestamp == 0:
-            self.first_timestamp = packet.time
+            self.first_timestamp = timestamp
         self.packets += 1
-        if TLSApplicationData in packet:
-            self.size += len(packet[TLSApplicationData])
-        self.latest_timestamp = packet.time
+        self.size += size
+        self.latest_timestamp = timestamp
 
-    def accepts(self, packet, direction):
+    def accepts(self, timestamp, direction):
         """ Determines whether a packet can be added to the current clump """
         if direction != self.direction:
             return False
-        if self.latest_timestamp != 0 and packet.time - self.latest_timestamp > CLUMP_TIMEOUT:
+        if self.latest_timestamp != 0 and timestamp - self.latest_timestamp > CLUMP_TIMEOUT:
             return False
         return True
     
@@ -45,16 +41,68 @@ class Clump:
         return self.latest_timestamp - self.first_timestamp
 
 
+class ClumpBuilder:
+    """ Builds the clumps of a flow while its packets arrive.
+        Only the open clump is kept as a Clump, finished clumps are reduced to their output rows. """
+
+    __slots__ = ('current', 'rows', 'latest_clump_end_timestamp')
+
+    def __init__(self):
+        self.current = None
+        self.rows = []
+        self.latest_clump_end_timestamp = None
+
+    def add_packet(self, timestamp, size, direction):
+        """ Adds a packet to the open clump, finishing it first if the packet does not fit.
+            Returns the row of the clump that was finished, if any. """
+        if size < 40:
+            # PING frame (len = 34) or other useless frames
+            return None
+        finished = None
+        if self.current is None:
+            self.current = Clump(direction=direction)
+        elif not self.current.accepts(timestamp, direction):
+            finished = self._finish_current()
+            self.current = Clump(direction=direction)
+        self.current.add_packet(timestamp, size)
+        return finished
+
+    def finish(self):
+        """ Finishes the open clump and returns the rows of all clumps of the flow. """
+        if self.current is not None:
+            self._finish_current()
+            self.current = None
+        return self.rows
+
+    def _finish_current(self):
+        c = self.current
+        if self.latest_clump_end_timestamp is None:
+            self.latest_clump_end_timestamp = c.first_timestamp
+        row = (
+            float(c.first_timestamp - self.latest_clump_end_timestamp),  # inter-arrival duration
+            float(c.duration()),
+            c.size,
+            c.packets,
+            1 if c.direction == PacketDirection.FORWARD else -1
+        )
+        self.latest_clump_end_timestamp = c.latest_timestamp
+        self.rows.append(row)
+        return row
+
+
 class FlowClumpsContainer:
     """ Class represents a sequence of Clump objects within a network flow."""
 
-    def __init__(self, flow, clumps):
+    def __init__(self, flow, clumps=None, rows=None):
         self.flow = flow
         self.clumps = clumps
+        self.rows = rows  # already summarized clumps, see ClumpBuilder
 
     def output(self):
         """ Generates a summary of the clumps
             Returns the results (list of lists, each representing a clump) and the count of clumps. """
+        if self.rows is not None:
+            return [list(row) for row in self.rows], len(self.rows)
         results = []
         latest_clump_end_timestamp = None
         count = 0
@@ -71,27 +119,3 @@ class FlowClumpsContainer:
             ])
             latest_clump_end_timestamp = c.latest_timestamp
         return results, count
-
-    def to_json_file(self, directory):
-        """ Saves the clump data to a JSON file. """
-        preferred_name = '{}_{}-{}_{}.json'.format(self.flow['src'], self.flow['sport'],
-                                                   self.flow['dst'], self.flow['dport'])
-        file_path = os.path.join(directory, preferred_name)
-        print(f"Saving JSON to: {file_path}")
-        output, count = self.output()
-        # Temporarily removing the clump count check for debugging
-        # if count < 5:
-        #     print("Clump count is less than 5, not saving the file.")
-        #     return
-        if os.path.exists(file_path):
-            with open(file_path, 'r') as f:
-                contents = json.load(f)
-                contents.append(output)
-        else:
-            contents = [output]
-        with open(file_path, 'w') as f:
-            json.dump(contents, f, indent=2)
-        print(f"File saved: {file_path}")
-
-
-
@@ -1,5 +1,5 @@
-from scapy.layers.tls.record import TLS, TLSApplicationData
-from extractor.time_series.flow_clumps import Clump, FlowClumpsContainer
+from time_series.flow_clumps import Clump, FlowClumpsContainer
+from features.context.packet_direction import PacketDirection
 
 
 class Processor:
@@ -13,23 +13,23 @@ class Processor:
     def clumps(self):
         """ Generator that processes packets in the flow and groups them into clumps. """
         current_clump = None
-        for packet, direction in self.flow.packets:
-            if TLS not in packet:
-                continue
-            if TLSApplicationData not in packet:
-                continue
-            if len(packet[TLSApplicationData]) < 40:
+        for timestamp, size, direction in zip(self.flow.times, self.flow.app_data_lengths, self.flow.directions):
+            if size < 40:
                 # PING frame (len = 34) or other useless frames
                 continue
+            direction = PacketDirection(direction)
             if current_clump is None:
                 current_clump = Clump(direction=direction)
-            if not current_clump.accepts(packet, direction):
+            if not current_clump.accepts(timestamp, direction):
                 yield current_clump
                 current_clump = Clump(direction=direction)
-            current_clump.add_packet(packet)
+            current_clump.add_packet(timestamp, size)
         if current_clump is not None:
             yield current_clump
 
     def create_flow_clumps_container(self):
-        """ Creates a FlowClumpsContainer that holds the flow and the clumps generated by the clumps method. """
+        """ Creates a FlowClumpsContainer that holds the flow and the clumps generated by the clumps method,
+            or the clumps already built while the packets arrived when the flow was clumped incrementally. """
+        if self.flow.clump_builder is not None:
+            return FlowClumpsContainer(flow=self.flow, rows=self.flow.clump_builder.finish())
         return FlowClumpsContainer(flow=self.flow, clumps=self.clumps())
@@ -0,0 +1,68 @@
+import gzip
+import json
+import os
+import zlib
+
+DEFAULT_SHARDS = 4
+FLUSH_SIZE = 512
+
+
+class SequenceWriter:
+    """ Appends clump sequences, one JSON array per line, to `shards` files per label:
+        <directory>/<label>/<prefix>-<shard>.jsonl (.jsonl.gz when compressed).
+        Sequences are buffered and written FLUSH_SIZE at a time, and files are only ever appended to,
+        so the cost of a sequence does not depend on how many were written before it. """
+
+    def __init__(self, directory, shards=DEFAULT_SHARDS, compress=False, prefix='part', flush_size=FLUSH_SIZE):
+        self.directory = directory
+        self.shards = shards
+        self.compress = compress
+        self.prefix = prefix
+        self.flush_size = flush_size
+        self.files = {}
+        self.buffers = {}
+        self.buffered = 0
+        self.sequences = 0
+        self.bytes_written = 0  # before compression
+
+    def write(self, label, sequence, shard_key) -> None:
+        """ Buffers a sequence for the shard of `shard_key`, a string identifying its connection:
+            the sequences of a connection always go to the same shard, in order. """
+        shard = zlib.crc32(shard_key.encode()) % self.shards
+        self.buffers.setdefault((label, shard), []).append(json.dumps(sequence))
+        self.buffered += 1
+        self.sequences += 1
+        if self.buffered >= self.flush_size:
+            self.flush()
+
+    def flush(self) -> None:
+        """ Writes the buffered sequences out. """
+        for (label, shard), lines in self.buffers.items():
+            if lines:
+                text = '\n'.join(lines) + '\n'
+                self._file(label, shard).write(text)
+                self.bytes_written += len(text)
+                lines.clear()
+        self.buffered = 0
+
+    def close(self) -> None:
+        """ Flushes and closes every file. """
+        self.flush()
+        for f in self.files.values():
+            f.close()
+        self.files = {}
+
+    def path(self, label, shard) -> str:
+        """ Returns the file of a shard. """
+        extension = '.jsonl.gz' if self.compress else '.jsonl'
+        return os.path.join(self.directory, label, '{}-{:03d}{}'.format(self.prefix, shard, extension))
+
+    def _file(self, label, shard):
+        f = self.files.get((label, shard))
+        if f is None:
+            path = self.path(label, shard)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Appending to a gzip file adds a member, which gzip readers decompress transparently
+            f = gzip.open(path, 'at') if self.compress else open(path, 'a')
+            self.files[(label, shard)] = f
+        return f
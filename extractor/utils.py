@@ -1,3 +1,4 @@
+import time
 import uuid
 from itertools import islice, zip_longest
 
@@ -14,3 +15,26 @@ def grouper(iterable, n, max_groups=0, fillvalue=None):
 def random_string():
     """ Generates a random string. """
     return uuid.uuid4().hex[:6].upper().replace('0', 'X').replace('O', 'Y')
+
+
+class Throughput:
+    """ Counts packets and bytes and periodically reports the processing rate. """
+
+    def __init__(self, interval=10000):
+        self.interval = interval
+        self.packets = 0
+        self.bytes = 0
+        self.start_time = time.perf_counter()
+
+    def update(self, size):
+        """ Accounts for one packet of `size` bytes, reporting every `interval` packets (never if 0). """
+        self.packets += 1
+        self.bytes += size
+        if self.interval and self.packets % self.interval == 0:
+            self.report()
+
+    def report(self):
+        """ Prints the totals and the average packets/s and bytes/s since start. """
+        elapsed = max(time.perf_counter() - self.start_time, 1e-9)
+        print('Packets: {} ({:.0f} packets/s), Bytes: {} ({:.0f} bytes/s)'.format(
+            self.packets, self.packets / elapsed, self.bytes, self.bytes / elapsed))
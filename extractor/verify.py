@@ -0,0 +1,201 @@
+import argparse
+import json
+import os
+import random
+import socket
+import struct
+import sys
+import time
+
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(project_root)
+
+from capture import SNAPLEN, compile_filter
+from features.context.packet_direction import PacketDirection
+from flow import Flow
+from packet_record import PacketRecord
+
+# CSV values of synthetic flows of 1 to 1000 packets, as computed by the original packet-list Flow
+# (with the ResponseTime directions fix), the reference the rewritten feature code must reproduce
+GOLDEN_FEATURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'golden_features.json')
+
+
+def synthetic_flow(packet_count, seed=0, **flow_options):
+    """ Creates a flow of `packet_count` packets with random sizes, gaps and directions. """
+    rng = random.Random(seed)
+    timestamp = 1600000000.0
+    flow = None
+    for _ in range(packet_count):
+        timestamp += rng.choice([0.0002, 0.0005, 0.003, 0.05, 0.4]) * rng.random()
+        direction = rng.choice([PacketDirection.FORWARD, PacketDirection.REVERSE])
+        src, dst = ('10.0.0.1', '1.1.1.1') if direction == PacketDirection.FORWARD else ('1.1.1.1', '10.0.0.1')
+        sport, dport = (40000, 443) if direction == PacketDirection.FORWARD else (443, 40000)
+        length = rng.choice([66, 120, 583, 1514, rng.randint(60, 1514)])
+        packet = PacketRecord(timestamp, src, dst, sport, dport, 'TCP', length, max(0, length - 71))
+        if flow is None:
+            flow = Flow(packet, direction, **flow_options)
+        flow.add_packet(packet, direction)
+    return flow
+
+
+def check_flow_features(path=GOLDEN_FEATURES) -> int:
+    """ Compares the CSV values of the synthetic flows with the golden ones and returns the number of
+        mismatches. The golden timestamps are in UTC. """
+    os.environ['TZ'] = 'UTC'
+    time.tzset()
+    with open(path) as f:
+        golden = json.load(f)
+    mismatches = 0
+    for size, expected in golden.items():
+        actual = synthetic_flow(int(size), seed=int(size)).get_data()
+        for key in sorted(set(expected) | set(actual)):
+            if key not in actual or str(actual[key]) != expected.get(key):
+                mismatches += 1
+                print('  mismatch in {} for {} packets: {} != {}'.format(key, size, expected.get(key),
+                                                                          actual.get(key)))
+    print('{} golden flows checked, {} mismatches'.format(len(golden), mismatches))
+    return mismatches
+
+
+def run_filter(program, frame) -> int:
+    """ Runs a classic BPF program, as assembled by compile_filter, over a frame and returns its verdict:
+        the number of bytes kept, 0 when the frame is dropped. Like the kernel, a load past the end of
+        the frame drops it. Only the instructions compile_filter emits are supported. """
+    instructions = [struct.unpack_from('=HBBI', program, offset) for offset in range(0, len(program), 8)]
+    a = x = pc = 0
+    while True:
+        code, jt, jf, k = instructions[pc]
+        pc += 1
+        kind = code & 0x07
+        if kind in (0, 1):  # LD, LDX
+            size = {0x00: 4, 0x08: 2, 0x10: 1}[code & 0x18]
+            mode = code & 0xe0
+            offset = k + x if mode == 0x40 else k
+            if offset + size > len(frame):
+                return 0
+            if mode == 0xa0:  # ldx 4 * ([k] & 0xf), the IPv4 header length
+                x = (frame[offset] & 0x0f) * 4
+            elif mode in (0x20, 0x40):
+                a = int.from_bytes(frame[offset:offset + size], 'big')
+            else:
+                raise ValueError('unsupported BPF load 0x{:02x}'.format(code))
+        elif kind == 4 and code & 0xf8 == 0x50:  # and #k
+            a &= k
+        elif kind == 5:
+            operation = code & 0xf0
+            if operation == 0x00:  # ja
+                pc += k
+            elif operation in (0x10, 0x40):  # jeq #k, jset #k
+                pc += jt if (a == k if operation == 0x10 else a & k) else jf
+            else:
+                raise ValueError('unsupported BPF jump 0x{:02x}'.format(code))
+        elif kind == 6:
+            return k
+        else:
+            raise ValueError('unsupported BPF instruction 0x{:02x}'.format(code))
+
+
+def tcp_ports(source_port, destination_port) -> bytes:
+    return struct.pack('!HHIIBBHHH', source_port, destination_port, 0, 0, 5 << 4, 0x18, 65535, 0, 0)
+
+
+def ipv4_frame(source, destination, source_port=50000, destination_port=443, protocol=6, ihl=5,
+               fragment=0, payload=None) -> bytes:
+    """ An Ethernet frame of an IPv4 packet, with `ihl` 32-bit words of header (the options are filled
+        with 443s, so a filter reading the ports at a fixed offset would match them) and the fragment
+        field `fragment` (flags and offset). """
+    if payload is None:
+        payload = tcp_ports(source_port, destination_port)
+    options = struct.pack('!H', 443) * (2 * (ihl - 5))
+    header = struct.pack('!BBHHHBBH4s4s', 0x40 | ihl, 0, 4 * ihl + len(payload), 0, fragment, 64, protocol, 0,
+                         socket.inet_pton(socket.AF_INET, source), socket.inet_pton(socket.AF_INET, destination))
+    return b'\x00' * 12 + struct.pack('!H', 0x0800) + header + options + payload
+
+
+def ipv6_frame(source, destination, source_port=50000, destination_port=443, next_header=6) -> bytes:
+    payload = tcp_ports(source_port, destination_port)
+    header = struct.pack('!IHBB16s16s', 6 << 28, len(payload), next_header, 64,
+                         socket.inet_pton(socket.AF_INET6, source), socket.inet_pton(socket.AF_INET6, destination))
+    return b'\x00' * 12 + struct.pack('!H', 0x86dd) + header + payload
+
+
+RESOLVER_NETWORKS = ('1.1.1.0/24', '9.9.9.9', '2606:4700::/32', '2620:fe::fe')
+HOST = '192.168.1.10'
+HOST6 = 'fd00::10'
+
+# description, frame, ports, networks, expected verdict (accepted or not)
+FILTER_CASES = [
+    ('v4 to a resolver network on 443', ipv4_frame(HOST, '1.1.1.1'), (443,), RESOLVER_NETWORKS, True),
+    ('v4 from a resolver network on 443', ipv4_frame('1.1.1.200', HOST, 443, 50000), (443,), RESOLVER_NETWORKS,
+     True),
+    ('v4 to a resolver address', ipv4_frame(HOST, '9.9.9.9'), (443,), RESOLVER_NETWORKS, True),
+    ('v4 next to a resolver address', ipv4_frame(HOST, '9.9.9.8'), (443,), RESOLVER_NETWORKS, False),
+    ('v4 outside the networks', ipv4_frame(HOST, '1.1.2.1'), (443,), RESOLVER_NETWORKS, False),
+    ('v4 on another port', ipv4_frame(HOST, '1.1.1.1', 50000, 80), (443,), RESOLVER_NETWORKS, False),
+    ('v4 on one of several ports', ipv4_frame(HOST, '1.1.1.1', 50000, 853), (443, 853), RESOLVER_NETWORKS, True),
+    ('v4 UDP', ipv4_frame(HOST, '1.1.1.1', protocol=17), (443,), RESOLVER_NETWORKS, False),
+    ('v4 ICMP', ipv4_frame(HOST, '1.1.1.1', protocol=1, payload=b'\x08' + b'\x00' * 19), (443,), (), False),
+    ('v4 with options (IHL 6) on 443', ipv4_frame(HOST, '1.1.1.1', 50000, 443, ihl=6), (443,),
+     RESOLVER_NETWORKS, True),
+    ('v4 with options (IHL 6) on 80', ipv4_frame(HOST, '1.1.1.1', 50000, 80, ihl=6), (443,),
+     RESOLVER_NETWORKS, False),
+    ('v4 with the longest header (IHL 15) on 443', ipv4_frame(HOST, '1.1.1.1', ihl=15), (443,), (), True),
+    ('v4 with the longest header (IHL 15) on 80', ipv4_frame(HOST, '1.1.1.1', 50000, 80, ihl=15), (443,), (),
+     False),
+    ('v4 first fragment', ipv4_frame(HOST, '1.1.1.1', fragment=0x2000), (443,), RESOLVER_NETWORKS, True),
+    ('v4 non-first fragment', ipv4_frame(HOST, '1.1.1.1', 443, 443, fragment=0x2000 | 185), (443,),
+     RESOLVER_NETWORKS, False),
+    ('v4 last fragment', ipv4_frame(HOST, '1.1.1.1', 443, 443, fragment=185), (443,), RESOLVER_NETWORKS, False),
+    ('v4 truncated before the ports', ipv4_frame(HOST, '1.1.1.1')[:36], (443,), (), False),
+    ('v4 any port', ipv4_frame(HOST, '1.1.1.1', 50000, 8443), (), RESOLVER_NETWORKS, True),
+    ('v4 any address', ipv4_frame(HOST, '203.0.113.1'), (443,), (), True),
+    ('v4 with only IPv6 networks', ipv4_frame(HOST, '1.1.1.1'), (443,), ('2606:4700::/32',), False),
+    ('v4 in the default route', ipv4_frame(HOST, '203.0.113.1'), (443,), ('0.0.0.0/0',), True),
+    ('v4 in a /12', ipv4_frame(HOST, '172.31.255.1'), (443,), ('172.16.0.0/12',), True),
+    ('v4 next to a /12', ipv4_frame(HOST, '172.32.0.1'), (443,), ('172.16.0.0/12',), False),
+    ('v6 to a resolver network on 443', ipv6_frame(HOST6, '2606:4700::1111'), (443,), RESOLVER_NETWORKS, True),
+    ('v6 from a resolver network on 443', ipv6_frame('2606:4700:ffff::1', HOST6, 443, 50000), (443,),
+     RESOLVER_NETWORKS, True),
+    ('v6 outside the networks', ipv6_frame(HOST6, '2606:4701::1111'), (443,), RESOLVER_NETWORKS, False),
+    ('v6 to a resolver address', ipv6_frame(HOST6, '2620:fe::fe'), (443,), RESOLVER_NETWORKS, True),
+    ('v6 next to a resolver address', ipv6_frame(HOST6, '2620:fe::ff'), (443,), RESOLVER_NETWORKS, False),
+    ('v6 on another port', ipv6_frame(HOST6, '2606:4700::1111', 50000, 80), (443,), RESOLVER_NETWORKS, False),
+    ('v6 UDP', ipv6_frame(HOST6, '2606:4700::1111', next_header=17), (443,), RESOLVER_NETWORKS, False),
+    # Extension headers are not followed, see compile_filter
+    ('v6 with a hop-by-hop header', ipv6_frame(HOST6, '2606:4700::1111', next_header=0), (443,), (), False),
+    ('v6 with only IPv4 networks', ipv6_frame(HOST6, '2606:4700::1111'), (443,), ('1.1.1.0/24',), False),
+    ('v6 in a /64', ipv6_frame(HOST6, '2001:db8:0:1::53'), (443,), ('2001:db8:0:1::/64',), True),
+    ('v6 next to a /64', ipv6_frame(HOST6, '2001:db8:0:2::53'), (443,), ('2001:db8:0:1::/64',), False),
+    ('v6 in a /100', ipv6_frame(HOST6, '2001:db8::0fff:ffff'), (443,), ('2001:db8::/100',), True),
+    ('v6 next to a /100', ipv6_frame(HOST6, '2001:db8::1000:0'), (443,), ('2001:db8::/100',), False),
+    ('ARP', b'\x00' * 12 + struct.pack('!H', 0x0806) + b'\x00' * 28, (443,), (), False),
+    # Enough networks for the accepting instructions to be repeated within jump range
+    ('v4 after 600 networks', ipv4_frame(HOST, '10.2.87.1'), (443,),
+     ['10.{}.{}.0/24'.format(i // 256, i % 256) for i in range(600)], True),
+    ('v6 after 150 networks', ipv6_frame(HOST6, '2001:db8:95::1'), (443,),
+     ['2001:db8:{:x}::/48'.format(i) for i in range(150)], True),
+    ('v6 past 150 networks', ipv6_frame(HOST6, '2001:db8:96::1'), (443,),
+     ['2001:db8:{:x}::/48'.format(i) for i in range(150)], False),
+]
+
+
+def check_filter() -> int:
+    """ Runs the BPF programs of compile_filter over the frames of FILTER_CASES and compares the verdicts
+        with the expected ones (and the kept length with SNAPLEN). Returns the number of mismatches. """
+    mismatches = 0
+    for description, frame, ports, networks, expected in FILTER_CASES:
+        verdict = run_filter(compile_filter(ports, networks), frame)
+        if verdict not in (0, SNAPLEN) or bool(verdict) != expected:
+            mismatches += 1
+            print('  filter mismatch for {} (ports {}, {} networks): {} instead of {}'
+                  .format(description, ports, len(networks), verdict, SNAPLEN if expected else 0))
+    print('{} filter cases checked, {} mismatches'.format(len(FILTER_CASES), mismatches))
+    return mismatches
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Checks the flow features against golden values and the '
+                                                 'compiled BPF filters against a table of crafted frames.')
+    parser.parse_args()
+    if check_flow_features() + check_filter():
+        sys.exit(1)